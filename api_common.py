@@ -0,0 +1,43 @@
+"""Phần dùng chung giữa gemini_chat.py và test_voice.py: phiên HTTP keep-alive và cấu hình ElevenLabs
+
+Chỉ phụ thuộc requests, nên nạp module này không chạy phần khởi tạo của gemini_chat
+(bộ nhớ đệm, kho job, kiểm tra gTTS...).
+"""
+import threading
+import requests
+
+# Cấu hình kết nối HTTP dùng chung (keep-alive)
+HTTP_POOL_CONNECTIONS = 10   # Số host được giữ connection pool
+HTTP_POOL_MAXSIZE = 16       # Số kết nối tối đa được giữ lại cho mỗi host
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Trả về phiên HTTP dùng chung với connection pool theo host, an toàn khi gọi từ nhiều luồng"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                                        pool_maxsize=HTTP_POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_session = session
+    return _http_session
+
+def reset_http_session():
+    """Đóng phiên HTTP dùng chung, lần gọi sau sẽ tạo lại theo cấu hình pool hiện tại"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+
+# Cấu hình ElevenLabs
+ELEVENLABS_API_BASE = "https://api.elevenlabs.io/v1"
+ELEVENLABS_VOICE_ID = "21m00Tcm4TlvDq8ikWAM"  # Rachel
+ELEVENLABS_MODEL_ID = "eleven_multilingual_v2"
+ELEVENLABS_VOICE_SETTINGS = {"stability": 0.5, "similarity_boost": 0.75}
+ELEVENLABS_OUTPUT_FORMAT = "mp3_44100_128"
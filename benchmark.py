@@ -0,0 +1,1733 @@
+#!/usr/bin/env python3
+"""Benchmark gemini_chat against local stub servers (no network or API keys needed)"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import glob
+import contextlib
+import io
+import threading
+import json
+import re
+import random
+import unicodedata
+import platform
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import gemini_chat
+
+SAMPLE_SENTENCE = "Đây là một câu mẫu dùng để đo hiệu năng của trình tạo giọng nói, với một vài dấu phẩy để chia đoạn."
+
+def make_sample_text(sentences):
+    """Numbered copies of SAMPLE_SENTENCE, so every TTS chunk is distinct and is not fetched once by chunk dedup"""
+    return " ".join(f"Câu số {i}: {SAMPLE_SENTENCE}" for i in range(sentences))
+
+def make_fake_mp3(frames=20, tagged=False):
+    """Build a silent MPEG-1 Layer III stream (128 kbps, 44.1 kHz) of the given frame count
+
+    With tagged=True the stream is wrapped like a typical encoder output: an ID3v2 tag,
+    a LAME Info frame, the audio frames and an ID3v1 tag.
+    """
+    # 0xFFFB9000: sync, MPEG-1, Layer III, no CRC, 128 kbps, 44100 Hz, no padding
+    frame = b'\xff\xfb\x90\x00' + b'\x00' * 413
+    if not tagged:
+        return frame * frames
+    id3v2 = b'ID3\x04\x00\x00\x00\x00\x00\x0f' + b'TIT2\x00\x00\x00\x05\x00\x00chunk'
+    info_frame = frame[:36] + b'Info' + frame[40:]
+    id3v1 = b'TAG' + b'\x00' * 125
+    return id3v2 + info_frame + frame * frames + id3v1
+
+class StubBehaviour:
+    """Latency, jitter and error rate shared by the stub handlers"""
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    error_status = 503
+    rng = random.Random(0)
+
+    def simulate(self, latency=None):
+        """Sleep for the latency plus up to `jitter` seconds, returns True if the request should fail"""
+        delay = self.latency if latency is None else latency
+        if self.jitter:
+            delay += self.rng.uniform(0, self.jitter)
+        time.sleep(delay)
+        return self.error_rate > 0 and self.rng.random() < self.error_rate
+
+    def send_error_status(self):
+        self.send_response(self.error_status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StubTTSHandler(StubBehaviour, BaseHTTPRequestHandler):
+    """Mimics the translate_tts endpoint: sleeps for the configured latency then returns MP3 bytes"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.05
+    payload = make_fake_mp3(tagged=True)
+    requests_served = 0
+    counter_lock = threading.Lock()
+
+    def do_GET(self):
+        with self.counter_lock:
+            type(self).requests_served += 1
+        if self.simulate():
+            return self.send_error_status()
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+class StubElevenLabsHandler(StubBehaviour, BaseHTTPRequestHandler):
+    """Mimics POST /v1/text-to-speech/{voice_id}: requires xi-api-key and returns MP3 bytes"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.3
+    payload = make_fake_mp3(100, tagged=True)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.startswith('/v1/text-to-speech/') or not self.headers.get('xi-api-key'):
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.simulate():
+            return self.send_error_status()
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+class StubElevenLabsStreamHandler(StubElevenLabsHandler):
+    """Mimics POST /v1/text-to-speech/{voice_id}/stream: audio length follows the text, sent in blocks at `bytes_per_second`"""
+    seconds_per_char = 0.06
+    bytes_per_second = 4 * 1024 * 1024
+    block_bytes = 64 * 1024
+    frame = make_fake_mp3(1)
+    requests_served = 0
+    counter_lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.startswith('/v1/text-to-speech/') or not self.headers.get('xi-api-key'):
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with self.counter_lock:
+            type(self).requests_served += 1
+        if self.simulate():
+            return self.send_error_status()
+        # 128 kbps MPEG-1 frames last 1152 / 44100 s; generated block by block so the stub holds one block at a time
+        frames = max(1, round(len(body.get('text', '')) * self.seconds_per_char * 44100 / 1152))
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(frames * len(self.frame)))
+        self.end_headers()
+        block_frames = max(1, self.block_bytes // len(self.frame))
+        for sent in range(0, frames, block_frames):
+            block = self.frame * min(block_frames, frames - sent)
+            self.wfile.write(block)
+            time.sleep(len(block) / self.bytes_per_second)
+
+class StubThrottledTTSHandler(StubTTSHandler):
+    """translate_tts stub that accepts `capacity` requests per second and answers 429 with Retry-After above it"""
+    capacity = 8.0
+    retry_after = 1
+    counts = {'ok': 0, 'throttled': 0}
+    _lock = threading.Lock()
+    _tokens = 0.0
+    _updated = 0.0
+
+    @classmethod
+    def reset(cls, capacity):
+        cls.capacity = capacity
+        cls.counts = {'ok': 0, 'throttled': 0}
+        cls._tokens = capacity
+        cls._updated = time.monotonic()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls._lock:
+            now = time.monotonic()
+            cls._tokens = min(cls.capacity, cls._tokens + (now - cls._updated) * cls.capacity)
+            cls._updated = now
+            allowed = cls._tokens >= 1.0
+            if allowed:
+                cls._tokens -= 1.0
+            cls.counts['ok' if allowed else 'throttled'] += 1
+        if allowed:
+            return super().do_GET()
+        self.send_response(429)
+        self.send_header('Retry-After', str(self.retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+def make_fake_script(sentences=40, distinct=False):
+    """Build a Gemini-style script with [tiêu đề] and [nội dung] sections
+
+    With distinct=True the sentences are numbered, so chunk dedup cannot collapse the TTS work.
+    """
+    body = make_sample_text(sentences) if distinct else " ".join([SAMPLE_SENTENCE] * sentences)
+    return f"[tiêu đề]\nKịch bản thử nghiệm hiệu năng\n\n[nội dung]\n{body}\n"
+
+class StubGeminiHandler(StubBehaviour, BaseHTTPRequestHandler):
+    """Mimics generateContent and streamGenerateContent (SSE) with a fixed generation time
+
+    Multi-turn (continuation) requests are answered with `continuation` when it is set. With
+    `seconds_per_word` set, the generation time is proportional to the words returned instead.
+    A `tail_probability` share of requests is slowed by `tail_time`, a `short_probability` share of
+    candidates is replaced by `short_script`, and `candidateCount` candidates are returned.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    generation_time = 1.0
+    seconds_per_word = None
+    script = make_fake_script()
+    continuation = None
+    stream_parts = 20
+    tail_probability = 0.0
+    tail_time = 0.0
+    short_probability = 0.0
+    short_script = make_fake_script(10)
+    rng = random.Random(0)
+    counts = {'calls': 0, 'words': 0, 'aborted': 0}
+
+    @classmethod
+    def reset_counts(cls):
+        cls.counts = {'calls': 0, 'words': 0, 'aborted': 0}
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.continuation is not None and len(request.get('contents', [])) > 1:
+            texts = [self.continuation]
+        else:
+            candidate_count = request.get('generationConfig', {}).get('candidateCount', 1)
+            texts = [self.short_script if self.rng.random() < self.short_probability else self.script
+                     for _ in range(candidate_count)]
+        words = max(len(text.split()) for text in texts)
+        generation_time = self.generation_time if self.seconds_per_word is None else words * self.seconds_per_word
+        if self.rng.random() < self.tail_probability:
+            generation_time += self.tail_time
+        if self.simulate(latency=0.0):
+            return self.send_error_status()
+        type(self).counts['calls'] += 1
+        type(self).counts['words'] += sum(len(text.split()) for text in texts)
+        self.reply(texts, generation_time)
+
+    def reply(self, texts, generation_time):
+        text = texts[0]
+        # Roughly two tokens per Vietnamese word, reported like usageMetadata.totalTokenCount
+        usage = {"totalTokenCount": 2 * sum(len(text.split()) for text in texts)}
+        if ':streamGenerateContent' in self.path:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            # The SSE body has no length, so it ends when the connection closes
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            sizes = [-(-len(text) // self.stream_parts) for text in texts]
+            for part in range(self.stream_parts):
+                time.sleep(generation_time / self.stream_parts)
+                event = {"candidates": [{"index": index, "content": {"parts": [{"text": text[part * size:(part + 1) * size]}]}}
+                                        for index, (text, size) in enumerate(zip(texts, sizes)) if part * size < len(text)]}
+                if part == self.stream_parts - 1:
+                    event["usageMetadata"] = usage
+                try:
+                    self.wfile.write(f"data: {json.dumps(event)}\r\n\r\n".encode('utf-8'))
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading (a hedged request that lost)
+                    type(self).counts['aborted'] += 1
+                    return
+            return
+
+        time.sleep(generation_time)
+        body = json.dumps({"candidates": [{"content": {"parts": [{"text": text}]}} for text in texts],
+                           "usageMetadata": usage}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubQuotaGeminiHandler(StubGeminiHandler):
+    """generateContent stub that accepts `capacity` requests per `window` seconds for each ?key= and answers 429 above it"""
+    generation_time = 0.05
+    capacity = 4
+    window = 1.0
+    quota_counts = {'ok': 0, 'throttled': 0}
+    _lock = threading.Lock()
+    _recent = {}
+
+    @classmethod
+    def reset(cls):
+        cls.quota_counts = {'ok': 0, 'throttled': 0}
+        cls._recent = {}
+
+    def do_POST(self):
+        cls = type(self)
+        key = re.search(r'[?&]key=([^&]+)', self.path).group(1)
+        with cls._lock:
+            now = time.monotonic()
+            recent = [sent for sent in cls._recent.get(key, []) if sent > now - cls.window]
+            allowed = len(recent) < cls.capacity
+            if allowed:
+                recent.append(now)
+            cls._recent[key] = recent
+            cls.quota_counts['ok' if allowed else 'throttled'] += 1
+        if allowed:
+            return super().do_POST()
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(429)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+# Reference (pre-optimization) text cleaning, kept verbatim as the golden baseline
+# for the compiled cleaning engine in gemini_chat.
+
+def legacy_clean_response(response_text):
+    if not response_text:
+        return ""
+        
+    # Lưu văn bản gốc trước khi làm sạch để kiểm tra
+    original_length = len(response_text.strip())
+    
+    # Remove asterisks
+    cleaned_text = response_text.replace('*', '')
+    
+    # Remove time codes like (7:30-8:00)
+    cleaned_text = re.sub(r'\(\d+:\d+-\d+:\d+\)', '', cleaned_text)
+    
+    # Remove timestamp patterns like 7:30, 12:45, etc.
+    cleaned_text = re.sub(r'\b\d+:\d+\b', '', cleaned_text)
+    
+    # Remove square brackets and their contents that aren't part of [title]/[tiêu đề] and [content]/[nội dung]
+    # Careful not to remove the actual tags we need
+    cleaned_text = re.sub(r'\[(?!(title|tiêu đề|content|nội dung))[^\]]*\]', '', cleaned_text)
+    
+    # Remove parentheses and their contents
+    cleaned_text = re.sub(r'\(.*?\)', '', cleaned_text)
+    
+    # Clear extra whitespace
+    cleaned_text = re.sub(r' +', ' ', cleaned_text)
+    cleaned_text = re.sub(r'\n\s*\n\s*\n+', '\n\n', cleaned_text)
+    
+    # Remove introductory phrases like "Tuyệt vời! Đây là kịch bản..."
+    cleaned_text = re.sub(r'^(Tuyệt vời|Chắc chắn|Dưới đây|Đây là kịch bản|Đây là nội dung|Dưới đây là kịch bản)[^[]*', '', cleaned_text)
+    
+    # Remove any references or annotations
+    cleaned_text = re.sub(r'\bRef\.?:?\s.*?$', '', cleaned_text, flags=re.MULTILINE)
+    cleaned_text = re.sub(r'\bNotes?:?\s.*?$', '', cleaned_text, flags=re.MULTILINE)
+    cleaned_text = re.sub(r'\bSources?:?\s.*?$', '', cleaned_text, flags=re.MULTILINE)
+    
+    # Filter out any instructions or annotations that start with special characters
+    cleaned_text = re.sub(r'^[-*_>]+.*$', '', cleaned_text, flags=re.MULTILINE)
+    
+    # Kết quả cuối cùng
+    cleaned_text = cleaned_text.strip()
+    cleaned_length = len(cleaned_text)
+    
+    # Kiểm tra nếu làm sạch đã loại bỏ quá nhiều nội dung
+    if cleaned_length < original_length * 0.1 and original_length > 100:
+        print(f"Cảnh báo: Làm sạch đã loại bỏ quá nhiều nội dung (từ {original_length} xuống {cleaned_length} ký tự)")
+        # Trả về văn bản gốc nếu làm sạch đã xóa quá nhiều
+        if cleaned_length < 50 and original_length > 100:
+            print("Sử dụng văn bản gốc thay thế vì văn bản sau khi làm sạch quá ngắn")
+            return response_text.strip()
+    
+    return cleaned_text
+
+
+def legacy_filter_speech_content(text):
+    """Lọc các thành phần không cần thiết trong kịch bản trước khi chuyển đổi thành giọng nói"""
+    if not text:
+        return ""
+    
+    # Lưu văn bản gốc
+    original_text = text
+    
+    # 1. Lọc bỏ các phần intro giới thiệu kịch bản
+    intro_patterns = [
+        r'^.*?(đây là kịch bản|kịch bản|bài viết).*?video.*?youtube.*?\.',
+        r'^(Tuyệt vời|Chắc chắn|Được rồi|Dưới đây|Sau đây|Xin chào).*?(kịch bản|bài viết|nội dung).*?\.',
+        r'^.*?kịch bản.*?(về chủ đề|với chủ đề|về).*?\.',
+        r'^.*?đây là.*?(kịch bản|nội dung|bài viết).*?\.',
+        # Thêm mẫu cụ thể để bắt dòng "Tuyệt vời! Đây là kịch bản chi tiết..."
+        r'^Tuyệt vời\! Đây là kịch bản chi tiết.*?\.',
+        r'^Tuyệt vời\! Đây là kịch bản.*?20 phút.*?\.',
+        r'^Tuyệt vời\! Đây là kịch bản.*?chủ đề.*?\.',
+        r'^Tuyệt vời\!.*?kịch bản.*?\.'
+    ]
+    
+    # Tìm và loại bỏ mẫu intro đầu tiên tìm thấy
+    filtered_text = text
+    for pattern in intro_patterns:
+        match = re.search(pattern, filtered_text, re.IGNORECASE)
+        if match:
+            intro_text = match.group(0)
+            filtered_text = filtered_text.replace(intro_text, '', 1)
+            print(f"Đã loại bỏ phần giới thiệu: '{intro_text[:50]}...'")
+            break  # Chỉ loại bỏ mẫu đầu tiên tìm thấy
+    
+    # 2. Lọc các hướng dẫn diễn xuất (đặt trong ngoặc vuông, ngoặc tròn hoặc dấu *)
+    acting_patterns = [
+        r'\[.*?\]',  # Loại bỏ [mọi thứ trong ngoặc vuông]
+        r'\(.*?\)',  # Loại bỏ (mọi thứ trong ngoặc tròn)
+        r'\*.*?\*',  # Loại bỏ *mọi thứ giữa dấu sao*
+    ]
+    
+    for pattern in acting_patterns:
+        filtered_text = re.sub(pattern, '', filtered_text)
+    
+    # 3. Lọc bỏ định dạng markdown
+    markdown_patterns = [
+        r'\*\*',  # Loại bỏ ** (bold)
+        r'\_\_',  # Loại bỏ __ (bold)
+        r'\*',    # Loại bỏ * (italic)
+        r'\_',    # Loại bỏ _ (italic)
+        r'\~\~',  # Loại bỏ ~~ (strikethrough)
+        r'\`',    # Loại bỏ ` (code)
+    ]
+    
+    for pattern in markdown_patterns:
+        filtered_text = filtered_text.replace(pattern, '')
+    
+    # 4. Lọc các lời kêu gọi hành động (CTA) thường có ở cuối
+    cta_patterns = [
+        r'Đừng quên.*?like.*?đăng ký.*?',
+        r'Hãy để lại.*?bình luận.*?',
+        r'Bấm đăng ký.*?',
+        r'Bấm like.*?',
+        r'Hãy đăng ký.*?',
+        r'Theo dõi.*?kênh.*?',
+        r'Cảm ơn.*?đã xem.*?',
+    ]
+    
+    for pattern in cta_patterns:
+        filtered_text = re.sub(pattern, '', filtered_text, flags=re.IGNORECASE)
+    
+    # 5. Loại bỏ các cụm từ thừa lặp lại
+    redundant_phrases = [
+        r'video đăng youtube',
+        r'video youtube',
+        r'kịch bản video',
+        r'trong video này',
+    ]
+    
+    for phrase in redundant_phrases:
+        filtered_text = re.sub(phrase, '', filtered_text, flags=re.IGNORECASE)
+    
+    # 6. Dọn dẹp khoảng trắng thừa và các vấn đề định dạng
+    filtered_text = re.sub(r'\n{3,}', '\n\n', filtered_text)  # Giảm nhiều dòng trống thành 2
+    filtered_text = re.sub(r' {2,}', ' ', filtered_text)      # Giảm nhiều khoảng trắng thành 1
+    filtered_text = filtered_text.strip()                     # Xóa khoảng trắng ở đầu và cuối
+    
+    # Kiểm tra nếu quá trình lọc đã loại bỏ quá nhiều nội dung
+    if len(filtered_text) < len(original_text) * 0.7:
+        print(f"Cảnh báo: Quá trình lọc đã giảm đáng kể nội dung (từ {len(original_text)} xuống {len(filtered_text)} ký tự)")
+    
+    return filtered_text
+
+
+def legacy_remove_special_characters(text):
+    """Loại bỏ hoặc thay thế các ký tự đặc biệt để giọng nói không đọc"""
+    if not text:
+        return ""
+    
+    # Lưu văn bản gốc
+    original_text = text
+    
+    # 1. Thay thế các ký tự đặc biệt bằng khoảng trắng hoặc xóa
+    replacements = {
+        # Các ký tự đặc biệt thường gây vấn đề khi đọc
+        '[': ' ',
+        ']': ' ',
+        '{': ' ',
+        '}': ' ',
+        '(': ' ',
+        ')': ' ',
+        '|': ' ',
+        '/': ' ',
+        '\\': ' ',
+        '#': ' ',
+        '@': ' ',
+        '&': ' và ',
+        '+': ' cộng ',
+        '=': ' bằng ',
+        '*': ' ',
+        '_': ' ',
+        '~': ' ',
+        '<': ' ',
+        '>': ' ',
+        '^': ' ',
+        '`': ' ',
+        '•': ' ',
+        '■': ' ',
+        '●': ' ',
+        '★': ' ',
+        '☆': ' ',
+        '♦': ' ',
+        '♣': ' ',
+        '♠': ' ',
+        '♥': ' ',
+        '→': ' ',
+        '←': ' ',
+        '↑': ' ',
+        '↓': ' ',
+    }
+    
+    # Thực hiện thay thế
+    processed_text = text
+    for char, replacement in replacements.items():
+        processed_text = processed_text.replace(char, replacement)
+    
+    # 2. Xử lý các biểu tượng cảm xúc và emoji
+    # Sử dụng regex để loại bỏ emoji
+    emoji_pattern = re.compile("["
+                               u"\U0001F600-\U0001F64F"  # emoticons
+                               u"\U0001F300-\U0001F5FF"  # symbols & pictographs
+                               u"\U0001F680-\U0001F6FF"  # transport & map symbols
+                               u"\U0001F700-\U0001F77F"  # alchemical symbols
+                               u"\U0001F780-\U0001F7FF"  # Geometric Shapes
+                               u"\U0001F800-\U0001F8FF"  # Supplemental Arrows-C
+                               u"\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
+                               u"\U0001FA00-\U0001FA6F"  # Chess Symbols
+                               u"\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
+                               u"\U00002702-\U000027B0"  # Dingbats
+                               u"\U000024C2-\U0001F251" 
+                               "]+", flags=re.UNICODE)
+    processed_text = emoji_pattern.sub(r'', processed_text)
+    
+    # 3. Xử lý các ký hiệu toán học
+    math_replacements = {
+        '÷': ' chia cho ',
+        '×': ' nhân ',
+        '≤': ' nhỏ hơn hoặc bằng ',
+        '≥': ' lớn hơn hoặc bằng ',
+        '≠': ' khác ',
+        '≈': ' xấp xỉ ',
+        '∞': ' vô cùng ',
+        '∑': ' tổng ',
+        '∏': ' tích ',
+        '√': ' căn bậc hai ',
+        '∫': ' tích phân ',
+        '∂': ' đạo hàm riêng ',
+        '∇': ' nabla ',
+        '∆': ' delta ',
+        '∈': ' thuộc ',
+        '∉': ' không thuộc ',
+        '∩': ' giao ',
+        '∪': ' hợp ',
+        '⊂': ' tập con ',
+        '⊃': ' tập cha ',
+        '⊆': ' tập con hoặc bằng ',
+        '⊇': ' tập cha hoặc bằng ',
+    }
+    
+    for char, replacement in math_replacements.items():
+        processed_text = processed_text.replace(char, replacement)
+    
+    # 4. Xử lý URL và đường dẫn web
+    # Loại bỏ hoặc đơn giản hóa URL
+    url_pattern = re.compile(r'https?://\S+|www\.\S+')
+    processed_text = url_pattern.sub(' liên kết website ', processed_text)
+    
+    # 5. Xử lý dấu ngoặc và nội dung bên trong
+    # Đã xử lý ở phần 1 bằng cách thay thế dấu ngoặc, nhưng có thể xử lý thêm nếu cần
+    
+    # 6. Xử lý nhiều dấu chấm câu lặp lại
+    processed_text = re.sub(r'\.{2,}', ' ', processed_text)  # Thay thế ... bằng khoảng trắng
+    processed_text = re.sub(r'\!{2,}', '!', processed_text)  # Thay thế !!! bằng !
+    processed_text = re.sub(r'\?{2,}', '?', processed_text)  # Thay thế ??? bằng ?
+    
+    # 7. Xử lý các ký tự Unicode đặc biệt
+    # Chuyển về dạng NFKD để tách Unicode đặc biệt
+    processed_text = unicodedata.normalize('NFKD', processed_text)
+    
+    # 8. Loại bỏ các thẻ HTML và XML nếu có
+    html_pattern = re.compile('<.*?>')
+    processed_text = html_pattern.sub(' ', processed_text)
+    
+    # 9. Dọn dẹp khoảng trắng và dấu câu thừa
+    processed_text = re.sub(r' +', ' ', processed_text)  # Thay thế nhiều khoảng trắng bằng 1 khoảng trắng
+    processed_text = processed_text.strip()
+    
+    # 10. Kiểm tra xem sau khi xử lý còn lại bao nhiêu nội dung
+    if len(processed_text) < len(original_text) * 0.5:
+        print(f"Cảnh báo: Xử lý ký tự đặc biệt đã giảm đáng kể nội dung (từ {len(original_text)} xuống {len(processed_text)} ký tự)")
+    
+    return processed_text
+
+SCRIPT_FRAGMENTS = [
+    "Tuyệt vời! Đây là kịch bản chi tiết cho video YouTube 20 phút về chủ đề này.",
+    "[tiêu đề]", "[nội dung]", "[Nhạc nền]", "[cười]", "(cười)", "(7:30-8:00)", "12:45", "Phần 2:",
+    "**Điểm chính:**", "*nhấn mạnh*", "__gạch chân__", "~~xóa~~", "`mã`", "_nghiêng_",
+    "Xin chào các bạn, hôm nay chúng ta sẽ tìm hiểu về lịch sử Việt Nam.",
+    "Đây là một câu hỏi rất thú vị!!! Bạn có biết vì sao không???",
+    "Chúng ta hãy cùng nhau khám phá... những điều bí ẩn.",
+    "Theo dõi kênh để không bỏ lỡ video mới.", "Đừng quên bấm like và đăng ký kênh nhé.",
+    "Hãy để lại bình luận bên dưới.", "Cảm ơn các bạn đã xem.", "Bấm đăng ký ngay!",
+    "Trong video này, kịch bản video youtube sẽ rất hấp dẫn.",
+    "Ref: Wikipedia", "Note: đây là ghi chú", "Sources: sách giáo khoa", "- gạch đầu dòng", "> trích dẫn",
+    "Xem thêm tại https://example.com/path?x=1 hoặc www.example.org.",
+    "Công thức: a + b = c, x × y ÷ z ≤ 10 ≥ 2 ≠ 3 ≈ 4 √9 ∞.", "A & B | C / D \\ E # F @ G",
+    "Ký hiệu: • ■ ● ★ ☆ ♦ ♣ ♠ ♥ → ← ↑ ↓ {x} <b>đậm</b> ^ ~",
+    "Cảm xúc 😀🚀🎉 và ✂ ✈.", "Dấu ba chấm unicode… và ký tự ﬁ ligature.",
+    "\n", "\n\n", "\n\n\n\n", "   ", " ",
+    # Edge cases where pass order matters
+    "\\*\\*đậm\\*\\* \\_x\\_ \\~\\~y\\~\\~ \\`z\\`", "(x [y) z]", "[a (b] c)", "1(7:30-8:00):5",
+    "Bấm lıke", "BẤM LİKE", "Sources: ſách", "kịch bản video youtube", "VIDEO YouTube", "Note\nRef: a\nSource b",
+]
+
+PROSE_SENTENCES = [
+    "Xin chào các bạn, hôm nay chúng ta sẽ cùng nhau tìm hiểu một chủ đề vô cùng thú vị.",
+    "Lịch sử của vùng đất này bắt đầu từ hàng nghìn năm trước, khi những cư dân đầu tiên đến định cư.",
+    "Điều đáng chú ý là họ đã phát triển một nền văn hóa rất riêng, gắn liền với sông nước.",
+    "Các nhà khoa học cho rằng khí hậu đã đóng vai trò quan trọng trong quá trình này.",
+    "Bạn có bao giờ tự hỏi tại sao những truyền thống ấy vẫn tồn tại đến ngày nay không?",
+    "Câu trả lời nằm ở cách mà mỗi thế hệ truyền lại kiến thức cho thế hệ tiếp theo.",
+    "Hãy tưởng tượng một ngôi làng nhỏ bên bờ sông, nơi mọi người cùng nhau làm việc và vui chơi.",
+    "Những câu chuyện cổ tích được kể bên bếp lửa mỗi tối đã nuôi dưỡng tâm hồn của trẻ em.",
+    "Tiếp theo, chúng ta sẽ khám phá những phát minh đã thay đổi cuộc sống hằng ngày.",
+    "Một ví dụ điển hình là kỹ thuật trồng lúa nước, giúp nâng cao năng suất một cách đáng kể.",
+]
+
+def make_golden_corpus(count=200, seed=1234):
+    """Deterministic corpus of script-like texts mixing every feature the cleaners handle"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        pieces = [rng.choice(SCRIPT_FRAGMENTS) for _ in range(rng.randint(1, 60))]
+        corpus.append(" ".join(pieces))
+    return corpus
+
+def make_long_script(minutes=20, words_per_minute=150, seed=42):
+    """A realistic 20-minute script (about 3000 words) for the cleaning micro-benchmark"""
+    rng = random.Random(seed)
+    parts = [SCRIPT_FRAGMENTS[0], "\n\n[tiêu đề]\nLịch sử thú vị\n\n[nội dung]\n"]
+    words = 0
+    while words < minutes * words_per_minute:
+        # Mostly plain prose, with an occasional formatting artifact
+        sentence = rng.choice(SCRIPT_FRAGMENTS if rng.random() < 0.05 else PROSE_SENTENCES)
+        parts.append(sentence + (" " if rng.random() < 0.8 else "\n\n"))
+        words += len(sentence.split())
+    return "".join(parts)
+
+def run_cleaning_pipeline(text, clean, filter_speech, remove_special):
+    return remove_special(filter_speech(clean(text)))
+
+def check_cleaning_golden(corpus):
+    """Return the corpus entries where the compiled engine differs from the reference functions"""
+    mismatches = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for text in corpus:
+            pairs = (
+                (legacy_clean_response(text), gemini_chat.clean_response(text)),
+                (legacy_filter_speech_content(text), gemini_chat.filter_speech_content(text)),
+                (legacy_remove_special_characters(text), gemini_chat.remove_special_characters(text)),
+                (run_cleaning_pipeline(text, legacy_clean_response, legacy_filter_speech_content, legacy_remove_special_characters),
+                 run_cleaning_pipeline(text, gemini_chat.clean_response, gemini_chat.filter_speech_content,
+                                       gemini_chat.remove_special_characters)),
+            )
+            if any(expected != actual for expected, actual in pairs):
+                mismatches.append(text)
+    return mismatches
+
+def bench_cleaning(repeat):
+    """Time the reference and compiled cleaning pipelines on a 20-minute script"""
+    script = make_long_script()
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, funcs in (("reference", (legacy_clean_response, legacy_filter_speech_content, legacy_remove_special_characters)),
+                            ("compiled", (gemini_chat.clean_response, gemini_chat.filter_speech_content,
+                                          gemini_chat.remove_special_characters))):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                run_cleaning_pipeline(script, *funcs)
+            results.append((name, (time.perf_counter() - start) / repeat))
+    return len(script.split()), results
+
+def legacy_add_speech_pauses(text):
+    """Thêm các khoảng dừng (...) để giọng nói tự nhiên hơn"""
+    processed_text = text
+    # Add pauses after sentences to make speech more natural
+    processed_text = re.sub(r'([.!?]) ', r'\1... ', processed_text)
+    # Add slight pauses at commas
+    processed_text = processed_text.replace(', ', ', ... ')
+    # Add pauses at line breaks, but not for multiple consecutive line breaks
+    processed_text = re.sub(r'(?<!\n)\n(?!\n)', '... ', processed_text)
+    # Remove any unnecessary multiple pauses
+    processed_text = re.sub(r'\.{3,}', '...', processed_text)
+    
+    return processed_text
+
+def legacy_split_text_into_chunks(text, max_length=200):
+    """Chia văn bản thành các phần nhỏ, cố gắng giữ nguyên câu"""
+    # Nếu văn bản ngắn hơn max_length, trả về nguyên văn
+    if len(text) <= max_length:
+        return [text]
+    
+    # Chia theo câu
+    sentences = re.split(r'(?<=[.!?])\s+', text)
+    chunks = []
+    current_chunk = ""
+    
+    for sentence in sentences:
+        # Nếu câu đơn lẻ dài hơn max_length, chia nhỏ câu
+        if len(sentence) > max_length:
+            # Chia theo dấu phẩy
+            comma_parts = sentence.split(', ')
+            for part in comma_parts:
+                if len(current_chunk) + len(part) + 2 <= max_length:  # +2 cho dấu phẩy và khoảng trắng
+                    current_chunk += part + ', '
+                else:
+                    if current_chunk:
+                        chunks.append(current_chunk.rstrip(', '))
+                    current_chunk = part + ', '
+            # Đảm bảo không bỏ sót phần cuối
+            if current_chunk:
+                chunks.append(current_chunk.rstrip(', '))
+                current_chunk = ""
+        elif len(current_chunk) + len(sentence) + 1 <= max_length:  # +1 cho khoảng trắng
+            current_chunk += sentence + ' '
+        else:
+            chunks.append(current_chunk.rstrip())
+            current_chunk = sentence + ' '
+    
+    # Thêm phần còn lại nếu có
+    if current_chunk:
+        chunks.append(current_chunk.rstrip())
+    
+    return chunks
+
+def make_run_on_script(words=3000, seed=7):
+    """A script made of very long comma-less sentences, which the legacy chunker passes through above the limit"""
+    rng = random.Random(seed)
+    vocabulary = " ".join(PROSE_SENTENCES).replace(',', '').replace('.', '').replace('?', '').split()
+    sentences = []
+    while words > 0:
+        length = rng.randint(40, 120)
+        sentences.append(" ".join(rng.choice(vocabulary) for _ in range(length)) + ".")
+        words -= length
+    return " ".join(sentences)
+
+def load_chunking_scripts(paths):
+    """Saved responses (responses/*.txt by default) plus two generated scripts, as speech text ready for TTS"""
+    scripts = [("generated 20-minute script", make_long_script()), ("long comma-less sentences", make_run_on_script())]
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            scripts.append((os.path.basename(path), f.read()))
+    with contextlib.redirect_stdout(io.StringIO()):
+        return [(name, gemini_chat.remove_special_characters(gemini_chat.filter_speech_content(gemini_chat.clean_response(text))))
+                for name, text in scripts]
+
+def bench_chunking(scripts, repeat):
+    """Chunk count, size and runtime of the legacy (pauses + greedy) and packing chunkers on each script"""
+    limit = gemini_chat.TTS_MAX_CHARS
+    chunkers = (("legacy", lambda text: legacy_split_text_into_chunks(legacy_add_speech_pauses(text), limit)),
+                ("packed", lambda text: gemini_chat.split_text_into_chunks(text, limit, pauses=True)))
+    results = []
+    for name, text in scripts:
+        for chunker_name, chunker in chunkers:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                chunks = chunker(text)
+            elapsed = (time.perf_counter() - start) / repeat
+            over = sum(1 for chunk in chunks if len(chunk) > limit)
+            fill = sum(min(len(chunk), limit) for chunk in chunks) / (len(chunks) * limit)
+            results.append((name, chunker_name, len(chunks), over, fill, elapsed))
+    return results
+
+def bench_mp3_join(chunks, frames):
+    """Join tagged chunks with plain concatenation and with the frame-aware joiner; check the duration"""
+    chunk = make_fake_mp3(frames, tagged=True)
+    expected = chunks * frames * 1152 / 44100
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in ("concatenate", "frame joiner"):
+            output_file = os.path.join(work_dir, f"{name.replace(' ', '_')}.mp3")
+            start = time.perf_counter()
+            if name == "concatenate":
+                with open(output_file, 'wb') as f:
+                    for _ in range(chunks):
+                        f.write(chunk)
+            else:
+                writer = gemini_chat.OrderedAudioWriter(output_file)
+                for index in range(chunks):
+                    writer.add(index, chunk)
+                writer.commit()
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(output_file)
+            results.append((name, elapsed, size, gemini_chat.read_mp3_duration(output_file), expected))
+    return results
+
+def bench_job_store(chunks):
+    """Record chunk progress for one job with a commit per chunk and with the default batched writes"""
+    audio = make_fake_mp3(40, tagged=True)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, flush_chunks in (("per chunk", 1), ("batched", gemini_chat.JOB_STORE_FLUSH_CHUNKS)):
+            store = gemini_chat.JobStore(os.path.join(work_dir, f"{flush_chunks}.sqlite3"), flush_chunks=flush_chunks)
+            store.start_chunks("job", [f"đoạn {index}" for index in range(chunks)])
+            start = time.perf_counter()
+            for index in range(chunks):
+                store.record_chunk("job", index, audio)
+            store.flush()
+            elapsed = time.perf_counter() - start
+            results.append((name, elapsed, store.chunk_progress("job").get('ok', 0)))
+    return results
+
+def bench_archive(records):
+    """Save `records` scripts as timestamped response files and into the archive; write time, disk use and topic lookup time"""
+    scripts = [make_long_script(seed=seed) for seed in range(8)]
+    cleaned = [gemini_chat.clean_response(script) for script in scripts]
+    topics = [f"Chủ đề thử nghiệm số {index}" for index in range(records)]
+    target = topics[records // 2]
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        text_dir = os.path.join(work_dir, "responses")
+        os.makedirs(text_dir)
+        start = time.perf_counter()
+        for index, topic in enumerate(topics):
+            path = os.path.join(text_dir, f"gemini_latest_response_{index:06d}.txt")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(gemini_chat.format_response_file(topic, scripts[index % 8], cleaned[index % 8], "2026-01-01 00:00:00"))
+        written = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for path in glob.glob(os.path.join(text_dir, "*.txt")))
+        start = time.perf_counter()
+        found = 0
+        for path in glob.glob(os.path.join(text_dir, "*.txt")):
+            with open(path, encoding='utf-8') as f:
+                f.readline()
+                found += f.readline().strip() == target
+        results.append(("text files", written, size, time.perf_counter() - start, found))
+
+        archive = gemini_chat.ResponseArchive(os.path.join(work_dir, "archive.sqlite3"))
+        start = time.perf_counter()
+        for index, topic in enumerate(topics):
+            archive.append(topic, scripts[index % 8], cleaned[index % 8], {'model': 'stub'}, 9000, {'total_s': 30.0},
+                           f"audio/{index}.mp3")
+        written = time.perf_counter() - start
+        size = sum(os.path.getsize(path) for path in glob.glob(os.path.join(work_dir, "archive.sqlite3*")))
+        start = time.perf_counter()
+        found = len(archive.find(topic=target))
+        results.append(("archive", written, size, time.perf_counter() - start, found))
+    return results
+
+SEARCH_SUBJECTS = ["Lịch sử", "Ẩm thực", "Văn hóa", "Kiến trúc", "Lễ hội", "Du lịch", "Con người", "Thiên nhiên",
+                   "Làng nghề", "Âm nhạc", "Bí ẩn", "Khám phá"]
+SEARCH_PLACES = ["Hà Nội", "Đà Lạt", "Huế", "Hội An", "Sài Gòn", "Hạ Long", "Sa Pa", "Phú Quốc", "Cần Thơ", "Đà Nẵng",
+                 "Nha Trang", "Ninh Bình", "Hà Giang", "Côn Đảo", "Mộc Châu", "Quy Nhơn", "Điện Biên", "Cà Mau",
+                 "Tây Nguyên", "Đồng Tháp"]
+
+def make_search_archive(path, records, seed=7):
+    """Archive with `records` short scripts on varied topics; returns (archive, topics, write seconds)"""
+    rng = random.Random(seed)
+    archive = gemini_chat.ResponseArchive(path)
+    topics = []
+    start = time.perf_counter()
+    for index in range(records):
+        place = rng.choice(SEARCH_PLACES)
+        topic = f"{rng.choice(SEARCH_SUBJECTS)} {place} phần {index}"
+        body = " ".join(rng.choice(PROSE_SENTENCES) for _ in range(15))
+        cleaned = (f"[tiêu đề]\n{topic}\n\n[nội dung]\n{body} Hôm nay chúng ta đến {place}, "
+                   f"nơi lưu giữ câu chuyện số {index} về {rng.choice(SEARCH_SUBJECTS).lower()} của vùng đất này.")
+        archive.append(topic, cleaned, cleaned, {'model': 'stub'})
+        topics.append(topic)
+    return archive, topics, time.perf_counter() - start
+
+def bench_archive_search(records, repeat=20):
+    """Build an archive of `records` scripts, then time full-text search and the near-duplicate topic check
+    against a linear scan that decompresses every record"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        archive, topics, written = make_search_archive(os.path.join(work_dir, "archive.sqlite3"), records)
+        target = topics[records // 2]
+        queries = [
+            ("word", "côn đảo"),
+            ("phrase", '"câu chuyện số 1234"'),
+            ("rare", f"phan {records // 2}"),
+            ("OR fallback", "xe lửa"),
+        ]
+        results = [("build", written, records)]
+        for name, query in queries:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                found = archive.search(query, 10)
+            results.append((f"search {name}", (time.perf_counter() - start) / repeat, len(found)))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            found = archive.similar_topics(target.replace("phần", "phan"), 0.75)
+        results.append(("duplicate check", (time.perf_counter() - start) / repeat, len(found)))
+
+        # Without the index: decompress and normalize every [nội dung] section
+        terms = gemini_chat.archive_terms("côn đảo")
+        start = time.perf_counter()
+        with archive._lock:
+            rows = archive._connect().execute("SELECT id, cleaned_text FROM generations").fetchall()
+        found = sum(1 for _, blob in rows
+                    if " ".join(terms) in gemini_chat.normalize_topic(
+                        gemini_chat.archive_content_text(gemini_chat.zlib.decompress(blob).decode('utf-8'))))
+        results.append(("linear scan", time.perf_counter() - start, found))
+    return results
+
+def start_stub_server(handler):
+    """Start a threaded stub server on a free local port, returns (server, base_url)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def bench_tts_concurrency(levels, sentences, latency):
+    """Measure text_to_speech_google wall time at each concurrency level"""
+    StubTTSHandler.latency = latency
+    server, base_url = start_stub_server(StubTTSHandler)
+    gemini_chat.GOOGLE_TTS_URL = f"{base_url}/translate_tts"
+    gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+    gemini_chat.TTS_CACHE_ENABLED = False
+
+    text = make_sample_text(sentences)
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            for workers in levels:
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    output_file = gemini_chat.text_to_speech_google(text, language='vi', max_workers=workers)
+                elapsed = time.perf_counter() - start
+                results.append((workers, elapsed, output_file is not None))
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+    return results
+
+def bench_http_pooling(count, latency):
+    """Per-request latency of a fresh connection per call versus the shared keep-alive session"""
+    import requests
+
+    StubTTSHandler.latency = latency
+    server, base_url = start_stub_server(StubTTSHandler)
+    url = f"{base_url}/translate_tts?q=test"
+    gemini_chat.reset_http_session()
+
+    results = []
+    try:
+        for name, get in (("no pooling", lambda: requests.get(url, timeout=10)),
+                          ("pooled", lambda: gemini_chat.get_http_session().get(url, timeout=10))):
+            samples = []
+            for _ in range(count):
+                start = time.perf_counter()
+                get().content
+                samples.append(time.perf_counter() - start)
+            samples.sort()
+            results.append((name, sum(samples) / count, samples[count // 2], samples[int(count * 0.95)]))
+    finally:
+        server.shutdown()
+    return results
+
+def bench_tts_cache(sentences, latency):
+    """Render the same script twice with the chunk cache enabled: cold run, then warm run"""
+    StubTTSHandler.latency = latency
+    server, base_url = start_stub_server(StubTTSHandler)
+    gemini_chat.GOOGLE_TTS_URL = f"{base_url}/translate_tts"
+    gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+    gemini_chat.TTS_CACHE_ENABLED = True
+
+    text = make_sample_text(sentences)
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            gemini_chat.tts_cache = gemini_chat.TTSCache(gemini_chat.TTS_CACHE_DIR, gemini_chat.TTS_CACHE_MAX_BYTES)
+            for name in ("cold", "warm"):
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    gemini_chat.text_to_speech_google(text, language='vi')
+                elapsed = time.perf_counter() - start
+                results.append((name, elapsed, gemini_chat.tts_cache.stats()))
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+        gemini_chat.TTS_CACHE_ENABLED = False
+    return results
+
+def bench_chunk_dedup(latency, workers):
+    """Render each chunking benchmark script once; requests that reach the stub versus chunks in the script"""
+    StubTTSHandler.latency = latency
+    server, base_url = start_stub_server(StubTTSHandler)
+    gemini_chat.GOOGLE_TTS_URL = f"{base_url}/translate_tts"
+    gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+    gemini_chat.TTS_CACHE_ENABLED = False
+
+    results = []
+    old_cwd = os.getcwd()
+    scripts = load_chunking_scripts([])
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            for name, text in scripts:
+                chunks = len(gemini_chat.split_text_into_chunks(text, gemini_chat.TTS_MAX_CHARS, pauses=True))
+                StubTTSHandler.requests_served = 0
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    gemini_chat.text_to_speech_google(text, language='vi', max_workers=workers)
+                results.append((name, chunks, StubTTSHandler.requests_served, time.perf_counter() - start))
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+    return results
+
+# Stand-in for mpg123: reads the stream URL (appended by ProgressivePlayer) and records when the first byte arrived
+STREAM_LISTENER = """
+import sys, time, json, urllib.request
+out_path, url = sys.argv[1], sys.argv[2]
+first, data = None, bytearray()
+with urllib.request.urlopen(url) as response:
+    while True:
+        block = response.read1(65536)
+        if not block:
+            break
+        first = first or time.time()
+        data += block
+with open(out_path + '.mp3', 'wb') as f:
+    f.write(data)
+with open(out_path, 'w') as f:
+    json.dump({'first_byte': first, 'end': time.time()}, f)
+"""
+
+def bench_progressive_playback(latency, workers):
+    """Render the generated script while a listener plays it over the local stream; time to first audio versus waiting for the file"""
+    StubTTSHandler.latency = latency
+    server, base_url = start_stub_server(StubTTSHandler)
+    gemini_chat.GOOGLE_TTS_URL = f"{base_url}/translate_tts"
+    gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+    gemini_chat.TTS_CACHE_ENABLED = False
+    players = gemini_chat.PROGRESSIVE_PLAYERS
+    stream_class = gemini_chat.AudioStream
+    streams = []
+
+    class RecordedStream(stream_class):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            streams.append(self)
+
+    gemini_chat.AudioStream = RecordedStream
+    text = load_chunking_scripts([])[0][1]
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            listener_out = os.path.join(work_dir, "listener.json")
+            gemini_chat.PROGRESSIVE_PLAYERS = ((sys.executable, '-c', STREAM_LISTENER, listener_out),)
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                output_file = gemini_chat.play_progressively(gemini_chat.text_to_speech_google, text, language='vi',
+                                                             max_workers=workers)
+            rendered = time.time() - start
+            deadline = time.time() + 30
+            while not os.path.exists(listener_out) and time.time() < deadline:
+                time.sleep(0.05)
+            with open(listener_out, 'r') as f:
+                listener = json.load(f)
+            with open(listener_out + '.mp3', 'rb') as f:
+                streamed = f.read()
+            with open(output_file, 'rb') as f:
+                audio = f.read()
+            # The file starts with the Xing/Info frame written at commit; the stream carries only the audio frames
+            info_length = gemini_chat.parse_mp3_frame_header(audio)['length']
+            matches = streamed == audio[info_length:]
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+        gemini_chat.PROGRESSIVE_PLAYERS = players
+        gemini_chat.AudioStream = stream_class
+    peak_buffered = max(stream.peak_buffered_bytes for stream in streams)
+    return rendered, listener['first_byte'] - start, listener['end'] - start, len(streamed), matches, peak_buffered
+
+def bench_tts_backends(latency):
+    """Render the generated script with google_translate and local backends: healthy stub, failing stub, then the next render"""
+    StubTTSHandler.latency = latency
+    server, base_url = start_stub_server(StubTTSHandler)
+    gemini_chat.GOOGLE_TTS_URL = f"{base_url}/translate_tts"
+    gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+    gemini_chat.TTS_CACHE_ENABLED = False
+    backends, selector, base_delay = gemini_chat.TTS_BACKENDS, gemini_chat.tts_backends, gemini_chat.TTS_RETRY_BASE_DELAY
+    gemini_chat.TTS_BACKENDS = ('google_translate', 'local')
+    gemini_chat.TTS_RETRY_BASE_DELAY = latency
+    gemini_chat.tts_backends = gemini_chat.TTSBackendSelector(gemini_chat.GoogleTranslateBackend(), gemini_chat.LocalTTSBackend())
+
+    text = load_chunking_scripts([])[0][1]
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            for name, error_rate in (("healthy", 0.0), ("failing", 1.0), ("next run", 1.0)):
+                StubTTSHandler.error_rate = error_rate
+                StubTTSHandler.error_status = 500
+                StubTTSHandler.requests_served = 0
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    gemini_chat.text_to_speech_google(text, language='vi')
+                elapsed = time.perf_counter() - start
+                with open(os.path.join("audio", "gemini_latest_speech.manifest.json"), 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                results.append((name, elapsed, manifest, StubTTSHandler.requests_served))
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+        gemini_chat.TTS_BACKENDS, gemini_chat.tts_backends, gemini_chat.TTS_RETRY_BASE_DELAY = backends, selector, base_delay
+        StubTTSHandler.error_rate = 0.0
+    return results
+
+def bench_elevenlabs_streaming(latency):
+    """Render the generated script through the ElevenLabs path against a streaming stub; requests and peak traced memory,
+    compared with Google-sized chunks and with downloading each large chunk into memory first"""
+    StubElevenLabsStreamHandler.latency = latency
+    server, base_url = start_stub_server(StubElevenLabsStreamHandler)
+    saved = (gemini_chat.ELEVENLABS_API_BASE, gemini_chat.TTS_BACKENDS, gemini_chat.tts_backends, gemini_chat.TTS_CACHE_ENABLED)
+    saved_keys = [key.value for key in gemini_chat.elevenlabs_keys.keys]
+    gemini_chat.ELEVENLABS_API_BASE = f"{base_url}/v1"
+    gemini_chat.elevenlabs_keys.load(["stub-key"])
+    gemini_chat.TTS_BACKENDS = ('elevenlabs',)
+    gemini_chat.tts_backends = gemini_chat.TTSBackendSelector(gemini_chat.ElevenLabsBackend())
+    gemini_chat.TTS_CACHE_ENABLED = False
+
+    text = load_chunking_scripts([])[0][1]
+    google_chunks = len(gemini_chat.split_text_into_chunks(text, gemini_chat.TTS_MAX_CHARS, pauses=True))
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            for name in ("buffered", "streamed"):
+                StubElevenLabsStreamHandler.requests_served = 0
+                tracemalloc.start()
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if name == "streamed":
+                        output_file = gemini_chat.text_to_speech_google(text, language='vi')
+                    else:
+                        # Each large chunk held in memory as a whole, as test_voice.py does with response.content
+                        chunks = gemini_chat.split_text_into_chunks(text, gemini_chat.ELEVENLABS_MAX_CHARS)
+                        output_file = os.path.join(work_dir, "buffered.mp3")
+                        writer = gemini_chat.OrderedAudioWriter(output_file)
+                        for index, chunk in enumerate(chunks):
+                            writer.add(index, gemini_chat.fetch_tts_chunk(chunk, 'vi'))
+                        writer.commit()
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                results.append((name, elapsed, StubElevenLabsStreamHandler.requests_served,
+                                os.path.getsize(output_file) if output_file else 0, peak))
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+        gemini_chat.ELEVENLABS_API_BASE, gemini_chat.TTS_BACKENDS, gemini_chat.tts_backends, gemini_chat.TTS_CACHE_ENABLED = saved
+        gemini_chat.elevenlabs_keys.load(saved_keys)
+    return google_chunks, results
+
+def bench_api_key_pool(requests_count, workers, capacity):
+    """Gemini requests from parallel workers against a stub with a per-key quota, for one or more keys in the pool
+
+    The pool's quota window is shortened to about the stub's one second. "no quota" turns the pool's request quota off, so keys
+    are only benched after a 429.
+    """
+    StubQuotaGeminiHandler.capacity = capacity
+    server, base_url = start_stub_server(StubQuotaGeminiHandler)
+    saved = (gemini_chat.GEMINI_API_BASE, gemini_chat.gemini_keys, gemini_chat.API_KEY_BENCH_SECONDS)
+    gemini_chat.GEMINI_API_BASE = f"{base_url}/v1beta/models/stub"
+    gemini_chat.API_KEY_BENCH_SECONDS = StubQuotaGeminiHandler.window
+    data = {"contents": [{"parts": [{"text": "benchmark"}]}], "generationConfig": {}}
+
+    def request(_):
+        # Retried like send_to_gemini, which takes a new key from the pool on every attempt
+        for _ in range(20):
+            try:
+                return gemini_chat.request_gemini_candidates("stub-key", data)
+            except requests.RequestException:
+                time.sleep(0.05)
+        return None
+
+    results = []
+    try:
+        for name, keys, quota in (("1 key", 1, capacity), ("2 keys", 2, capacity), ("4 keys", 4, capacity),
+                                  ("4 keys, no quota", 4, None)):
+            pool = gemini_chat.APIKeyPool('Gemini', quota)
+            # A little longer than the stub's window: the stub counts a request when it arrives, not when it was sent
+            pool.QUOTA_WINDOW = StubQuotaGeminiHandler.window * 1.1
+            pool.load([f"stub-key-{i}" for i in range(keys)])
+            gemini_chat.gemini_keys = pool
+            StubQuotaGeminiHandler.reset()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                answered = sum(1 for texts in executor.map(request, range(requests_count)) if texts)
+            elapsed = time.perf_counter() - start
+            results.append((name, elapsed, answered, StubQuotaGeminiHandler.quota_counts['throttled'],
+                            [key['requests'] for key in pool.stats()]))
+    finally:
+        server.shutdown()
+        gemini_chat.GEMINI_API_BASE, gemini_chat.gemini_keys, gemini_chat.API_KEY_BENCH_SECONDS = saved
+    return results
+
+def bench_chunk_retries(latency, error_rate):
+    """Render the generated script against a stub failing `error_rate` of requests with HTTP 500, without and with retries"""
+    StubTTSHandler.latency = latency
+    StubTTSHandler.error_rate = error_rate
+    StubTTSHandler.error_status = 500
+    StubTTSHandler.rng = random.Random(19)
+    server, base_url = start_stub_server(StubTTSHandler)
+    gemini_chat.GOOGLE_TTS_URL = f"{base_url}/translate_tts"
+    gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+    gemini_chat.TTS_CACHE_ENABLED = False
+    retries, base_delay = gemini_chat.TTS_CHUNK_RETRIES, gemini_chat.TTS_RETRY_BASE_DELAY
+
+    text = load_chunking_scripts([])[0][1]
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            for name, chunk_retries in (("no retries", 0), ("retries", retries)):
+                gemini_chat.TTS_CHUNK_RETRIES = chunk_retries
+                gemini_chat.TTS_RETRY_BASE_DELAY = latency
+                StubTTSHandler.requests_served = 0
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    gemini_chat.text_to_speech_google(text, language='vi')
+                elapsed = time.perf_counter() - start
+                with open(os.path.join("audio", "gemini_latest_speech.manifest.json"), 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                results.append((name, elapsed, manifest, StubTTSHandler.requests_served))
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+        gemini_chat.TTS_CHUNK_RETRIES, gemini_chat.TTS_RETRY_BASE_DELAY = retries, base_delay
+        StubTTSHandler.error_rate = 0.0
+    return results
+
+def bench_rate_limiter(sentences, latency, capacity):
+    """Render a script against a stub that throttles above `capacity` req/s, without and with the adaptive limiter"""
+    StubThrottledTTSHandler.latency = latency
+    server, base_url = start_stub_server(StubThrottledTTSHandler)
+    gemini_chat.GOOGLE_TTS_URL = f"{base_url}/translate_tts"
+    gemini_chat.TTS_CACHE_ENABLED = False
+
+    text = make_sample_text(sentences)
+    chunks = len(gemini_chat.split_text_into_chunks(text, gemini_chat.TTS_MAX_CHARS, pauses=True))
+    retries = gemini_chat.TTS_THROTTLE_RETRIES
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            # "no limiter" reproduces the old behaviour: throttled chunks are dropped
+            for name, limited in (("no limiter", False), ("adaptive", True)):
+                gemini_chat.TTS_RATE_LIMIT_ENABLED = limited
+                gemini_chat.TTS_THROTTLE_RETRIES = retries if limited else 0
+                gemini_chat.tts_rate_limiter = gemini_chat.AdaptiveRateLimiter(
+                    gemini_chat.TTS_RATE_INITIAL, gemini_chat.TTS_RATE_MIN, gemini_chat.TTS_RATE_MAX,
+                    gemini_chat.TTS_RATE_INCREASE, gemini_chat.TTS_RATE_DECREASE_FACTOR,
+                    gemini_chat.TTS_CONCURRENCY_INITIAL, gemini_chat.TTS_CONCURRENCY_MAX)
+                StubThrottledTTSHandler.reset(capacity)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    gemini_chat.text_to_speech_google(text, language='vi')
+                elapsed = time.perf_counter() - start
+                counts = dict(StubThrottledTTSHandler.counts)
+                results.append((name, elapsed, chunks, counts, gemini_chat.tts_rate_limiter.stats()))
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+        gemini_chat.TTS_THROTTLE_RETRIES = retries
+        gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+    return results
+
+def bench_lengthening(first_sentences, continuation_sentences, seconds_per_word):
+    """Short first draft: full regeneration (old behaviour) versus continuation requests"""
+    StubGeminiHandler.seconds_per_word = seconds_per_word
+    StubGeminiHandler.script = make_fake_script(first_sentences)
+    StubGeminiHandler.continuation = " ".join([SAMPLE_SENTENCE] * continuation_sentences)
+    gemini_server, gemini_url = start_stub_server(StubGeminiHandler)
+    gemini_chat.GEMINI_API_BASE = f"{gemini_url}/v1beta/models/stub"
+    gemini_chat.GEMINI_CACHE_ENABLED = False
+    continuation_enabled = gemini_chat.GEMINI_CONTINUATION_ENABLED
+
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            for name, enabled in (("regenerate", False), ("continue", True)):
+                gemini_chat.GEMINI_CONTINUATION_ENABLED = enabled
+                StubGeminiHandler.reset_counts()
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    # Only the text generation is measured here
+                    process = gemini_chat.process_gemini_response
+                    gemini_chat.process_gemini_response = lambda original, *args, **kwargs: original
+                    try:
+                        response = gemini_chat.send_to_gemini("stub-key", "benchmark")
+                    finally:
+                        gemini_chat.process_gemini_response = process
+                elapsed = time.perf_counter() - start
+                counts = dict(StubGeminiHandler.counts)
+                results.append((name, elapsed, counts['calls'], counts['words'], len(response.split())))
+    finally:
+        os.chdir(old_cwd)
+        gemini_server.shutdown()
+        gemini_chat.GEMINI_CONTINUATION_ENABLED = continuation_enabled
+        StubGeminiHandler.seconds_per_word = None
+        StubGeminiHandler.continuation = None
+    return results
+
+def bench_hedging(runs, generation_time, tail_probability, tail_time, short_probability, hedge_delay):
+    """Latency of send_to_gemini per hedging mode against a stub with slow tails and short responses"""
+    StubGeminiHandler.generation_time = generation_time
+    StubGeminiHandler.script = make_fake_script(80)
+    StubGeminiHandler.continuation = " ".join([SAMPLE_SENTENCE] * 22)
+    StubGeminiHandler.tail_probability = tail_probability
+    StubGeminiHandler.tail_time = tail_time
+    StubGeminiHandler.short_probability = short_probability
+    gemini_server, gemini_url = start_stub_server(StubGeminiHandler)
+    gemini_chat.GEMINI_API_BASE = f"{gemini_url}/v1beta/models/stub"
+    gemini_chat.GEMINI_CACHE_ENABLED = False
+    gemini_chat.GEMINI_HEDGE_DELAY = hedge_delay
+    process = gemini_chat.process_gemini_response
+
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            # Only the text generation is measured here
+            gemini_chat.process_gemini_response = lambda original, *args, **kwargs: original
+            for mode in gemini_chat.GEMINI_HEDGE_MODES:
+                gemini_chat.GEMINI_HEDGE_MODE = mode
+                gemini_chat.gemini_hedge_stats.clear()
+                StubGeminiHandler.rng = random.Random(7)
+                StubGeminiHandler.reset_counts()
+                samples = []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        gemini_chat.send_to_gemini("stub-key", "benchmark")
+                    samples.append(time.perf_counter() - start)
+                samples.sort()
+                results.append((mode, sum(samples) / runs, samples[int(runs * 0.95)], samples[-1],
+                                StubGeminiHandler.counts['calls'], dict(gemini_chat.gemini_hedge_stats)))
+    finally:
+        os.chdir(old_cwd)
+        gemini_server.shutdown()
+        gemini_chat.process_gemini_response = process
+        gemini_chat.GEMINI_HEDGE_MODE = 'off'
+        StubGeminiHandler.continuation = None
+        StubGeminiHandler.tail_probability = 0.0
+        StubGeminiHandler.short_probability = 0.0
+    return results
+
+def bench_pipeline(sentences, generation_time, workers):
+    """Compare time-to-finished-MP3 of send_to_gemini against send_to_gemini_streaming
+
+    The script has distinct sentences and the TTS cache is off, so every chunk reaches the stub. The stub TTS
+    latency is chosen so that rendering alone takes about as long as generation: sequential should then take
+    about the sum of the two, streaming about the larger one. Returns (results, tts-only seconds).
+    """
+    script = make_fake_script(sentences, distinct=True)
+    speech_text = gemini_chat.extract_content_section(script)
+    chunks = len(gemini_chat.split_text_into_chunks(speech_text, gemini_chat.TTS_MAX_CHARS, pauses=True))
+    StubTTSHandler.latency = generation_time * workers / max(1, chunks)
+    StubGeminiHandler.generation_time = generation_time
+    StubGeminiHandler.script = script
+    tts_server, tts_url = start_stub_server(StubTTSHandler)
+    gemini_server, gemini_url = start_stub_server(StubGeminiHandler)
+    gemini_chat.GOOGLE_TTS_URL = f"{tts_url}/translate_tts"
+    gemini_chat.GEMINI_API_BASE = f"{gemini_url}/v1beta/models/stub"
+    gemini_chat.GEMINI_HEDGE_MODE = 'off'
+    gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+    gemini_chat.TTS_MAX_WORKERS = workers
+    gemini_chat.TTS_CACHE_ENABLED = False
+    gemini_chat.GEMINI_CACHE_ENABLED = False
+
+    results = []
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                gemini_chat.text_to_speech_google(speech_text, language='vi', max_workers=workers)
+            tts_time = time.perf_counter() - start
+            for name, generate in (("sequential", gemini_chat.send_to_gemini),
+                                   ("streaming", gemini_chat.send_to_gemini_streaming)):
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    generate("stub-key", "benchmark", use_content_only=True)
+                elapsed = time.perf_counter() - start
+                audio_file = os.path.join("audio", "gemini_latest_speech.mp3")
+                ok = os.path.exists(audio_file) and os.path.getsize(audio_file) > 0
+                results.append((name, elapsed, ok))
+    finally:
+        os.chdir(old_cwd)
+        tts_server.shutdown()
+        gemini_server.shutdown()
+    return results, tts_time
+
+STUB_HANDLERS = {
+    'gemini': StubGeminiHandler,
+    'tts': StubTTSHandler,
+    'elevenlabs': StubElevenLabsHandler,
+}
+
+def apply_stub_settings(settings):
+    """Apply NAME.ATTR=VALUE overrides (e.g. tts.jitter=0.02, elevenlabs.payload_kb=64) to the stub handlers"""
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        name, _, attr = key.partition('.')
+        handler = STUB_HANDLERS.get(name)
+        if attr == 'payload_kb' and handler is not StubGeminiHandler and handler is not None:
+            handler.payload = make_fake_mp3(max(1, round(float(value) * 1024 / 417)), tagged=True)
+        elif attr == 'script_sentences' and handler is StubGeminiHandler:
+            handler.script = make_fake_script(int(value))
+        elif handler is not None and attr and not attr.startswith('_') and hasattr(handler, attr):
+            current = getattr(handler, attr)
+            setattr(handler, attr, int(value) if isinstance(current, int) and not isinstance(current, bool) else float(value))
+        else:
+            raise SystemExit(f"unknown stub setting: {setting}")
+
+def describe_stubs():
+    """Current stub settings, recorded in the JSON report"""
+    description = {}
+    for name, handler in STUB_HANDLERS.items():
+        entry = {'latency': handler.latency, 'jitter': handler.jitter,
+                 'error_rate': handler.error_rate, 'error_status': handler.error_status}
+        if handler is StubGeminiHandler:
+            entry.update(generation_time=handler.generation_time, script_words=len(handler.script.split()),
+                         stream_parts=handler.stream_parts)
+        else:
+            entry['payload_bytes'] = len(handler.payload)
+        description[name] = entry
+    return description
+
+def percentiles(samples):
+    """Nearest-rank percentiles of a list of seconds"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    pick = lambda q: ordered[min(len(ordered) - 1, max(0, -(-len(ordered) * q // 100) - 1))]
+    return {'min': ordered[0], 'p50': pick(50), 'p90': pick(90), 'p95': pick(95), 'p99': pick(99),
+            'max': ordered[-1], 'mean': sum(ordered) / len(ordered)}
+
+def run_e2e_scenario(runs, run_once, items_per_run=1):
+    """Call run_once(i) `runs` times; it returns the bytes of audio produced (0/None on failure)"""
+    samples = []
+    succeeded = 0
+    audio_bytes = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(runs):
+        run_start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                produced = run_once(i)
+        except Exception:
+            produced = None
+        samples.append(time.perf_counter() - run_start)
+        if produced:
+            succeeded += 1
+            audio_bytes += produced
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'runs': runs,
+        'succeeded': succeeded,
+        'failed': runs - succeeded,
+        'latency_s': {key: round(value, 4) for key, value in percentiles(samples).items()},
+        'throughput_per_s': round(runs * items_per_run / wall, 4),
+        'audio_bytes_per_s': round(audio_bytes / wall),
+        'peak_traced_memory_bytes': peak,
+        'wall_s': round(wall, 3),
+    }
+
+def file_size(path):
+    return os.path.getsize(path) if path and os.path.exists(path) else 0
+
+def run_e2e_suite(runs, batch_topics, batch_workers, rate_limit):
+    """Drive the real gemini_chat code paths against all stubs and return a JSON-serializable report"""
+    import test_voice
+
+    servers = {name: start_stub_server(handler) for name, handler in STUB_HANDLERS.items()}
+    gemini_chat.GEMINI_API_BASE = f"{servers['gemini'][1]}/v1beta/models/stub"
+    gemini_chat.GOOGLE_TTS_URL = f"{servers['tts'][1]}/translate_tts"
+    test_voice.ELEVENLABS_API_BASE = f"{servers['elevenlabs'][1]}/v1"
+    gemini_chat.TTS_CACHE_ENABLED = False
+    gemini_chat.GEMINI_CACHE_ENABLED = False
+    gemini_chat.TTS_RATE_LIMIT_ENABLED = rate_limit
+    gemini_chat.reset_http_session()
+    speech_text = make_sample_text(40)
+
+    scenarios = {}
+    old_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            audio = lambda name: os.path.join(work_dir, "audio", f"{name}.mp3")
+            scenarios['tts'] = run_e2e_scenario(runs, lambda i: file_size(
+                gemini_chat.text_to_speech_google(speech_text, output_name=f"e2e/tts_{i}")))
+            scenarios['gemini_sequential'] = run_e2e_scenario(runs, lambda i: (
+                gemini_chat.send_to_gemini("stub-key", f"chủ đề {i}", use_content_only=True,
+                                           output_name=f"e2e/sequential_{i}") and file_size(audio(f"e2e/sequential_{i}"))))
+            scenarios['gemini_streaming'] = run_e2e_scenario(runs, lambda i: (
+                gemini_chat.send_to_gemini_streaming("stub-key", f"chủ đề {i}", use_content_only=True,
+                                                     output_name=f"e2e/streaming_{i}") and file_size(audio(f"e2e/streaming_{i}"))))
+
+            def run_batch_once(i):
+                report = gemini_chat.run_batch("stub-key", [f"chủ đề {i}-{n}" for n in range(batch_topics)], batch_workers)
+                return sum(file_size(result['audio_file']) for result in report['results'] if result['status'] == 'ok')
+            scenarios['batch'] = run_e2e_scenario(runs, run_batch_once, items_per_run=batch_topics)
+            scenarios['batch'].update(topics_per_run=batch_topics, workers=batch_workers)
+
+            scenarios['elevenlabs'] = run_e2e_scenario(runs, lambda i: (
+                test_voice.test_elevenlabs("stub-key") and file_size(os.path.join("audio", "test_voice.mp3"))))
+    finally:
+        os.chdir(old_cwd)
+        for server, _ in servers.values():
+            server.shutdown()
+        gemini_chat.TTS_RATE_LIMIT_ENABLED = False
+
+    try:
+        import resource
+        max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        max_rss_kb = None
+    return {
+        'suite': 'e2e',
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'runs': runs,
+            'tts_max_workers': gemini_chat.TTS_MAX_WORKERS,
+            'tts_rate_limit': rate_limit,
+            'caches': False,
+        },
+        'stubs': describe_stubs(),
+        'scenarios': scenarios,
+        'max_rss_kb': max_rss_kb,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sentences', type=int, default=40, help="number of sample sentences in the script")
+    parser.add_argument('--latency', type=float, default=0.05, help="stub TTS latency per request (seconds)")
+    parser.add_argument('--capacity', type=float, default=8.0, help="requests per second the throttling stub accepts before returning 429")
+    parser.add_argument('--levels', default="1,2,4,8,16", help="comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=200, help="requests for the HTTP pooling benchmark")
+    parser.add_argument('--clean-repeat', type=int, default=50, help="runs of the cleaning micro-benchmark")
+    parser.add_argument('--generation-time', type=float, default=1.0, help="stub Gemini generation time (seconds)")
+    parser.add_argument('--script-sentences', type=int, default=80, help="sentences in the stub Gemini script (80 is above the 1500-word retry threshold)")
+    parser.add_argument('--seconds-per-word', type=float, default=0.001, help="stub Gemini generation time per word for the lengthening benchmark")
+    parser.add_argument('--error-rate', type=float, default=0.1, help="stub TTS failure rate for the chunk retry benchmark")
+    parser.add_argument('--hedge-runs', type=int, default=40, help="requests per mode in the hedging benchmark")
+    parser.add_argument('--tail-time', type=float, default=3.0, help="extra stub Gemini latency for slow-tail requests (seconds)")
+    parser.add_argument('--hedge-delay', type=float, default=1.5, help="GEMINI_HEDGE_DELAY for the hedging benchmark")
+    parser.add_argument('--scripts', nargs='*', default=sorted(glob.glob(os.path.join('responses', '*.txt'))),
+                        help="saved scripts for the chunker benchmark (default: responses/*.txt)")
+    parser.add_argument('--key-requests', type=int, default=48, help="Gemini requests in the API key pool benchmark")
+    parser.add_argument('--key-capacity', type=int, default=4, help="requests per second the quota stub accepts for each key")
+    parser.add_argument('--archive-records', type=int, default=2000, help="generations in the archive benchmark")
+    parser.add_argument('--search-records', type=int, default=20000, help="generations in the archive search benchmark")
+    parser.add_argument('--store-chunks', type=int, default=2000, help="chunk results in the job store benchmark")
+    parser.add_argument('--join-chunks', type=int, default=500, help="chunks in the MP3 join benchmark")
+    parser.add_argument('--workers', type=int, default=gemini_chat.TTS_MAX_WORKERS, help="TTS workers for the pipeline benchmark")
+    parser.add_argument('--e2e', action='store_true', help="run only the end-to-end suite and write a JSON report")
+    parser.add_argument('--runs', type=int, default=5, help="runs per end-to-end scenario")
+    parser.add_argument('--batch-topics', type=int, default=4, help="topics per batch run in the end-to-end suite")
+    parser.add_argument('--batch-workers', type=int, default=2, help="batch workers in the end-to-end suite")
+    parser.add_argument('--rate-limit', action='store_true', help="keep the adaptive TTS rate limiter on in the end-to-end suite")
+    parser.add_argument('--stub', action='append', default=[], metavar='NAME.ATTR=VALUE',
+                        help="stub setting for the end-to-end suite, e.g. tts.jitter=0.02, tts.error_rate=0.01, "
+                             "gemini.generation_time=2, elevenlabs.payload_kb=64 (repeatable)")
+    parser.add_argument('--json', default='-', metavar='PATH', help="where to write the end-to-end report (default: stdout)")
+    args = parser.parse_args()
+    # The stub servers have no per-key quota
+    gemini_chat.gemini_keys.requests_per_minute = None
+    # Benchmarks repeat the same topics on purpose: never reuse (or ask about) earlier archived scripts
+    gemini_chat.ARCHIVE_DUPLICATE_CHECK = 'off'
+
+    if args.e2e:
+        StubGeminiHandler.generation_time = args.generation_time
+        StubGeminiHandler.script = make_fake_script(args.script_sentences)
+        StubTTSHandler.latency = args.latency
+        apply_stub_settings(args.stub)
+        report = json.dumps(run_e2e_suite(args.runs, args.batch_topics, args.batch_workers, args.rate_limit),
+                            ensure_ascii=False, indent=2)
+        if args.json == '-':
+            print(report)
+        else:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                f.write(report + "\n")
+            print(f"End-to-end report written to {args.json}")
+        return 0
+
+    corpus = make_golden_corpus()
+    mismatches = check_cleaning_golden(corpus)
+    print(f"Cleaning golden corpus: {len(corpus) - len(mismatches)}/{len(corpus)} identical to the reference")
+    for text in mismatches[:3]:
+        print(f"  mismatch: {text[:120]!r}")
+    words, results = bench_cleaning(args.clean_repeat)
+    print(f"Cleaning micro-benchmark: {words}-word script, {args.clean_repeat} runs")
+    print(f"{'engine':>10} {'per script (ms)':>16} {'speedup':>8}")
+    for name, elapsed in results:
+        print(f"{name:>10} {elapsed * 1000:>16.2f} {results[0][1] / elapsed:>7.1f}x")
+    print()
+
+    print(f"TTS chunker benchmark: limit {gemini_chat.TTS_MAX_CHARS} characters, {args.clean_repeat} runs")
+    print(f"{'script':>28} {'chunker':>8} {'chunks':>7} {'over limit':>11} {'fill':>6} {'ms':>7}")
+    for name, chunker, count, over, fill, elapsed in bench_chunking(load_chunking_scripts(args.scripts), args.clean_repeat):
+        print(f"{name[:28]:>28} {chunker:>8} {count:>7} {over:>11} {fill:>6.0%} {elapsed * 1000:>7.2f}")
+    print()
+
+    print(f"Archive benchmark: {args.archive_records} generations of a 20-minute script")
+    print(f"{'storage':>10} {'write (s)':>10} {'disk (MB)':>10} {'topic lookup (ms)':>18} {'found':>6}")
+    for name, written, size, lookup, found in bench_archive(args.archive_records):
+        print(f"{name:>10} {written:>10.2f} {size / 1e6:>10.1f} {lookup * 1000:>18.2f} {found:>6}")
+    print()
+
+    print(f"Archive search benchmark: {args.search_records} scripts")
+    print(f"{'query':>16} {'time (ms)':>10} {'results':>8}")
+    for name, elapsed, found in bench_archive_search(args.search_records):
+        print(f"{name:>16} {elapsed * 1000:>10.2f} {found:>8}")
+    print()
+
+    print(f"Job store benchmark: {args.store_chunks} chunk results of {len(make_fake_mp3(40, tagged=True))} bytes")
+    print(f"{'writes':>10} {'total (ms)':>11} {'per chunk (ms)':>15} {'saved':>6}")
+    for name, elapsed, saved in bench_job_store(args.store_chunks):
+        print(f"{name:>10} {elapsed * 1000:>11.1f} {elapsed * 1000 / args.store_chunks:>15.3f} {saved:>6}")
+    print()
+
+    print(f"MP3 join benchmark: {args.join_chunks} tagged chunks of 20 frames")
+    print(f"{'method':>14} {'time (ms)':>10} {'MB/s':>7} {'reported (s)':>13} {'actual (s)':>11}")
+    for name, elapsed, size, reported, expected in bench_mp3_join(args.join_chunks, 20):
+        # Plain concatenation: the first chunk's Info frame claims the whole file is one chunk long
+        print(f"{name:>14} {elapsed * 1000:>10.1f} {size / elapsed / 1e6:>7.0f} {reported:>13.1f} {expected:>11.1f}")
+    print()
+
+    levels = [int(level) for level in args.levels.split(',')]
+    print(f"TTS concurrency benchmark: {args.sentences} sentences, latency {args.latency}s, rate limiter off")
+    print(f"{'workers':>8} {'wall time (s)':>14} {'speedup':>8}")
+    results = bench_tts_concurrency(levels, args.sentences, args.latency)
+    baseline = results[0][1]
+    for workers, elapsed, ok in results:
+        status = "" if ok else "  (FAILED)"
+        print(f"{workers:>8} {elapsed:>14.2f} {baseline / elapsed:>7.1f}x{status}")
+
+    print()
+    print(f"HTTP pooling benchmark: {args.requests} requests, latency {args.latency}s")
+    print(f"{'mode':>12} {'mean (ms)':>10} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    for name, mean, p50, p95 in bench_http_pooling(args.requests, args.latency):
+        print(f"{name:>12} {mean * 1000:>10.2f} {p50 * 1000:>9.2f} {p95 * 1000:>9.2f}")
+
+    print()
+    print("TTS cache benchmark")
+    print(f"{'run':>8} {'wall time (s)':>14} {'hits':>6} {'misses':>7}")
+    for name, elapsed, stats in bench_tts_cache(args.sentences, args.latency):
+        print(f"{name:>8} {elapsed:>14.2f} {stats['hits']:>6} {stats['misses']:>7}")
+
+    print()
+    print(f"Chunk dedup benchmark: latency {args.latency}s, {args.workers} workers, cache off")
+    print(f"{'script':>28} {'chunks':>7} {'requests':>9} {'saved':>6} {'wall time (s)':>14}")
+    for name, chunks, requests_served, elapsed in bench_chunk_dedup(args.latency, args.workers):
+        print(f"{name[:28]:>28} {chunks:>7} {requests_served:>9} {chunks - requests_served:>6} {elapsed:>14.2f}")
+
+    print()
+    print(f"Progressive playback benchmark: latency {args.latency}s, {args.workers} workers, listener over the local stream")
+    rendered, first_audio, stream_end, streamed, matches, peak_buffered = bench_progressive_playback(args.latency,
+                                                                                                     args.workers)
+    print(f"{'time to first audio (s)':>24} {'file ready (s)':>15} {'stream ended (s)':>17} {'bytes':>8} "
+          f"{'peak buffered':>14} {'matches file':>13}")
+    print(f"{first_audio:>24.2f} {rendered:>15.2f} {stream_end:>17.2f} {streamed:>8} {peak_buffered:>14} "
+          f"{str(matches):>13}")
+
+    print()
+    print(f"Chunk retry benchmark: stub fails {args.error_rate:.0%} of requests with HTTP 500")
+    print(f"{'mode':>12} {'wall time (s)':>14} {'chunks ok':>10} {'requests':>9} {'retries':>8} {'result':>9}")
+    for name, elapsed, manifest, requests_served in bench_chunk_retries(args.latency, args.error_rate):
+        print(f"{name:>12} {elapsed:>14.2f} {manifest['ok']:>5}/{manifest['chunks']:<4} {requests_served:>9} "
+              f"{manifest['retries']['used']:>8} {manifest['status']:>9}")
+
+    print()
+    print(f"TTS backend benchmark: google_translate stub (latency {args.latency}s) with local failover")
+    print(f"{'run':>10} {'wall time (s)':>14} {'chunks':>7} {'stub requests':>14} {'result':>9}  backends")
+    for name, elapsed, manifest, requests_served in bench_tts_backends(args.latency):
+        backends = ', '.join(f"{backend} {count}" for backend, count in manifest['backends'].items())
+        print(f"{name:>10} {elapsed:>14.2f} {manifest['chunks']:>7} {requests_served:>14} {manifest['status']:>9}  {backends}")
+
+    print()
+    google_chunks, results = bench_elevenlabs_streaming(args.latency)
+    print(f"ElevenLabs benchmark: streaming stub, {gemini_chat.ELEVENLABS_MAX_CHARS}-character chunks "
+          f"({google_chunks} chunks at the Google limit)")
+    print(f"{'download':>10} {'wall time (s)':>14} {'requests':>9} {'file (KB)':>10} {'peak memory (KB)':>17}")
+    for name, elapsed, requests_served, size, peak in results:
+        print(f"{name:>10} {elapsed:>14.2f} {requests_served:>9} {size // 1024:>10} {peak // 1024:>17}")
+
+    print()
+    print(f"API key pool benchmark: {args.key_requests} Gemini requests from 8 workers, "
+          f"stub accepts {args.key_capacity} req/s per key")
+    print(f"{'keys':>16} {'wall time (s)':>14} {'answered':>9} {'429s':>6} {'requests per key':>17}")
+    for name, elapsed, answered, throttled, per_key in bench_api_key_pool(args.key_requests, 8, args.key_capacity):
+        print(f"{name:>16} {elapsed:>14.2f} {answered:>9} {throttled:>6} {'/'.join(map(str, per_key)):>17}")
+
+    print()
+    print(f"Rate limiter benchmark: {args.sentences} sentences, stub accepts {args.capacity} req/s")
+    print(f"{'mode':>12} {'wall time (s)':>14} {'chunks ok':>10} {'429s':>6} {'final rate':>11}")
+    for name, elapsed, chunks, counts, stats in bench_rate_limiter(args.sentences, args.latency, args.capacity):
+        rate = f"{stats['rate']}/s" if name == "adaptive" else "-"
+        delivered = f"{counts['ok']}/{chunks}"
+        print(f"{name:>12} {elapsed:>14.2f} {delivered:>10} {counts['throttled']:>6} {rate:>11}")
+
+    print()
+    print("Lengthening benchmark: 1000-word first draft, 1500-word target")
+    print(f"{'mode':>12} {'time (s)':>9} {'calls':>6} {'words generated':>16} {'final words':>12}")
+    for name, elapsed, calls, words, final_words in bench_lengthening(43, 22, args.seconds_per_word):
+        print(f"{name:>12} {elapsed:>9.2f} {calls:>6} {words:>16} {final_words:>12}")
+
+    print()
+    print(f"Hedging benchmark: {args.hedge_runs} runs, generation {args.generation_time}s, "
+          f"20% of requests +{args.tail_time}s, 20% short candidates, hedge delay {args.hedge_delay}s")
+    print(f"{'mode':>12} {'mean (s)':>9} {'p95 (s)':>8} {'max (s)':>8} {'calls':>6}  winners")
+    for mode, mean, p95, worst, calls, winners in bench_hedging(args.hedge_runs, args.generation_time, 0.2,
+                                                                args.tail_time, 0.2, args.hedge_delay):
+        print(f"{mode:>12} {mean:>9.2f} {p95:>8.2f} {worst:>8.2f} {calls:>6}  {winners or ''}")
+
+    print()
+    results, tts_time = bench_pipeline(args.script_sentences, args.generation_time, args.workers)
+    print(f"Pipeline benchmark: generation {args.generation_time}s, TTS alone {tts_time:.2f}s, {args.workers} TTS workers")
+    print(f"{'mode':>12} {'time to MP3 (s)':>16}")
+    for name, elapsed, ok in results:
+        status = "" if ok else "  (FAILED)"
+        print(f"{name:>12} {elapsed:>16.2f}{status}")
+    longest = max(args.generation_time, tts_time)
+    overlap = args.generation_time + tts_time - longest
+    streaming = dict((name, elapsed) for name, elapsed, _ in results)["streaming"]
+    print(f"sum {args.generation_time + tts_time:.2f}s, max {longest:.2f}s: streaming is "
+          f"{'near the max' if streaming <= longest + overlap / 2 else 'NOT near the max'}")
+    assert streaming <= longest + overlap / 2, "streaming pipeline did not overlap generation with TTS"
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,35 @@ import time
 import urllib.parse  # Thêm thư viện urllib.parse để mã hóa text trong URL
 import unicodedata
 import platform
+import hashlib
+import struct
+import email.utils
+import io
+import threading
+import argparse
+import csv
+import glob
+import contextlib
+import contextvars
+import functools
+import itertools
+import math
+import random
+import signal
+import socket
+import socketserver
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+# Phiên HTTP dùng chung (HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE) và cấu hình ElevenLabs nằm trong api_common
+from api_common import (get_http_session, reset_http_session, ELEVENLABS_API_BASE, ELEVENLABS_VOICE_ID,
+                        ELEVENLABS_MODEL_ID, ELEVENLABS_VOICE_SETTINGS, ELEVENLABS_OUTPUT_FORMAT)
 
 # ANSI color codes for colored terminal text
 class Colors:
@@ -33,6 +62,905 @@ except ImportError:
     GTTS_AVAILABLE = False
     print(f"{Colors.RED}Thư viện gTTS chưa được cài đặt. Cài đặt bằng lệnh: pip install gtts{Colors.ENDC}")
 
+# Ghi vết thời gian từng bước (định dạng Chrome trace, mở bằng chrome://tracing hoặc Perfetto)
+TRACE_ENABLED = True
+TRACE_DIR = "traces"
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def topic_slug(topic, max_chars=60):
+    """Chủ đề không dấu, chỉ gồm chữ thường, số và dấu gạch ngang, dùng cho tên file"""
+    return re.sub(r'[^a-z0-9]+', '-', normalize_topic(topic)).strip('-')[:max_chars].rstrip('-')
+
+class RunTrace:
+    """Thu thập các span của một lần tạo kịch bản và ghi ra file JSON theo định dạng Chrome trace"""
+    
+    def __init__(self, topic):
+        self.topic = topic
+        self.started_at = datetime.datetime.now()
+        self.events = []
+        self._origin = time.perf_counter()
+        self._threads = {}
+        self._lock = threading.Lock()
+    
+    def add(self, name, category, start, duration, args):
+        thread = threading.current_thread()
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': round((start - self._origin) * 1e6, 1),
+                'dur': round(duration * 1e6, 1),
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': args,
+            })
+    
+    def summary(self):
+        """Số lần, tổng thời gian (ms), tổng bytes và số lần thử lại theo tên span"""
+        totals = {}
+        with self._lock:
+            for event in self.events:
+                entry = totals.setdefault(event['name'], {'count': 0, 'total_ms': 0.0, 'bytes': 0, 'retries': 0})
+                entry['count'] += 1
+                entry['total_ms'] = round(entry['total_ms'] + event['dur'] / 1000, 3)
+                entry['bytes'] += event['args'].get('bytes', 0) or 0
+                entry['retries'] += event['args'].get('retries', 0) or 0
+        return totals
+    
+    def save(self, trace_dir=None):
+        """Ghi trace vào TRACE_DIR, trả về đường dẫn file hoặc None nếu lỗi"""
+        trace_dir = trace_dir or TRACE_DIR
+        filename = f"trace_{self.started_at.strftime('%Y%m%d_%H%M%S_%f')}_{topic_slug(self.topic) or 'run'}.json"
+        path = os.path.join(trace_dir, filename)
+        with self._lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name}}
+                        for ident, name in self._threads.items()]
+            events = metadata + list(self.events)
+        trace = {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'topic': self.topic,
+                'started_at': self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+                'summary': self.summary(),
+            },
+        }
+        try:
+            os.makedirs(trace_dir, exist_ok=True)
+            write_file_atomically(path, json.dumps(trace, ensure_ascii=False).encode('utf-8'))
+            return path
+        except OSError as e:
+            print(f"Cảnh báo: Không thể ghi trace: {str(e)}")
+            return None
+
+@contextlib.contextmanager
+def trace_span(name, category='pipeline', **args):
+    """Đo thời gian một bước trong trace hiện tại; có thể ghi thêm thông tin vào dict được trả về"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield {}
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = str(e) or type(e).__name__
+        raise
+    finally:
+        trace.add(name, category, start, time.perf_counter() - start, args)
+
+def traced_stage(category):
+    """Decorator: ghi span cho một bước xử lý văn bản, kèm số ký tự vào/ra hoặc số đoạn"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(text, *args, **kwargs):
+            if _current_trace.get() is None:
+                return func(text, *args, **kwargs)
+            with trace_span(func.__name__, category, chars_in=len(text or '')) as span:
+                result = func(text, *args, **kwargs)
+                if isinstance(result, list):
+                    span['chunks'] = len(result)
+                else:
+                    span['chars_out'] = len(result or '')
+                return result
+        return wrapper
+    return decorator
+
+def traced_run(func):
+    """Decorator: mỗi lần tạo kịch bản (theo chủ đề) ghi một file trace; lời gọi lồng nhau dùng chung trace"""
+    @functools.wraps(func)
+    def wrapper(api_key, prompt, *args, **kwargs):
+        if not TRACE_ENABLED or _current_trace.get() is not None:
+            return func(api_key, prompt, *args, **kwargs)
+        trace = RunTrace(prompt)
+        token = _current_trace.set(trace)
+        try:
+            with trace_span(func.__name__, 'run', topic=prompt):
+                return func(api_key, prompt, *args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+            trace_file = trace.save()
+            if trace_file:
+                print(f"Đã ghi trace thời gian: {trace_file}")
+    return wrapper
+
+def submit_traced(executor, fn, *args):
+    """executor.submit giữ nguyên trace hiện tại trong luồng worker"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+# Cấu hình Gemini API
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash"
+DEFAULT_GENERATION_CONFIG = {
+    "temperature": 0.8,
+    "topK": 40,
+    "topP": 0.95,
+    "maxOutputTokens": 32768  # Tăng lên mức tối đa có thể để có nội dung dài hơn
+}
+# Mẫu prompt kịch bản YouTube, nhấn mạnh chỉ trả về lời thoại
+SCRIPT_PROMPT_TEMPLATE = """Tạo kịch bản chi tiết và đầy đủ cho video YouTube dài 20 phút với chủ đề: {topic}.
+
+Kịch bản phải thực sự dài, đầy đủ thông tin, và đủ nội dung để nói trong 20 phút. Kịch bản nên có độ dài ít nhất 2000-3000 từ.
+
+Yêu cầu bắt buộc:
+1. Sử dụng định dạng [tiêu đề] và [nội dung]
+2. [nội dung] PHẢI dài và chi tiết, đủ để nói trong 20 phút
+3. CHỈ bao gồm lời thoại của một người, KHÔNG có hướng dẫn quay phim, mô tả cảnh, chú thích hay ghi chú kỹ thuật
+4. Nội dung PHẢI được triển khai đầy đủ, có phần giới thiệu, thân bài với nhiều điểm và ví dụ, và phần kết luận
+5. Viết hoàn toàn bằng tiếng Việt, tập trung vào nội dung chất lượng cao
+
+QUAN TRỌNG: ĐỪNG rút gọn hoặc tóm tắt. Kịch bản phải đủ dài cho video 20 phút."""
+
+# Kéo dài kịch bản ngắn bằng cách yêu cầu viết tiếp (hội thoại nhiều lượt) thay vì tạo lại toàn bộ
+GEMINI_CONTINUATION_ENABLED = True
+GEMINI_TARGET_WORDS = 1500       # Số từ tối thiểu cho video 20 phút
+GEMINI_MAX_CONTINUATIONS = 3     # Số lần viết tiếp tối đa
+GEMINI_TOKENS_PER_WORD = 2.5     # Ước tính token đầu ra cho mỗi từ tiếng Việt (có dư), để giới hạn maxOutputTokens
+GEMINI_CONTINUATION_PROMPT = """Kịch bản trên chưa đủ dài. Hãy viết tiếp ngay từ chỗ vừa dừng, thêm khoảng {missing_words} từ nữa.
+Không lặp lại nội dung đã viết, không viết lại tiêu đề hay các thẻ [tiêu đề]/[nội dung], không chào lại khán giả.
+Chỉ trả về phần viết tiếp, hoàn toàn bằng tiếng Việt."""
+
+# Yêu cầu dự phòng (hedging) để giảm độ trễ đuôi khi phản hồi chậm hoặc không hợp lệ
+GEMINI_HEDGE_MODES = ('off', 'delay', 'candidates', 'parallel')
+GEMINI_HEDGE_MODE = 'off'        # 'delay': gửi thêm yêu cầu sau GEMINI_HEDGE_DELAY giây; 'candidates': candidateCount; 'parallel': nhiều yêu cầu song song
+GEMINI_HEDGE_DELAY = 20.0
+GEMINI_HEDGE_CANDIDATES = 2
+GEMINI_HEDGE_LOG = os.path.join("cache", "gemini_hedge.jsonl")  # Ghi chiến lược thắng của mỗi lần để tinh chỉnh cấu hình
+
+STREAM_SEGMENT_MIN_CHARS = 400  # Gom tối thiểu bấy nhiêu ký tự câu hoàn chỉnh trước khi gửi sang TTS
+
+# Cấu hình Google Translate TTS
+GOOGLE_TTS_URL = "https://translate.google.com/translate_tts"
+TTS_HEADERS = {
+    # Thêm User-Agent để tránh bị chặn
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Referer': 'https://translate.google.com/'
+}
+TTS_MAX_CHARS = 200        # Google Translate TTS giới hạn khoảng 200 ký tự mỗi yêu cầu
+TTS_CHUNK_MIN_FILL = 0.8   # Chỉ ngắt ở cuối câu/dấu phẩy khi đoạn đã đầy ít nhất 80%, nếu không thì ngắt giữa hai từ
+TTS_MAX_WORKERS = 8        # Số luồng tải tối đa; số yêu cầu thực sự đồng thời do bộ giới hạn tốc độ điều chỉnh
+TTS_REQUEST_TIMEOUT = 30
+
+# Các backend TTS (xem TTSBackend). Backend có độ trễ và tỉ lệ thành công gần đây tốt nhất được dùng trước;
+# backend chưa đủ số liệu xếp sau theo thứ tự dưới đây. Một đoạn lỗi chuyển sang backend tiếp theo.
+TTS_BACKENDS = ('google_translate', 'elevenlabs', 'gtts')  # Thêm 'local' để chạy thử không cần mạng (âm thanh im lặng)
+TTS_BACKEND_WINDOW = 50          # Số lần gọi gần nhất của mỗi backend được dùng để xếp hạng
+TTS_BACKEND_MIN_SAMPLES = 3
+GTTS_MAX_CHARS = 1000            # gTTS tự chia nhỏ văn bản thành nhiều yêu cầu
+GTTS_MAX_CONCURRENCY = 2
+ELEVENLABS_MAX_CHARS = 9500      # eleven_multilingual_v2 nhận tối đa 10.000 ký tự mỗi yêu cầu: kịch bản 20 phút chỉ cần vài yêu cầu
+ELEVENLABS_MAX_CONCURRENCY = 2   # Số yêu cầu đồng thời mỗi khóa (gói miễn phí cho phép 2)
+ELEVENLABS_REQUEST_TIMEOUT = 120 # Thời gian chờ tối đa giữa hai lần nhận dữ liệu (giây)
+ELEVENLABS_STREAM_BLOCK_BYTES = 64 * 1024
+ELEVENLABS_SPOOL_MEMORY_BYTES = 1024 * 1024  # Mỗi đoạn đang chờ ghi giữ tối đa 1 MB trong bộ nhớ, phần còn lại ở file tạm
+LOCAL_TTS_MAX_CHARS = 5000
+LOCAL_TTS_SECONDS_PER_CHAR = 0.06  # Độ dài âm thanh im lặng do backend 'local' tạo
+
+# Bộ giới hạn tốc độ thích ứng (token bucket + AIMD), dùng chung cho mọi yêu cầu TTS trong tiến trình
+TTS_RATE_LIMIT_ENABLED = True
+TTS_RATE_INITIAL = 4.0           # Số yêu cầu mỗi giây lúc bắt đầu
+TTS_RATE_MIN = 0.5
+TTS_RATE_MAX = 20.0
+TTS_RATE_INCREASE = 1.0          # Tăng cộng: khoảng +1 yêu cầu/giây sau mỗi giây liên tục thành công
+TTS_RATE_DECREASE_FACTOR = 0.5   # Giảm nhân khi bị giới hạn (429/503)
+TTS_CONCURRENCY_INITIAL = 4
+TTS_CONCURRENCY_MAX = 16
+TTS_THROTTLE_STATUS_CODES = (429, 503)
+TTS_THROTTLE_RETRIES = 3         # Số lần thử lại một đoạn bị giới hạn thay vì bỏ qua
+TTS_RETRY_AFTER_MAX = 60         # Thời gian chờ Retry-After tối đa được chấp nhận (giây)
+
+# Thử lại từng đoạn khi gặp lỗi tạm thời (5xx, lỗi mạng, phản hồi rỗng), backoff lũy thừa có jitter
+TTS_CHUNK_RETRIES = 3            # Số lần thử lại tối đa cho một đoạn
+TTS_RETRY_BASE_DELAY = 0.5       # Lần thử lại thứ n chờ ngẫu nhiên 0..min(TTS_RETRY_MAX_DELAY, 0.5 * 2^n) giây
+TTS_RETRY_MAX_DELAY = 8.0
+TTS_RETRY_BUDGET_RATIO = 0.25    # Tổng số lần thử lại của một lần tạo âm thanh: 25% số đoạn...
+TTS_RETRY_BUDGET_MIN = 5         # ...nhưng ít nhất 5 lần
+TTS_MAX_MISSING_RATIO = 0.02     # Chấp nhận file thiếu tối đa 2% số đoạn (có cảnh báo); thiếu nhiều hơn thì hủy
+
+def parse_retry_after(value):
+    """Đọc header Retry-After (số giây hoặc ngày HTTP), trả về số giây hoặc None"""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at is None:
+            return None
+        seconds = retry_at.timestamp() - time.time()
+    return min(max(0.0, seconds), TTS_RETRY_AFTER_MAX)
+
+class AdaptiveRateLimiter:
+    """Token bucket với tốc độ và số yêu cầu đồng thời thích ứng kiểu AIMD
+    
+    Mỗi lần thành công tăng tốc độ thêm khoảng increase yêu cầu/giây sau mỗi giây và nới giới hạn
+    đồng thời; mỗi lần bị giới hạn giảm cả hai theo decrease_factor (tối đa một lần mỗi giây để
+    các phản hồi 429 đến cùng lúc không bị tính nhiều lần) và tạm dừng theo Retry-After.
+    """
+    
+    def __init__(self, initial_rate, min_rate, max_rate, increase, decrease_factor,
+                 initial_concurrency, max_concurrency):
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.concurrency = float(initial_concurrency)
+        self.max_concurrency = max_concurrency
+        self.successes = 0
+        self.throttled = 0
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+    
+    def _refill(self, now):
+        # Dung lượng bucket bằng giới hạn đồng thời để không dồn quá nhiều yêu cầu cùng lúc
+        self._tokens = min(max(1.0, self.concurrency), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def acquire(self):
+        """Chờ đến khi có token và còn chỗ cho một yêu cầu đồng thời"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    timeout = self._paused_until - now
+                elif self._in_flight >= int(self.concurrency):
+                    timeout = None
+                elif self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    self._in_flight += 1
+                    return
+                else:
+                    timeout = (1.0 - self._tokens) / self.rate
+                self._condition.wait(timeout)
+    
+    def release(self, outcome='ok', retry_after=None):
+        """Kết thúc một yêu cầu: outcome là 'ok', 'throttled' hoặc 'error' (lỗi mạng, không điều chỉnh)"""
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            self._refill(now)
+            if outcome == 'ok':
+                self.successes += 1
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            elif outcome == 'throttled':
+                self.throttled += 1
+                if now - self._last_decrease >= 1.0:
+                    self._last_decrease = now
+                    self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                    self.concurrency = max(1.0, self.concurrency * self.decrease_factor)
+                    self._tokens = 0.0
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            self._condition.notify_all()
+    
+    def stats(self):
+        """Tốc độ hiện tại (yêu cầu/giây), giới hạn đồng thời và số lần thành công/bị giới hạn"""
+        with self._condition:
+            return {
+                'rate': round(self.rate, 2),
+                'concurrency': int(self.concurrency),
+                'in_flight': self._in_flight,
+                'successes': self.successes,
+                'throttled': self.throttled,
+            }
+
+tts_rate_limiter = AdaptiveRateLimiter(TTS_RATE_INITIAL, TTS_RATE_MIN, TTS_RATE_MAX, TTS_RATE_INCREASE,
+                                       TTS_RATE_DECREASE_FACTOR, TTS_CONCURRENCY_INITIAL, TTS_CONCURRENCY_MAX)
+
+# Nhóm khóa API: mỗi dòng API: (Gemini) hoặc ELEVENLABS: trong APIvsCURL.txt thêm một khóa vào nhóm tương ứng,
+# nên tổng số yêu cầu và token mỗi phút tăng theo số khóa
+API_KEY_SELECTIONS = ('least_loaded', 'round_robin')
+API_KEY_SELECTION = 'least_loaded'   # 'least_loaded': khóa ít yêu cầu đang chạy và ít dùng nhất trong phút vừa qua
+API_KEY_BENCH_SECONDS = 60           # Tạm ngưng khóa bị giới hạn (429) nếu phản hồi không có Retry-After
+API_KEY_REJECT_BENCH_SECONDS = 3600  # Tạm ngưng khóa bị từ chối (hết hạn mức hoặc khóa sai)
+API_KEY_REJECT_STATUS_CODES = (401, 403)  # ElevenLabs trả 401 quota_exceeded khi hết ký tự
+GEMINI_KEY_REQUESTS_PER_MINUTE = 15  # Hạn mức mỗi khóa (gói miễn phí gemini-2.0-flash); None để bỏ giới hạn
+GEMINI_KEY_TOKENS_PER_MINUTE = 1000000
+ELEVENLABS_KEY_CHARS_PER_MINUTE = None
+
+class APIKey:
+    """Một khóa trong APIKeyPool và số liệu sử dụng của nó"""
+    
+    def __init__(self, value):
+        self.value = value
+        self.in_flight = 0
+        self.requests = 0
+        self.tokens = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.benched_until = 0.0
+        self.bench_reason = None
+        # Thời điểm các yêu cầu và (thời điểm, số token) trong QUOTA_WINDOW giây gần nhất
+        self.recent_requests = deque()
+        self.recent_tokens = deque()
+    
+    @property
+    def label(self):
+        """Chỉ hiện 4 ký tự cuối của khóa"""
+        return f"…{self.value[-4:]}"
+
+class APIKeyPool:
+    """Chia yêu cầu cho nhiều khóa API, theo dõi hạn mức mỗi khóa và tạm ngưng khóa bị 429 hoặc bị từ chối
+    
+    Mỗi khóa có hạn mức yêu cầu/phút, token/phút và số yêu cầu đồng thời (None là không giới hạn). acquire()
+    chọn khóa còn hạn mức theo API_KEY_SELECTION; nếu không còn khóa nào thì chờ đến khi có khóa trống.
+    Khi mọi khóa đều bị từ chối, khóa đầu tiên vẫn được dùng để lời gọi báo lỗi thay vì chờ mãi.
+    """
+    QUOTA_WINDOW = 60.0
+    
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None, max_in_flight=None):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_in_flight = max_in_flight
+        self.keys = []
+        self._next = 0
+        self._condition = threading.Condition()
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def load(self, values):
+        """Thay danh sách khóa (bỏ trùng, giữ thứ tự); khóa đã có giữ nguyên số liệu"""
+        with self._condition:
+            existing = {key.value: key for key in self.keys}
+            self.keys = [existing.get(value) or APIKey(value) for value in dict.fromkeys(values)]
+            self._next = 0
+            self._condition.notify_all()
+    
+    def _ready_at(self, key, now):
+        """Thời điểm sớm nhất khóa có thể nhận thêm yêu cầu (now nếu ngay bây giờ), hoặc None nếu phải chờ release()"""
+        while key.recent_requests and key.recent_requests[0] <= now - self.QUOTA_WINDOW:
+            key.recent_requests.popleft()
+        while key.recent_tokens and key.recent_tokens[0][0] <= now - self.QUOTA_WINDOW:
+            key.recent_tokens.popleft()
+        if self.max_in_flight and key.in_flight >= self.max_in_flight:
+            return None
+        ready = max(now, key.benched_until)
+        if self.requests_per_minute and len(key.recent_requests) >= self.requests_per_minute:
+            ready = max(ready, key.recent_requests[-self.requests_per_minute] + self.QUOTA_WINDOW)
+        if self.tokens_per_minute:
+            used = sum(tokens for _, tokens in key.recent_tokens)
+            for sent_at, tokens in key.recent_tokens:
+                if used < self.tokens_per_minute:
+                    break
+                used -= tokens
+                ready = max(ready, sent_at + self.QUOTA_WINDOW)
+        return ready
+    
+    def _choose(self, ready):
+        if API_KEY_SELECTION == 'round_robin':
+            for offset in range(len(self.keys)):
+                key = self.keys[(self._next + offset) % len(self.keys)]
+                if key in ready:
+                    self._next = (self.keys.index(key) + 1) % len(self.keys)
+                    return key
+        return min(ready, key=lambda key: (key.in_flight, len(key.recent_requests), self.keys.index(key)))
+    
+    def acquire(self, fallback=None, tokens=0):
+        """Chờ và giữ một khóa cho một yêu cầu (ước tính tokens token); fallback được thêm vào nhóm nếu nhóm trống"""
+        with self._condition:
+            if not self.keys and fallback:
+                self.keys.append(APIKey(fallback))
+            if not self.keys:
+                raise ValueError(f"Chưa có khóa API {self.name}")
+            while True:
+                now = time.monotonic()
+                ready_at = {key: self._ready_at(key, now) for key in self.keys}
+                ready = [key for key, at in ready_at.items() if at is not None and at <= now]
+                if not ready and all(key.bench_reason == 'rejected' and key.benched_until > now for key in self.keys):
+                    ready = [self.keys[0]]
+                if ready:
+                    key = self._choose(ready)
+                    key.in_flight += 1
+                    key.requests += 1
+                    key.recent_requests.append(now)
+                    if tokens:
+                        key.tokens += tokens
+                        key.recent_tokens.append((now, tokens))
+                    return key
+                waits = [at - now for at in ready_at.values() if at is not None]
+                self._condition.wait(min(waits) if waits else None)
+    
+    def release(self, key, status=None, tokens=0, retry_after=None):
+        """Kết thúc một yêu cầu: tokens là số token thực tế dùng thêm, status là mã HTTP nếu bị lỗi"""
+        with self._condition:
+            key.in_flight -= 1
+            if tokens:
+                key.tokens += tokens
+                key.recent_tokens.append((time.monotonic(), tokens))
+            if status == 429:
+                key.throttled += 1
+                key.bench_reason = 'throttled'
+                key.benched_until = max(key.benched_until, time.monotonic() + (retry_after or API_KEY_BENCH_SECONDS))
+            elif status in API_KEY_REJECT_STATUS_CODES:
+                key.rejected += 1
+                key.bench_reason = 'rejected'
+                key.benched_until = time.monotonic() + API_KEY_REJECT_BENCH_SECONDS
+            self._condition.notify_all()
+    
+    @contextlib.contextmanager
+    def lease(self, fallback=None, tokens=0):
+        """Giữ một khóa trong khối with; trả về dict {'key', 'tokens'}, ghi số token thực tế vào 'tokens'
+        
+        Mã HTTP của lỗi (requests.HTTPError hoặc TTSBackendError) được chuyển cho release() để tạm ngưng khóa.
+        """
+        key = self.acquire(fallback, tokens)
+        usage = {'key': key.value, 'tokens': 0}
+        status = retry_after = None
+        try:
+            yield usage
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            status = getattr(e, 'status', None) or getattr(response, 'status_code', None)
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is None and response is not None:
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            raise
+        finally:
+            self.release(key, status, usage['tokens'], retry_after)
+    
+    def stats(self):
+        with self._condition:
+            now = time.monotonic()
+            return [{
+                'key': key.label,
+                'requests': key.requests,
+                'tokens': key.tokens,
+                'in_flight': key.in_flight,
+                'throttled': key.throttled,
+                'rejected': key.rejected,
+                'benched': round(key.benched_until - now) if key.benched_until > now else 0,
+            } for key in self.keys]
+
+gemini_keys = APIKeyPool('Gemini', GEMINI_KEY_REQUESTS_PER_MINUTE, GEMINI_KEY_TOKENS_PER_MINUTE)
+elevenlabs_keys = APIKeyPool('ElevenLabs', tokens_per_minute=ELEVENLABS_KEY_CHARS_PER_MINUTE,
+                             max_in_flight=ELEVENLABS_MAX_CONCURRENCY)
+
+# Bộ nhớ đệm âm thanh TTS trên đĩa
+TTS_CACHE_ENABLED = True
+TTS_CACHE_DIR = os.path.join("cache", "tts")
+TTS_CACHE_MAX_BYTES = 200 * 1024 * 1024  # Giới hạn dung lượng, xóa các đoạn ít dùng nhất khi vượt quá
+
+class TTSCache:
+    """Bộ nhớ đệm âm thanh MP3 trên đĩa, định danh theo hash (ngôn ngữ, văn bản, backend), xóa theo LRU"""
+    
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = None  # OrderedDict key -> kích thước, cũ nhất ở đầu
+        self._total_bytes = 0
+    
+    @staticmethod
+    def make_key(language, text, backend):
+        return hashlib.sha256(f"{backend}\0{language}\0{text}".encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+    
+    def _index(self):
+        # Nạp chỉ mục từ thư mục ở lần dùng đầu tiên, sắp xếp theo thời gian truy cập
+        if self._entries is None:
+            self.cache_dir = os.path.abspath(self.cache_dir)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            files = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.mp3'):
+                    try:
+                        stat = os.stat(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, name[:-4], stat.st_size))
+            files.sort()
+            self._entries = OrderedDict((key, size) for _, key, size in files)
+            self._total_bytes = sum(size for _, _, size in files)
+        return self._entries
+    
+    def get(self, key):
+        """Trả về bytes âm thanh nếu có trong bộ nhớ đệm, ngược lại trả về None"""
+        with self._lock:
+            entries = self._index()
+            if key in entries:
+                path = self._path(key)
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    os.utime(path, None)
+                except OSError:
+                    # File bị xóa bởi tiến trình khác
+                    self._total_bytes -= entries.pop(key)
+                else:
+                    entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+            self.misses += 1
+            return None
+    
+    def put(self, key, data):
+        """Lưu bytes âm thanh vào bộ nhớ đệm, ghi nguyên tử và xóa các mục cũ nhất nếu vượt giới hạn"""
+        if not data or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            entries = self._index()
+            path = self._path(key)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except OSError as e:
+                print(f"  - Cảnh báo: Không thể ghi bộ nhớ đệm TTS: {str(e)}")
+                return
+            
+            if key in entries:
+                self._total_bytes -= entries.pop(key)
+            entries[key] = len(data)
+            self._total_bytes += len(data)
+            
+            while self._total_bytes > self.max_bytes and entries:
+                old_key, size = entries.popitem(last=False)
+                self._total_bytes -= size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+    
+    def stats(self):
+        with self._lock:
+            entries = self._index()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(entries),
+                'bytes': self._total_bytes,
+            }
+
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES)
+
+# Bộ nhớ đệm phản hồi Gemini
+GEMINI_CACHE_ENABLED = True
+GEMINI_CACHE_DIR = os.path.join("cache", "gemini")
+GEMINI_CACHE_TTL = 24 * 3600      # Thời gian sống của một phản hồi (giây)
+GEMINI_CACHE_MAX_ENTRIES = 500    # Số phản hồi tối đa, xóa các phản hồi cũ nhất khi vượt quá
+
+def normalize_topic(topic):
+    """Chuẩn hóa chủ đề: NFKD, bỏ dấu tiếng Việt, chữ thường và gộp khoảng trắng"""
+    decomposed = unicodedata.normalize('NFKD', topic.replace('đ', 'd').replace('Đ', 'D'))
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+class ResponseCache:
+    """Bộ nhớ đệm phản hồi Gemini trên đĩa, mỗi mục một file JSON, có TTL và giới hạn số mục"""
+    
+    def __init__(self, cache_dir, ttl, max_entries):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(topic, prompt_template, generation_config):
+        key_data = json.dumps({
+            'topic': normalize_topic(topic),
+            'template': prompt_template,
+            'config': generation_config,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+    
+    def get(self, key):
+        """Trả về văn bản phản hồi gốc nếu còn hạn, ngược lại trả về None"""
+        with self._lock:
+            path = self._path(key)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+            
+            if time.time() - entry.get('created', 0) > self.ttl:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            return entry.get('response')
+    
+    def put(self, key, response_text, topic):
+        """Lưu phản hồi gốc và xóa các mục cũ nhất nếu vượt quá giới hạn"""
+        with self._lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                path = self._path(key)
+                temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'topic': topic, 'created': time.time(), 'response': response_text}, f, ensure_ascii=False)
+                os.replace(temp_path, path)
+                
+                entries = sorted(
+                    (os.path.getmtime(os.path.join(self.cache_dir, name)), name)
+                    for name in os.listdir(self.cache_dir) if name.endswith('.json')
+                )
+                for _, name in entries[:max(0, len(entries) - self.max_entries)]:
+                    os.remove(os.path.join(self.cache_dir, name))
+            except OSError as e:
+                print(f"Cảnh báo: Không thể ghi bộ nhớ đệm phản hồi Gemini: {str(e)}")
+
+gemini_cache = ResponseCache(GEMINI_CACHE_DIR, GEMINI_CACHE_TTL, GEMINI_CACHE_MAX_ENTRIES)
+
+# Kho job bền vững (SQLite): văn bản Gemini và tiến độ từng đoạn TTS của các job ở chế độ dịch vụ,
+# để sau khi tiến trình bị dừng, job tiếp tục từ đoạn chưa xong mà không gọi lại Gemini
+JOB_STORE_ENABLED = True
+JOB_STORE_PATH = os.path.join("cache", "jobs.sqlite3")
+JOB_STORE_FLUSH_CHUNKS = 16       # Ghi tiến độ theo lô: sau mỗi 16 đoạn...
+JOB_STORE_FLUSH_INTERVAL = 2.0    # ...hoặc sau 2 giây, tùy điều kiện nào đến trước
+_JOB_FIELDS = ('id', 'kind', 'status', 'topic', 'options', 'error', 'submitted_at', 'started_at', 'finished_at',
+               'timings', 'artifacts')
+_JOB_JSON_FIELDS = ('options', 'timings', 'artifacts')
+
+class JobStore:
+    """Lưu job (chủ đề, văn bản gốc/đã làm sạch, danh sách đoạn, trạng thái và audio từng đoạn) vào SQLite
+    
+    Kết quả từng đoạn được gom lại và ghi trong một giao dịch mỗi JOB_STORE_FLUSH_CHUNKS đoạn hoặc
+    JOB_STORE_FLUSH_INTERVAL giây, nên việc ghi tiến độ không làm chậm quá trình tải.
+    """
+    
+    def __init__(self, path, flush_chunks=JOB_STORE_FLUSH_CHUNKS, flush_interval=JOB_STORE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_chunks = flush_chunks
+        self.flush_interval = flush_interval
+        self._db = None
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        # Mở kết nối khi dùng lần đầu; một kết nối dùng chung cho mọi luồng, bảo vệ bằng khóa
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, kind TEXT, status TEXT, topic TEXT, input_text TEXT,
+                    options TEXT, error TEXT, submitted_at TEXT, started_at TEXT, finished_at TEXT,
+                    timings TEXT, artifacts TEXT, raw_text TEXT, cleaned_text TEXT);
+                CREATE TABLE IF NOT EXISTS chunks (
+                    job_id TEXT, idx INTEGER, text TEXT, status TEXT, bytes INTEGER, audio BLOB,
+                    PRIMARY KEY (job_id, idx));
+            """)
+            # stream_state: tiến độ của job chế độ luồng (JSON); kho tạo trước khi có cột này cần thêm vào
+            if 'stream_state' not in [row[1] for row in db.execute("PRAGMA table_info(jobs)")]:
+                db.execute("ALTER TABLE jobs ADD COLUMN stream_state TEXT")
+            self._db = db
+        return self._db
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connect()
+        db.execute("BEGIN")
+        try:
+            yield db
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+    
+    def save_job(self, job, input_text=None):
+        """Thêm mới hoặc cập nhật các trường công khai của job (dict của JobQueue)"""
+        row = {key: json.dumps(job[key], ensure_ascii=False) if key in _JOB_JSON_FIELDS else job[key]
+               for key in _JOB_FIELDS}
+        with self._lock:
+            db = self._connect()
+            self._flush_locked()
+            db.execute(f"INSERT INTO jobs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))}) "
+                       f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{key}=excluded.{key}' for key in row if key != 'id')}",
+                       list(row.values()))
+            if input_text is not None:
+                db.execute("UPDATE jobs SET input_text=? WHERE id=?", (input_text, job['id']))
+    
+    def update_texts(self, job_id, **texts):
+        """Lưu raw_text, cleaned_text và/hoặc stream_state của job ngay lập tức"""
+        with self._lock:
+            self._connect().execute(f"UPDATE jobs SET {', '.join(f'{key}=?' for key in texts)} WHERE id=?",
+                                    list(texts.values()) + [job_id])
+    
+    def load_jobs(self, statuses=None):
+        """Danh sách job (kèm input_text, raw_text, cleaned_text), lọc theo trạng thái nếu có"""
+        if statuses:
+            return self._query_jobs(f"status IN ({', '.join('?' * len(statuses))})", list(statuses))
+        return self._query_jobs("1", [])
+    
+    def load_job(self, job_id):
+        jobs = self._query_jobs("id=?", [job_id])
+        return jobs[0] if jobs else None
+    
+    def _query_jobs(self, where, params):
+        with self._lock:
+            db = self._connect()
+            db.row_factory = sqlite3.Row
+            try:
+                rows = db.execute(f"SELECT * FROM jobs WHERE {where} ORDER BY submitted_at", params).fetchall()
+            finally:
+                db.row_factory = None
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            for key in _JOB_JSON_FIELDS:
+                job[key] = json.loads(job[key] or '{}')
+            jobs.append(job)
+        return jobs
+    
+    def start_chunks(self, job_id, chunks):
+        """Ghi danh sách đoạn của job; nếu danh sách trùng với lần chạy trước, trả về {vị trí: audio} của các đoạn đã xong"""
+        with self._lock:
+            db = self._connect()
+            self._flush_locked()
+            stored = db.execute("SELECT text FROM chunks WHERE job_id=? ORDER BY idx", (job_id,)).fetchall()
+            if [text for text, in stored] == list(chunks):
+                return {index: bytes(audio) for index, audio in db.execute(
+                    "SELECT idx, audio FROM chunks WHERE job_id=? AND status='ok' AND audio IS NOT NULL", (job_id,))}
+            with self._transaction() as db:
+                db.execute("DELETE FROM chunks WHERE job_id=?", (job_id,))
+                db.executemany("INSERT INTO chunks (job_id, idx, text, status, bytes) VALUES (?, ?, ?, 'pending', 0)",
+                               [(job_id, index, chunk) for index, chunk in enumerate(chunks)])
+            return {}
+    
+    def add_chunk(self, job_id, index, chunk):
+        """Thêm một đoạn vào danh sách của job khi danh sách chưa biết trước (chế độ luồng)"""
+        with self._lock:
+            self._flush_locked()
+            self._connect().execute("INSERT OR REPLACE INTO chunks (job_id, idx, text, status, bytes) "
+                                    "VALUES (?, ?, ?, 'pending', 0)", (job_id, index, chunk))
+    
+    def take_streamed_audio(self, job_id):
+        """Trả về {văn bản đoạn: audio} của các đoạn đã xong ở lần chạy luồng trước rồi xóa danh sách đoạn
+        
+        Ranh giới đoạn phụ thuộc vào thời điểm dữ liệu luồng đến, nên khi tiếp tục, audio được dùng lại theo văn bản
+        chứ không theo vị trí.
+        """
+        with self._lock:
+            self._flush_locked()
+            with self._transaction() as db:
+                audio = {text: bytes(audio) for text, audio in db.execute(
+                    "SELECT text, audio FROM chunks WHERE job_id=? AND status='ok' AND audio IS NOT NULL", (job_id,))}
+                db.execute("DELETE FROM chunks WHERE job_id=?", (job_id,))
+            return audio
+    
+    def record_chunk(self, job_id, index, audio_bytes):
+        """Ghi nhận kết quả một đoạn (None nếu lỗi); được ghi xuống đĩa theo lô"""
+        with self._lock:
+            self._pending.append(('ok' if audio_bytes else 'failed', len(audio_bytes or b''), audio_bytes, job_id, index))
+            if len(self._pending) >= self.flush_chunks or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_locked()
+    
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+    
+    def _flush_locked(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        with self._transaction() as db:
+            db.executemany("UPDATE chunks SET status=?, bytes=?, audio=? WHERE job_id=? AND idx=?", self._pending)
+        self._pending = []
+    
+    def drop_audio(self, job_id):
+        """Xóa audio đã lưu của một job đã hoàn tất (file MP3 đã có), giữ lại trạng thái và số byte"""
+        with self._lock:
+            self._flush_locked()
+            self._connect().execute("UPDATE chunks SET audio=NULL WHERE job_id=?", (job_id,))
+    
+    def chunk_progress(self, job_id):
+        """Số đoạn theo trạng thái (pending, ok, failed) của job"""
+        with self._lock:
+            self._flush_locked()
+            return dict(self._connect().execute(
+                "SELECT status, COUNT(*) FROM chunks WHERE job_id=? GROUP BY status", (job_id,)).fetchall())
+
+job_store = JobStore(JOB_STORE_PATH)
+
+# Job đang chạy trên luồng hiện tại: (JobStore, job_id), hoặc None ngoài chế độ dịch vụ
+_current_job = contextvars.ContextVar('current_job', default=None)
+
+def job_checkpoint(**texts):
+    """Lưu văn bản (raw_text, cleaned_text) của job đang chạy, nếu có"""
+    current = _current_job.get()
+    if current:
+        store, job_id = current
+        store.update_texts(job_id, **texts)
+
+def job_start_chunks(chunks):
+    """Ghi danh sách đoạn của job đang chạy, trả về audio của các đoạn đã xong ở lần chạy trước"""
+    current = _current_job.get()
+    if not current:
+        return {}
+    store, job_id = current
+    return store.start_chunks(job_id, chunks)
+
+def job_record_chunk(index, audio_bytes):
+    current = _current_job.get()
+    if current:
+        store, job_id = current
+        store.record_chunk(job_id, index, audio_bytes)
+
+def job_add_chunk(index, chunk):
+    current = _current_job.get()
+    if current:
+        store, job_id = current
+        store.add_chunk(job_id, index, chunk)
+
+def job_resume_stream():
+    """(tiến độ luồng, {văn bản đoạn: audio}) của job luồng đang chạy từ lần chạy bị dừng trước, hoặc (None, {})"""
+    current = _current_job.get()
+    if not current:
+        return None, {}
+    store, job_id = current
+    stored = store.load_job(job_id)
+    # Luôn xóa danh sách đoạn cũ: lần chạy này đánh số lại từ đầu
+    audio = store.take_streamed_audio(job_id)
+    if not stored or not stored.get('stream_state'):
+        return None, {}
+    return json.loads(stored['stream_state']), audio
+
+def extract_api_keys(file_path, prefix):
+    """Mọi khóa có dạng PREFIX:khóa (ví dụ API: hoặc ELEVENLABS:) trong tệp cấu hình, theo thứ tự xuất hiện"""
+    try:
+        with open(file_path, 'r') as file:
+            return re.findall(rf'\b{prefix}:([\w-]+)', file.read())
+    except FileNotFoundError:
+        return []
+
+def load_api_keys(file_path):
+    """Nạp mọi khóa Gemini (API:) và ElevenLabs (ELEVENLABS:) trong tệp cấu hình vào gemini_keys và elevenlabs_keys"""
+    gemini_keys.load(extract_api_keys(file_path, 'API'))
+    elevenlabs_keys.load(extract_api_keys(file_path, 'ELEVENLABS'))
+
 def extract_api_key(file_path):
     try:
         with open(file_path, 'r') as file:
@@ -48,7 +976,25 @@ def extract_api_key(file_path):
         print(f"Lỗi: Tệp cấu hình {file_path} không tìm thấy.")
         sys.exit(1)
 
-def clean_response(response_text):
+# Các mẫu làm sạch văn bản được biên dịch sẵn một lần khi nạp module
+_COLON_DIGIT_RE = re.compile(r':\d')  # Lọc nhanh: mẫu có tiền tố cố định nên quét nhanh hơn nhiều
+_TIMECODE_RE = re.compile(r'\(\d+:\d+-\d+:\d+\)')
+_TIMESTAMP_RE = re.compile(r'\b\d+:\d+\b')
+_EXTRA_BRACKETS_RE = re.compile(r'\[(?!(title|tiêu đề|content|nội dung))[^\]]*\]')
+_PARENTHESES_RE = re.compile(r'\(.*?\)')
+_MULTI_SPACE_RE = re.compile(r' {2,}')
+_MULTI_BLANK_LINES_RE = re.compile(r'\n\s*\n\s*\n+')
+_RESPONSE_INTRO_RE = re.compile(r'^(Tuyệt vời|Chắc chắn|Dưới đây|Đây là kịch bản|Đây là nội dung|Dưới đây là kịch bản)[^[]*')
+# Ghi chú tham khảo: áp dụng lần lượt vì \s có thể khớp xuống dòng nên thứ tự xóa ảnh hưởng kết quả
+_ANNOTATION_RES = [(keyword, re.compile(pattern, re.MULTILINE)) for keyword, pattern in [
+    ('Ref', r'\bRef\.?:?\s.*?$'),
+    ('Note', r'\bNotes?:?\s.*?$'),
+    ('Source', r'\bSources?:?\s.*?$'),
+]]
+_SPECIAL_LINE_RE = re.compile(r'^[-*_>]+.*$', re.MULTILINE)
+
+@traced_stage('text')
+def clean_response(response_text, strip_intro=True):
     if not response_text:
         return ""
         
@@ -58,33 +1004,37 @@ def clean_response(response_text):
     # Remove asterisks
     cleaned_text = response_text.replace('*', '')
     
-    # Remove time codes like (7:30-8:00)
-    cleaned_text = re.sub(r'\(\d+:\d+-\d+:\d+\)', '', cleaned_text)
-    
-    # Remove timestamp patterns like 7:30, 12:45, etc.
-    cleaned_text = re.sub(r'\b\d+:\d+\b', '', cleaned_text)
+    # Các bước dưới đây chỉ chạy khi văn bản có ký tự kích hoạt tương ứng
+    if _COLON_DIGIT_RE.search(cleaned_text):
+        # Remove time codes like (7:30-8:00)
+        cleaned_text = _TIMECODE_RE.sub('', cleaned_text)
+        # Remove timestamp patterns like 7:30, 12:45, etc.
+        cleaned_text = _TIMESTAMP_RE.sub('', cleaned_text)
     
     # Remove square brackets and their contents that aren't part of [title]/[tiêu đề] and [content]/[nội dung]
     # Careful not to remove the actual tags we need
-    cleaned_text = re.sub(r'\[(?!(title|tiêu đề|content|nội dung))[^\]]*\]', '', cleaned_text)
+    if '[' in cleaned_text:
+        cleaned_text = _EXTRA_BRACKETS_RE.sub('', cleaned_text)
     
     # Remove parentheses and their contents
-    cleaned_text = re.sub(r'\(.*?\)', '', cleaned_text)
+    if '(' in cleaned_text:
+        cleaned_text = _PARENTHESES_RE.sub('', cleaned_text)
     
     # Clear extra whitespace
-    cleaned_text = re.sub(r' +', ' ', cleaned_text)
-    cleaned_text = re.sub(r'\n\s*\n\s*\n+', '\n\n', cleaned_text)
+    cleaned_text = _MULTI_SPACE_RE.sub(' ', cleaned_text)
+    cleaned_text = _MULTI_BLANK_LINES_RE.sub('\n\n', cleaned_text)
     
     # Remove introductory phrases like "Tuyệt vời! Đây là kịch bản..."
-    cleaned_text = re.sub(r'^(Tuyệt vời|Chắc chắn|Dưới đây|Đây là kịch bản|Đây là nội dung|Dưới đây là kịch bản)[^[]*', '', cleaned_text)
+    if strip_intro:
+        cleaned_text = _RESPONSE_INTRO_RE.sub('', cleaned_text)
     
     # Remove any references or annotations
-    cleaned_text = re.sub(r'\bRef\.?:?\s.*?$', '', cleaned_text, flags=re.MULTILINE)
-    cleaned_text = re.sub(r'\bNotes?:?\s.*?$', '', cleaned_text, flags=re.MULTILINE)
-    cleaned_text = re.sub(r'\bSources?:?\s.*?$', '', cleaned_text, flags=re.MULTILINE)
+    for keyword, pattern in _ANNOTATION_RES:
+        if keyword in cleaned_text:
+            cleaned_text = pattern.sub('', cleaned_text)
     
     # Filter out any instructions or annotations that start with special characters
-    cleaned_text = re.sub(r'^[-*_>]+.*$', '', cleaned_text, flags=re.MULTILINE)
+    cleaned_text = _SPECIAL_LINE_RE.sub('', cleaned_text)
     
     # Kết quả cuối cùng
     cleaned_text = cleaned_text.strip()
@@ -100,8 +1050,446 @@ def clean_response(response_text):
     
     return cleaned_text
 
-def save_responses(original_response, cleaned_response, topic, save_timestamp=False):
-    """Save both original and cleaned responses to a file"""
+# Kho lưu trữ mọi lần tạo kịch bản (SQLite, chỉ thêm mới): văn bản gốc và đã làm sạch được nén zlib,
+# có chỉ mục theo chủ đề và thời gian. File văn bản dễ đọc được tạo lại khi cần bằng export_archive()
+ARCHIVE_ENABLED = True
+ARCHIVE_PATH = os.path.join("responses", "archive.sqlite3")
+ARCHIVE_COMPRESSION_LEVEL = 6
+ARCHIVE_EXPORT_DIR = os.path.join("responses", "export")
+_ARCHIVE_FIELDS = ('id', 'created_at', 'topic', 'config', 'tokens', 'timings', 'audio_path', 'response_file',
+                   'raw_bytes', 'cleaned_bytes')
+_ARCHIVE_JSON_FIELDS = ('config', 'timings')
+# Tìm kiếm toàn văn (FTS5) trên chủ đề và phần [nội dung]; kiểm tra chủ đề gần trùng trước khi gọi Gemini:
+# 'off', 'warn' (chỉ báo), 'ask' (hỏi khi chạy tương tác, các luồng khác coi như 'warn'), 'reuse' (dùng lại kịch bản cũ)
+ARCHIVE_SEARCH_LIMIT = 10
+ARCHIVE_DUPLICATE_MODES = ('off', 'warn', 'ask', 'reuse')
+ARCHIVE_DUPLICATE_CHECK = 'warn'
+ARCHIVE_DUPLICATE_THRESHOLD = 0.75  # Độ giống tối thiểu (Jaccard trên các âm tiết đã bỏ dấu)
+ARCHIVE_SNIPPET_WORDS = 24
+
+def archive_terms(text):
+    """Các âm tiết không dấu, chữ thường của văn bản
+    
+    Tiếng Việt viết tách từng âm tiết nên mỗi âm tiết là một từ tố; bỏ dấu (kể cả đ → d) để
+    "Hà Nội", "ha noi" và "HÀ NỘI" khớp nhau. Cả văn bản được đánh chỉ mục lẫn truy vấn đều đi qua hàm này.
+    """
+    return re.findall(r'\w+', normalize_topic(text or ''))
+
+def archive_content_text(cleaned_text):
+    """Phần [nội dung] của văn bản đã làm sạch (không in thông báo), hoặc toàn bộ văn bản nếu không có thẻ"""
+    match = re.search(r'\[(?:content|nội dung)\](.*?)(?:$|\[)', cleaned_text or '', re.DOTALL | re.IGNORECASE)
+    if match and match.group(1).strip():
+        return match.group(1).strip()
+    return cleaned_text or ''
+
+def fts_query(query, operator='AND'):
+    """Truy vấn FTS5 từ chuỗi người dùng nhập: cụm trong dấu ngoặc kép là cụm từ, các từ còn lại nối bằng operator"""
+    parts = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        terms = archive_terms(phrase or word)
+        if terms:
+            parts.append('"' + ' '.join(terms) + '"')
+    return f' {operator} '.join(parts)
+
+def similar_topic_query(topic, threshold, max_groups=64):
+    """Truy vấn FTS5 tìm ứng viên gần trùng với topic
+    
+    Jaccard >= threshold kéo theo chủ đề ứng viên chứa ít nhất ceil(threshold * n) trong n âm tiết của topic,
+    nên truy vấn là OR của các nhóm AND thay vì OR từng âm tiết (âm tiết phổ biến như "phần" khớp gần hết kho).
+    """
+    terms = sorted(set(archive_terms(topic)))
+    needed = max(1, math.ceil(threshold * len(terms) - 1e-9))
+    if math.comb(len(terms), needed) > max_groups:
+        return ' OR '.join(f'"{term}"' for term in terms)
+    return ' OR '.join('(' + ' AND '.join(f'"{term}"' for term in group) + ')'
+                       for group in itertools.combinations(terms, needed))
+
+def archive_snippet(text, terms, words=ARCHIVE_SNIPPET_WORDS):
+    """Đoạn trích (giữ nguyên dấu) quanh lần xuất hiện đầu tiên của một trong các âm tiết terms"""
+    tokens = text.split()
+    normalized = normalize_topic(text).split()
+    index = 0
+    if len(normalized) == len(tokens):
+        index = next((position for position, token in enumerate(normalized)
+                      if terms.intersection(re.findall(r'\w+', token))), 0)
+    start = max(0, index - words // 3)
+    return ('… ' if start else '') + ' '.join(tokens[start:start + words]) + (' …' if start + words < len(tokens) else '')
+
+def topic_similarity(first, second):
+    """Độ giống của hai chủ đề: Jaccard trên tập âm tiết không dấu (0..1)"""
+    a, b = set(archive_terms(first)), set(archive_terms(second))
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+class ResponseArchive:
+    """Lưu mỗi lần tạo kịch bản thành một dòng SQLite: chủ đề, văn bản gốc và đã làm sạch (nén), cấu hình,
+    số token, thời gian các bước, đường dẫn audio và file phản hồi. Chỉ thêm mới, không sửa hay xóa.
+    
+    Bảng FTS5 generations_fts (không lưu nội dung, chỉ chỉ mục) đánh chỉ mục chủ đề và phần [nội dung]
+    sau khi bỏ dấu; rowid trùng với id của generations.
+    """
+    SEARCH_VERSION = 1
+    
+    def __init__(self, path, compression_level=ARCHIVE_COMPRESSION_LEVEL):
+        self.path = path
+        self.compression_level = compression_level
+        self.fts = None
+        self._db = None
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS generations (
+                    id INTEGER PRIMARY KEY, created_at TEXT, topic TEXT, topic_key TEXT, config TEXT,
+                    tokens INTEGER, timings TEXT, audio_path TEXT, response_file TEXT,
+                    raw_bytes INTEGER, cleaned_bytes INTEGER, raw_text BLOB, cleaned_text BLOB);
+                CREATE INDEX IF NOT EXISTS generations_topic ON generations (topic_key, created_at);
+                CREATE INDEX IF NOT EXISTS generations_time ON generations (created_at);
+            """)
+            self._db = db
+            self._init_search()
+        return self._db
+    
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._connect()
+        db.execute("BEGIN")
+        try:
+            yield db
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+    
+    def _init_search(self):
+        """Tạo bảng FTS5 (nếu SQLite hỗ trợ) và đánh chỉ mục các dòng có từ trước khi có tìm kiếm"""
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5("
+                             "topic, body, content='', tokenize='unicode61 remove_diacritics 2')")
+        except sqlite3.OperationalError as e:
+            print(f"{Colors.YELLOW}Cảnh báo: SQLite không hỗ trợ FTS5 ({str(e)}), chỉ tìm kiếm theo chủ đề{Colors.ENDC}")
+            self.fts = False
+            return
+        self.fts = True
+        if self._db.execute("PRAGMA user_version").fetchone()[0] >= self.SEARCH_VERSION:
+            return
+        with self._transaction() as db:
+            for record_id, topic, cleaned_blob in db.execute(
+                    "SELECT id, topic, cleaned_text FROM generations").fetchall():
+                self._index(db, record_id, topic, zlib.decompress(cleaned_blob).decode('utf-8'))
+            db.execute(f"PRAGMA user_version={self.SEARCH_VERSION}")
+    
+    def _index(self, db, record_id, topic, cleaned_text):
+        db.execute("INSERT INTO generations_fts (rowid, topic, body) VALUES (?, ?, ?)",
+                   (record_id, ' '.join(archive_terms(topic)),
+                    ' '.join(archive_terms(archive_content_text(cleaned_text)))))
+    
+    def _compress(self, text):
+        return zlib.compress((text or '').encode('utf-8'), self.compression_level)
+    
+    def append(self, topic, raw_text, cleaned_text, config=None, tokens=0, timings=None, audio_path=None,
+               response_file=None, created_at=None):
+        """Thêm một lần tạo kịch bản (và đánh chỉ mục tìm kiếm), trả về id"""
+        row = {
+            'created_at': created_at or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'topic': topic,
+            'topic_key': normalize_topic(topic),
+            'config': json.dumps(config or {}, ensure_ascii=False),
+            'tokens': tokens,
+            'timings': json.dumps(timings or {}),
+            'audio_path': audio_path,
+            'response_file': response_file,
+            'raw_bytes': len((raw_text or '').encode('utf-8')),
+            'cleaned_bytes': len((cleaned_text or '').encode('utf-8')),
+            'raw_text': self._compress(raw_text),
+            'cleaned_text': self._compress(cleaned_text),
+        }
+        with self._lock, self._transaction() as db:
+            record_id = db.execute(
+                f"INSERT INTO generations ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                list(row.values())).lastrowid
+            if self.fts:
+                self._index(db, record_id, topic, cleaned_text)
+            return record_id
+    
+    def search(self, query, limit=ARCHIVE_SEARCH_LIMIT):
+        """Các lần tạo khớp với query trên chủ đề và phần [nội dung], phù hợp nhất trước
+        
+        Mỗi bản ghi có thêm 'score' (bm25, chủ đề nặng gấp 5 lần nội dung) và 'snippet'. Các từ được nối
+        bằng AND; nếu không có kết quả thì thử lại với OR. Cụm trong dấu ngoặc kép được tìm nguyên cụm.
+        """
+        if not archive_terms(query):
+            return []
+        with self._lock:
+            db = self._connect()
+            if self.fts:
+                rows = []
+                for operator in ('AND', 'OR'):
+                    rows = db.execute(
+                        "SELECT rowid, bm25(generations_fts, 5.0, 1.0) AS score FROM generations_fts "
+                        "WHERE generations_fts MATCH ? ORDER BY score LIMIT ?",
+                        (fts_query(query, operator), int(limit))).fetchall()
+                    if rows:
+                        break
+            else:
+                rows = db.execute("SELECT id, 0 FROM generations WHERE topic_key LIKE ? ORDER BY id DESC LIMIT ?",
+                                  (f"%{' '.join(archive_terms(query))}%", int(limit))).fetchall()
+        if not rows:
+            return []
+        scores = dict(rows)
+        records = sorted(self.find(ids=list(scores)), key=lambda record: scores[record['id']])
+        terms = set(archive_terms(query))
+        for record in records:
+            record['score'] = round(-scores[record['id']], 3)
+            texts = self.load_texts(record['id'])
+            record['snippet'] = archive_snippet(archive_content_text(texts[1]), terms) if texts else ''
+        return records
+    
+    def similar_topics(self, topic, threshold=ARCHIVE_DUPLICATE_THRESHOLD, limit=200):
+        """[(độ giống, bản ghi mới nhất của chủ đề đó)] cho các chủ đề đã lưu giống topic từ threshold trở lên"""
+        terms = archive_terms(topic)
+        if not terms:
+            return []
+        with self._lock:
+            db = self._connect()
+            if self.fts:
+                rows = db.execute(
+                    "SELECT topic, MAX(id) FROM generations WHERE id IN (SELECT rowid FROM generations_fts "
+                    "WHERE generations_fts MATCH ? ORDER BY rank LIMIT ?) GROUP BY topic_key",
+                    (f"topic : ({similar_topic_query(topic, threshold)})", int(limit))).fetchall()
+            else:
+                rows = db.execute("SELECT topic, MAX(id) FROM generations GROUP BY topic_key").fetchall()
+        matches = [(topic_similarity(topic, stored), record_id) for stored, record_id in rows]
+        matches = [(score, record_id) for score, record_id in matches if score >= threshold]
+        if not matches:
+            return []
+        records = {record['id']: record for record in self.find(ids=[record_id for _, record_id in matches])}
+        return sorted(((round(score, 3), records[record_id]) for score, record_id in matches),
+                      key=lambda match: (-match[0], -match[1]['id']))
+    
+    def find(self, topic=None, since=None, until=None, ids=None, limit=None):
+        """Các lần tạo (không kèm văn bản), mới nhất trước; topic khớp sau khi chuẩn hóa (bỏ dấu, chữ thường)
+        
+        since/until là chuỗi 'YYYY-MM-DD' hoặc 'YYYY-MM-DD HH:MM:SS'.
+        """
+        where, params = [], []
+        if topic:
+            where.append("topic_key=?")
+            params.append(normalize_topic(topic))
+        if since:
+            where.append("created_at>=?")
+            params.append(since)
+        if until:
+            # until chỉ có ngày: tính cả ngày đó
+            where.append("created_at<=?")
+            params.append(until if len(until) > 10 else f"{until} 23:59:59")
+        if ids:
+            where.append(f"id IN ({', '.join('?' * len(ids))})")
+            params.extend(ids)
+        sql = (f"SELECT {', '.join(_ARCHIVE_FIELDS)} FROM generations WHERE {' AND '.join(where) or '1'} "
+               f"ORDER BY created_at DESC, id DESC")
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        records = []
+        for row in rows:
+            record = dict(zip(_ARCHIVE_FIELDS, row))
+            for key in _ARCHIVE_JSON_FIELDS:
+                record[key] = json.loads(record[key] or '{}')
+            records.append(record)
+        return records
+    
+    def load_texts(self, record_id):
+        """(văn bản gốc, văn bản đã làm sạch) của một lần tạo, hoặc None"""
+        with self._lock:
+            row = self._connect().execute("SELECT raw_text, cleaned_text FROM generations WHERE id=?",
+                                          (record_id,)).fetchone()
+        if row is None:
+            return None
+        return tuple(zlib.decompress(blob).decode('utf-8') for blob in row)
+    
+    def stats(self):
+        with self._lock:
+            count, raw, stored = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_bytes + cleaned_bytes), 0), "
+                "COALESCE(SUM(LENGTH(raw_text) + LENGTH(cleaned_text)), 0) FROM generations").fetchone()
+        return {'records': count, 'text_bytes': raw, 'stored_bytes': stored}
+
+response_archive = ResponseArchive(ARCHIVE_PATH)
+
+# Lần tạo kịch bản đang chạy trên luồng hiện tại (thời điểm bắt đầu, số token Gemini...), để ghi vào kho lưu trữ
+_current_generation = contextvars.ContextVar('current_generation', default=None)
+_generation_lock = threading.Lock()
+
+def archived_run(func):
+    """Decorator: theo dõi thời gian và số token của một lần tạo kịch bản; lời gọi lồng nhau dùng chung"""
+    @functools.wraps(func)
+    def wrapper(api_key, prompt, *args, **kwargs):
+        if _current_generation.get() is not None:
+            return func(api_key, prompt, *args, **kwargs)
+        token = _current_generation.set({'started': time.perf_counter(), 'tokens': 0, 'cached': False,
+                                         'streaming': func.__name__ == 'send_to_gemini_streaming'})
+        try:
+            return func(api_key, prompt, *args, **kwargs)
+        finally:
+            _current_generation.reset(token)
+    return wrapper
+
+def add_generation_tokens(tokens):
+    """Cộng số token của một yêu cầu Gemini vào lần tạo kịch bản hiện tại"""
+    generation = _current_generation.get()
+    if generation is not None and tokens:
+        with _generation_lock:
+            generation['tokens'] += tokens
+
+def mark_generation_cached():
+    generation = _current_generation.get()
+    if generation is not None:
+        generation['cached'] = True
+
+def mark_generation_reused(record_id):
+    generation = _current_generation.get()
+    if generation is not None:
+        generation['reused_from'] = record_id
+
+def generation_elapsed():
+    """Số giây từ khi lần tạo kịch bản hiện tại bắt đầu, hoặc None"""
+    generation = _current_generation.get()
+    return round(time.perf_counter() - generation['started'], 3) if generation else None
+
+def archive_generation(topic, original_response, cleaned_response, audio_file, response_file, use_content_only,
+                       timings):
+    """Ghi lần tạo kịch bản hiện tại vào response_archive (nếu bật), trả về id hoặc None"""
+    if not ARCHIVE_ENABLED:
+        return None
+    generation = _current_generation.get() or {}
+    if generation.get('reused_from'):
+        # Kịch bản lấy từ kho lưu trữ đã có bản ghi, không thêm bản ghi thứ hai
+        print(f"Kịch bản đã có trong kho lưu trữ (#{generation['reused_from']}), không ghi thêm")
+        return generation['reused_from']
+    config = {
+        'model': GEMINI_API_BASE.rsplit('/', 1)[-1],
+        'generation_config': DEFAULT_GENERATION_CONFIG,
+        'prompt_template': hashlib.sha256(SCRIPT_PROMPT_TEMPLATE.encode('utf-8')).hexdigest()[:16],
+        'hedge_mode': GEMINI_HEDGE_MODE,
+        'streaming': generation.get('streaming', False),
+        'content_only': use_content_only,
+        'cached': generation.get('cached', False),
+        'tts_backends': list(TTS_BACKENDS),
+    }
+    timings = dict(timings, total_s=generation_elapsed())
+    try:
+        record_id = response_archive.append(topic, original_response, cleaned_response, config,
+                                            generation.get('tokens', 0), timings, audio_file, response_file)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Cảnh báo: Không thể ghi vào kho lưu trữ: {str(e)}")
+        return None
+    print(f"Đã lưu vào kho lưu trữ (#{record_id})")
+    return record_id
+
+def check_duplicate_topic(prompt):
+    """Tìm chủ đề gần trùng trong kho lưu trữ trước khi gọi Gemini (theo ARCHIVE_DUPLICATE_CHECK)
+    
+    Trả về văn bản gốc của kịch bản cũ nếu dùng lại nó, nếu không trả về None để tiếp tục gọi Gemini.
+    Chế độ 'ask' chỉ hỏi khi chạy tương tác trên luồng chính; batch và dịch vụ chỉ in cảnh báo.
+    """
+    if not ARCHIVE_ENABLED or ARCHIVE_DUPLICATE_CHECK == 'off':
+        return None
+    try:
+        matches = response_archive.similar_topics(prompt, ARCHIVE_DUPLICATE_THRESHOLD)
+    except sqlite3.Error as e:
+        print(f"Cảnh báo: Không thể kiểm tra chủ đề trùng trong kho lưu trữ: {str(e)}")
+        return None
+    if not matches:
+        return None
+    print(f"{Colors.YELLOW}Kho lưu trữ đã có chủ đề gần giống:{Colors.ENDC}")
+    for score, record in matches[:3]:
+        print(f"{Colors.YELLOW}  #{record['id']} {record['created_at']} {record['topic']} (giống {score:.0%}){Colors.ENDC}")
+    record = matches[0][1]
+    reuse = ARCHIVE_DUPLICATE_CHECK == 'reuse'
+    if ARCHIVE_DUPLICATE_CHECK == 'ask' and threading.current_thread() is threading.main_thread() and sys.stdin.isatty():
+        answer = input(f"{Colors.GREEN}Dùng lại kịch bản #{record['id']} thay vì tạo mới? (c/K): {Colors.ENDC}")
+        reuse = answer.strip().lower() in ('c', 'có', 'co', 'y', 'yes')
+    texts = response_archive.load_texts(record['id']) if reuse else None
+    if not texts:
+        return None
+    print(f"Dùng lại kịch bản #{record['id']} từ kho lưu trữ, bỏ qua lời gọi Gemini API.")
+    mark_generation_reused(record['id'])
+    return texts[0]
+
+def format_response_file(topic, original_response, cleaned_response, saved_at):
+    """Nội dung file phản hồi dễ đọc (định dạng của save_responses)"""
+    return (f"=== CHỦ ĐỀ ===\n{topic}"
+            f"\n\n=== GỐC: PHẢN HỒI GEMINI NGUYÊN BẢN ===\n\n{original_response}"
+            f"\n\n\n=== ĐÃ LÀM SẠCH: PHẢN HỒI SAU KHI XỬ LÝ ===\n\n{cleaned_response}"
+            f"\n\n=== THỜI GIAN ===\n{saved_at}")
+
+_RESPONSE_FILE_PATTERN = re.compile(
+    r'=== CHỦ ĐỀ ===\n(.*?)\n\n=== GỐC: PHẢN HỒI GEMINI NGUYÊN BẢN ===\n\n(.*?)'
+    r'\n\n\n=== ĐÃ LÀM SẠCH: PHẢN HỒI SAU KHI XỬ LÝ ===\n\n(.*?)\n\n=== THỜI GIAN ===\n(.*?)\s*$', re.DOTALL)
+
+def import_response_files(paths):
+    """Nhập các file phản hồi (định dạng save_responses) vào kho lưu trữ để tìm kiếm được, trả về số file đã nhập
+    
+    Bỏ qua file không đúng định dạng và file đã có trong kho (cùng chủ đề và thời gian, ví dụ file do export_archive tạo).
+    """
+    imported = 0
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                match = _RESPONSE_FILE_PATTERN.match(file.read())
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Cảnh báo: Không thể đọc {path}: {str(e)}")
+            continue
+        if not match:
+            continue
+        topic, original_response, cleaned_response, saved_at = match.groups()
+        if any(record['created_at'] == saved_at for record in response_archive.find(topic=topic)):
+            continue
+        response_archive.append(topic, original_response, cleaned_response, {'imported': True},
+                                response_file=path, created_at=saved_at)
+        imported += 1
+    return imported
+
+def export_archive(records, output_dir=None):
+    """Tạo lại file phản hồi dễ đọc cho các lần tạo trong kho lưu trữ, trả về danh sách đường dẫn"""
+    output_dir = output_dir or ARCHIVE_EXPORT_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for record in records:
+        texts = response_archive.load_texts(record['id'])
+        if texts is None:
+            continue
+        path = os.path.join(output_dir, f"{record['id']:06d}_{topic_slug(record['topic']) or 'topic'}.txt")
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(format_response_file(record['topic'], texts[0], texts[1], record['created_at']))
+        paths.append(path)
+    return paths
+
+def print_archive_records(records):
+    for record in records:
+        audio = os.path.basename(record['audio_path']) if record['audio_path'] else "không có audio"
+        total = record['timings'].get('total_s')
+        print(f"{Colors.CYAN}#{record['id']} {record['created_at']} {record['topic']} "
+              f"({record['cleaned_bytes'] // 1024} KB, {record['tokens']} token, "
+              f"{f'{total:.1f} giây' if total is not None else '-'}, {audio}){Colors.ENDC}")
+
+def print_search_results(records):
+    for record in records:
+        print(f"{Colors.CYAN}#{record['id']} {record['created_at']} {record['topic']} (điểm {record['score']}){Colors.ENDC}")
+        if record['snippet']:
+            print(f"    {record['snippet']}")
+
+def save_responses(original_response, cleaned_response, topic, save_timestamp=False, output_name=None):
+    """Save both original and cleaned responses to a file
+    
+    output_name (ví dụ từ chế độ hàng loạt) đặt tên file riêng thay cho gemini_latest_response.
+    """
     # Create responses directory if it doesn't exist
     if not os.path.exists('responses'):
         os.makedirs('responses')
@@ -109,7 +1497,10 @@ def save_responses(original_response, cleaned_response, topic, save_timestamp=Fa
     # Use a fixed filename for the most recent chat 
     base_filename = "gemini_latest_response"
     
-    if save_timestamp:
+    if output_name:
+        filename = f"responses/{output_name}.txt"
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    elif save_timestamp:
         # Add timestamp to filename to avoid overwriting
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"responses/{base_filename}_{timestamp}.txt"
@@ -117,7 +1508,7 @@ def save_responses(original_response, cleaned_response, topic, save_timestamp=Fa
         filename = f"responses/{base_filename}.txt"
     
     # Remove existing file if not using timestamp
-    if not save_timestamp and os.path.exists(filename):
+    if not save_timestamp and not output_name and os.path.exists(filename):
         try:
             os.remove(filename)
             print(f"Đã xóa file phản hồi cũ: {filename}")
@@ -126,14 +1517,8 @@ def save_responses(original_response, cleaned_response, topic, save_timestamp=Fa
     
     try:
         with open(filename, 'w', encoding='utf-8') as file:
-            file.write("=== CHỦ ĐỀ ===\n")
-            file.write(topic)
-            file.write("\n\n=== GỐC: PHẢN HỒI GEMINI NGUYÊN BẢN ===\n\n")
-            file.write(original_response)
-            file.write("\n\n\n=== ĐÃ LÀM SẠCH: PHẢN HỒI SAU KHI XỬ LÝ ===\n\n")
-            file.write(cleaned_response)
-            file.write("\n\n=== THỜI GIAN ===\n")
-            file.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            file.write(format_response_file(topic, original_response, cleaned_response,
+                                            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
             # Explicitly flush and close the file
             file.flush()
         
@@ -149,61 +1534,1270 @@ def save_responses(original_response, cleaned_response, topic, save_timestamp=Fa
         print(f"Lỗi khi lưu phản hồi vào file: {str(e)}")
         return None
 
-def split_text_into_chunks(text, max_length=200):
-    """Chia văn bản thành các phần nhỏ, cố gắng giữ nguyên câu"""
-    # Nếu văn bản ngắn hơn max_length, trả về nguyên văn
-    if len(text) <= max_length:
-        return [text]
+# Bộ chia đoạn TTS: mỗi từ kèm mức ngắt sau nó (2 = cuối câu/xuống dòng, 1 = dấu phẩy, chấm phẩy...)
+_CHUNK_WORD_RE = re.compile(r'(\S+)(\s*)')
+_SENTENCE_END_RE = re.compile(r'[.!?…]+["\'”’»)\]]*$')
+_CLAUSE_END_RE = re.compile(r'[,;:]["\'”’»)\]]*$')
+_DASHES = ('-', '–', '—')
+
+def _chunk_break_level(word, gap):
+    if word[-1].isalnum():  # đa số từ: không có dấu câu ở cuối
+        return 2 if '\n' in gap else 0
+    if _SENTENCE_END_RE.search(word) or '\n' in gap:
+        return 2
+    if _CLAUSE_END_RE.search(word) or word in _DASHES:
+        return 1
+    return 0
+
+def _pause_marker(word, level):
+    """Dấu ngắt nghỉ chèn sau một từ: '...' sau câu (tận dụng dấu chấm sẵn có), ' ...' sau dấu phẩy"""
+    if level == 2:
+        if word.endswith(('...', '…')):
+            return ''
+        return '..' if word.endswith('.') else '...'
+    if level == 1 and word.endswith((',', ';', ':')):
+        return ' ...'
+    return ''
+
+@traced_stage('text')
+def split_text_into_chunks(text, max_length=200, pauses=False):
+    """Chia văn bản thành ít đoạn nhất có thể, mỗi đoạn không quá max_length ký tự
+    
+    Ưu tiên ngắt ở cuối câu rồi đến dấu phẩy/chấm phẩy, miễn là đoạn đã đầy ít nhất
+    TTS_CHUNK_MIN_FILL; nếu không thì ngắt giữa hai từ. Từ dài hơn max_length bị cắt cứng.
+    pauses=True chèn dấu ngắt nghỉ (...) vào phần ký tự còn trống của từng đoạn, nên
+    không làm tăng số đoạn.
+    """
+    # NFC: chữ tiếng Việt dạng tổ hợp (NFD) tốn gấp đôi số ký tự cho mỗi dấu
+    text = unicodedata.normalize('NFC', text)
+    words = []
+    for word, gap in _CHUNK_WORD_RE.findall(text):
+        level = _chunk_break_level(word, gap)
+        while len(word) > max_length:
+            words.append((word[:max_length], 0))
+            word = word[max_length:]
+        words.append((word, level))
+    
+    # Tham lam theo từ; khi đoạn đầy thì lùi về điểm ngắt tốt nhất đã đủ dài.
+    # Phần lùi lại ngắn hơn (1 - TTS_CHUNK_MIN_FILL) * max_length nên mỗi từ chỉ bị duyệt lại tối đa một lần.
+    min_fill = max_length * TTS_CHUNK_MIN_FILL
+    spans = []
+    start = index = length = 0
+    breaks = {1: None, 2: None}  # mức ngắt -> (vị trí sau từ, độ dài đoạn tại đó)
+    while index < len(words):
+        added = len(words[index][0]) + (1 if index > start else 0)
+        if index > start and length + added > max_length:
+            end = index
+            for level in (2, 1):
+                if breaks[level] and breaks[level][1] >= min_fill:
+                    end = breaks[level][0]
+                    break
+            spans.append((start, end))
+            start = index = end
+            length = 0
+            breaks = {1: None, 2: None}
+            continue
+        length += added
+        level = words[index][1]
+        index += 1
+        if level:
+            breaks[1] = (index, length)
+            if level == 2:
+                breaks[2] = breaks[1]
+    if start < len(words):
+        spans.append((start, len(words)))
     
-    # Chia theo câu
-    sentences = re.split(r'(?<=[.!?])\s+', text)
     chunks = []
-    current_chunk = ""
-    
-    for sentence in sentences:
-        # Nếu câu đơn lẻ dài hơn max_length, chia nhỏ câu
-        if len(sentence) > max_length:
-            # Chia theo dấu phẩy
-            comma_parts = sentence.split(', ')
-            for part in comma_parts:
-                if len(current_chunk) + len(part) + 2 <= max_length:  # +2 cho dấu phẩy và khoảng trắng
-                    current_chunk += part + ', '
+    for start, end in spans:
+        chunk_words = words[start:end]
+        markers = [''] * len(chunk_words)
+        if pauses:
+            # Cuối đoạn đã là một khoảng nghỉ; chỉ chèn vào khoảng trống còn lại, câu trước rồi đến dấu phẩy
+            slack = max_length - (sum(len(word) for word, _ in chunk_words) + len(chunk_words) - 1)
+            for wanted in (2, 1):
+                for position, (word, level) in enumerate(chunk_words[:-1]):
+                    if level == wanted:
+                        marker = _pause_marker(word, level)
+                        if marker and len(marker) <= slack:
+                            markers[position] = marker
+                            slack -= len(marker)
+        chunks.append(' '.join(word + marker for (word, _), marker in zip(chunk_words, markers)))
+    return chunks
+
+class RetryBudget:
+    """Số lần thử lại do lỗi dùng chung cho mọi đoạn của một lần tạo âm thanh
+    
+    Giới hạn là max(TTS_RETRY_BUDGET_MIN, TTS_RETRY_BUDGET_RATIO * số đoạn), để một dịch vụ đang hỏng
+    không làm mỗi đoạn phải chờ hết các lần thử lại.
+    """
+    
+    def __init__(self, chunks=0):
+        self.chunks = chunks
+        self.used = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def limit(self):
+        return max(TTS_RETRY_BUDGET_MIN, math.ceil(self.chunks * TTS_RETRY_BUDGET_RATIO))
+    
+    def expand(self, chunks):
+        """Thêm đoạn (chế độ luồng, khi chưa biết trước tổng số đoạn)"""
+        with self._lock:
+            self.chunks += chunks
+    
+    def take(self):
+        """Dùng một lần thử lại; False nếu đã hết"""
+        with self._lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+def retry_backoff_delay(retry):
+    """Thời gian chờ trước lần thử lại thứ retry (từ 0): backoff lũy thừa với full jitter"""
+    return random.uniform(0, min(TTS_RETRY_MAX_DELAY, TTS_RETRY_BASE_DELAY * 2 ** retry))
+
+class TTSBackendError(Exception):
+    """Lỗi của một lần gọi backend TTS; status (mã HTTP nếu có) quyết định có thử lại hay không"""
+    
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def check_tts_status(response):
+    """Ném TTSBackendError nếu phản hồi HTTP không phải 200 (không đọc nội dung)"""
+    status = response.status_code
+    if status in TTS_THROTTLE_STATUS_CODES:
+        raise TTSBackendError(f"HTTP {status}", status, parse_retry_after(response.headers.get('Retry-After')))
+    if status != 200:
+        raise TTSBackendError(f"HTTP {status}", status)
+
+def read_tts_response(response):
+    """Bytes MP3 của một phản hồi HTTP thành công, nếu không thì ném TTSBackendError"""
+    check_tts_status(response)
+    if not response.content:
+        raise TTSBackendError("phản hồi rỗng", response.status_code)
+    return response.content
+
+class TTSBackend:
+    """Một dịch vụ chuyển văn bản thành giọng nói
+    
+    Lớp con khai báo name, max_chars (số ký tự tối đa mỗi yêu cầu), max_concurrency (số yêu cầu đồng thời)
+    và synthesize(text, language) trả về bytes MP3, hoặc synthesize_to(text, language, sink) nếu backend
+    trả âm thanh theo luồng; lỗi được báo bằng TTSBackendError. Mỗi lần gọi được ghi lại
+    (thành công, số giây, số ký tự) để xếp hạng backend theo số liệu gần đây.
+    """
+    name = None
+    max_chars = TTS_MAX_CHARS
+    max_concurrency = 4
+    cacheable = True
+    
+    def __init__(self):
+        # max_concurrency được đọc mỗi lần chờ chỗ nên có thể thay đổi theo cấu hình (ví dụ số khóa ElevenLabs)
+        self._slots = threading.Condition()
+        self._in_flight = 0
+        self._samples = deque(maxlen=TTS_BACKEND_WINDOW)
+        self._lock = threading.Lock()
+    
+    @property
+    def limiter(self):
+        """Bộ giới hạn tốc độ thích ứng của backend, hoặc None"""
+        return None
+    
+    @property
+    def cache_name(self):
+        """Tên dùng trong khóa bộ nhớ đệm TTS (thêm giọng đọc nếu backend có nhiều giọng)"""
+        return self.name
+    
+    def available(self):
+        return True
+    
+    def synthesize(self, text, language):
+        raise NotImplementedError
+    
+    def synthesize_to(self, text, language, sink):
+        """Gửi âm thanh vào sink(bytes) theo từng khối ngay khi nhận được"""
+        sink(self.synthesize(text, language))
+    
+    def acquire(self):
+        """Chờ chỗ cho một yêu cầu, trả về bộ giới hạn đã dùng để truyền lại cho release()"""
+        with self._slots:
+            while self._in_flight >= max(1, self.max_concurrency):
+                self._slots.wait()
+            self._in_flight += 1
+        limiter = self.limiter
+        if limiter:
+            limiter.acquire()
+        return limiter
+    
+    def release(self, limiter, outcome, retry_after, seconds, chars):
+        if limiter:
+            limiter.release(outcome, retry_after)
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify()
+        with self._lock:
+            self._samples.append((outcome == 'ok', seconds, chars))
+    
+    def score(self):
+        """Số giây đã dùng cho mỗi ký tự đọc thành công, tính cả các lần lỗi; None nếu chưa đủ số liệu
+        
+        Một chỉ số gộp độ trễ và tỉ lệ thành công: backend chậm hoặc hay lỗi đều có điểm cao (kém) hơn.
+        """
+        with self._lock:
+            if len(self._samples) < TTS_BACKEND_MIN_SAMPLES:
+                return None
+            seconds = sum(sample[1] for sample in self._samples)
+            chars = sum(sample[2] for sample in self._samples if sample[0])
+        return seconds / chars if chars else math.inf
+    
+    def stats(self):
+        with self._lock:
+            samples = list(self._samples)
+        score = self.score()
+        return {
+            'name': self.name,
+            'available': self.available(),
+            'samples': len(samples),
+            'success_rate': round(sum(sample[0] for sample in samples) / len(samples), 3) if samples else None,
+            'ms_per_char': round(score * 1000, 2) if score is not None and score != math.inf else None,
+        }
+
+class GoogleTranslateBackend(TTSBackend):
+    """URL translate_tts không chính thức của Google Translate, dùng bộ giới hạn tốc độ thích ứng"""
+    name = 'google_translate'
+    max_chars = TTS_MAX_CHARS
+    max_concurrency = TTS_CONCURRENCY_MAX
+    
+    @property
+    def limiter(self):
+        return tts_rate_limiter if TTS_RATE_LIMIT_ENABLED else None
+    
+    def synthesize(self, text, language):
+        url = f"{GOOGLE_TTS_URL}?ie=UTF-8&client=tw-ob&tl={language}&q={urllib.parse.quote(text)}"
+        return read_tts_response(get_http_session().get(url, headers=TTS_HEADERS, timeout=TTS_REQUEST_TIMEOUT))
+
+class GTTSBackend(TTSBackend):
+    """Thư viện gTTS (cũng gọi Google Translate, tự chia văn bản dài)"""
+    name = 'gtts'
+    max_chars = GTTS_MAX_CHARS
+    max_concurrency = GTTS_MAX_CONCURRENCY
+    
+    def available(self):
+        return GTTS_AVAILABLE
+    
+    def synthesize(self, text, language):
+        buffer = io.BytesIO()
+        try:
+            gTTS(text=text, lang=language, slow=False).write_to_fp(buffer)
+        except Exception as e:
+            # gTTSError giữ phản hồi HTTP trong thuộc tính rsp
+            raise TTSBackendError(f"gTTS: {str(e)}", getattr(getattr(e, 'rsp', None), 'status_code', None))
+        return buffer.getvalue()
+
+class ElevenLabsBackend(TTSBackend):
+    """Endpoint streaming text-to-speech của ElevenLabs, chỉ bật khi elevenlabs_keys có khóa
+    
+    Số yêu cầu đồng thời được giới hạn theo từng khóa trong elevenlabs_keys. Khóa bị 429 hoặc hết hạn mức
+    được tạm ngưng và yêu cầu được gửi lại ngay bằng khóa khác, nếu còn.
+    """
+    name = 'elevenlabs'
+    max_chars = ELEVENLABS_MAX_CHARS
+    
+    @property
+    def max_concurrency(self):
+        return ELEVENLABS_MAX_CONCURRENCY * len(elevenlabs_keys)
+    
+    @property
+    def cache_name(self):
+        return f"elevenlabs:{ELEVENLABS_VOICE_ID}:{ELEVENLABS_MODEL_ID}:{ELEVENLABS_OUTPUT_FORMAT}"
+    
+    def available(self):
+        return bool(elevenlabs_keys)
+    
+    def synthesize(self, text, language):
+        buffer = io.BytesIO()
+        self.synthesize_to(text, language, buffer.write)
+        return buffer.getvalue()
+    
+    def synthesize_to(self, text, language, sink):
+        for attempt in range(len(elevenlabs_keys)):
+            try:
+                with elevenlabs_keys.lease(tokens=len(text)) as usage:
+                    return self._stream(usage['key'], text, sink)
+            except TTSBackendError as e:
+                # Lỗi xảy ra trước khi nhận được âm thanh nên có thể gửi lại bằng khóa khác
+                if (e.status != 429 and e.status not in API_KEY_REJECT_STATUS_CODES) or attempt == len(elevenlabs_keys) - 1:
+                    raise
+    
+    def _stream(self, api_key, text, sink):
+        headers = {"Accept": "audio/mpeg", "Content-Type": "application/json", "xi-api-key": api_key}
+        data = {"text": text, "model_id": ELEVENLABS_MODEL_ID, "voice_settings": ELEVENLABS_VOICE_SETTINGS}
+        url = f"{ELEVENLABS_API_BASE}/text-to-speech/{ELEVENLABS_VOICE_ID}/stream"
+        received = 0
+        with get_http_session().post(url, params={'output_format': ELEVENLABS_OUTPUT_FORMAT}, json=data, headers=headers,
+                                     stream=True, timeout=ELEVENLABS_REQUEST_TIMEOUT) as response:
+            check_tts_status(response)
+            for block in response.iter_content(ELEVENLABS_STREAM_BLOCK_BYTES):
+                if block:
+                    sink(block)
+                    received += len(block)
+        if not received:
+            raise TTSBackendError("phản hồi rỗng", 200)
+
+class LocalTTSBackend(TTSBackend):
+    """Backend ngoại tuyến để thử nghiệm: âm thanh im lặng dài LOCAL_TTS_SECONDS_PER_CHAR giây mỗi ký tự"""
+    name = 'local'
+    max_chars = LOCAL_TTS_MAX_CHARS
+    max_concurrency = 8
+    cacheable = False
+    # Khung MPEG-2 Layer III 24 kHz, 32 kbps, mono như Google Translate TTS; side info bằng 0 là khung im lặng
+    FRAME_HEADER = b'\xff\xf3\x44\xc4'
+    
+    def synthesize(self, text, language):
+        frame = parse_mp3_frame_header(self.FRAME_HEADER)
+        frames = max(1, round(len(text) * LOCAL_TTS_SECONDS_PER_CHAR * frame['sample_rate'] / frame['samples']))
+        return (self.FRAME_HEADER + bytes(frame['length'] - 4)) * frames
+
+class TTSBackendSelector:
+    """Xếp hạng các backend có trong TTS_BACKENDS và đang khả dụng theo score() (thấp hơn là tốt hơn)"""
+    
+    def __init__(self, *backends):
+        self.backends = {backend.name: backend for backend in backends}
+    
+    def rank(self):
+        enabled = [self.backends[name] for name in TTS_BACKENDS
+                   if name in self.backends and self.backends[name].available()]
+        scores = {backend.name: backend.score() for backend in enabled}
+        # Backend chưa đủ số liệu đứng sau và giữ thứ tự cấu hình (sắp xếp ổn định)
+        return sorted(enabled, key=lambda backend: (scores[backend.name] is None, scores[backend.name] or 0.0))
+    
+    def chunk_limit(self):
+        """Số ký tự mỗi đoạn theo backend đang được xếp đầu"""
+        ranked = self.rank()
+        return ranked[0].max_chars if ranked else TTS_MAX_CHARS
+    
+    def stats(self):
+        return [self.backends[name].stats() for name in TTS_BACKENDS if name in self.backends]
+    
+    def reset_stats(self):
+        """Xóa số liệu của mọi backend để thứ tự trong TTS_BACKENDS có hiệu lực ngay"""
+        for backend in self.backends.values():
+            with backend._lock:
+                backend._samples.clear()
+
+def toggle_elevenlabs_first():
+    """Đưa elevenlabs lên đầu TTS_BACKENDS hoặc trả về sau backend kế tiếp; trả về True nếu ElevenLabs đứng đầu"""
+    global TTS_BACKENDS
+    others = tuple(name for name in TTS_BACKENDS if name != 'elevenlabs')
+    if TTS_BACKENDS[:1] == ('elevenlabs',):
+        TTS_BACKENDS = others[:1] + ('elevenlabs',) + others[1:]
+    else:
+        TTS_BACKENDS = ('elevenlabs',) + others
+    tts_backends.reset_stats()
+    return TTS_BACKENDS[0] == 'elevenlabs'
+
+tts_backends = TTSBackendSelector(GoogleTranslateBackend(), ElevenLabsBackend(), GTTSBackend(), LocalTTSBackend())
+
+# Các phần của một đoạn được chia lại khi chuyển sang backend có giới hạn nhỏ hơn được tải song song trong pool này,
+# vẫn qua giới hạn đồng thời và bộ giới hạn tốc độ của backend. Luồng của đoạn gốc chờ các phần, nên không dùng chung
+# pool của lần tạo âm thanh: nếu mọi luồng đều đang chờ, các phần sẽ không bao giờ được chạy.
+tts_piece_executor = ThreadPoolExecutor(max_workers=TTS_CONCURRENCY_MAX, thread_name_prefix='tts-piece')
+
+def fetch_tts_chunk(chunk, language, budget=None, report=None, sink=None, backends=None):
+    """Tạo âm thanh MP3 cho một đoạn văn bản, trả về bytes hoặc None
+    
+    Các backend được thử theo thứ tự xếp hạng của tts_backends (hoặc theo backends). Với mỗi backend, lỗi tạm thời
+    được thử lại tối đa TTS_CHUNK_RETRIES lần trong giới hạn budget (RetryBudget); hết lượt thì đoạn chuyển sang
+    backend sau. report (dict) nhận số lần gọi ('attempts'), lỗi cuối cùng ('error') và backend đã dùng ('backend').
+    Với sink(bytes), âm thanh được gửi đi ngay khi nhận được và hàm trả về số bytes đã gửi (0 nếu lỗi);
+    đoạn đã gửi được một phần thì không thể thử lại hay chuyển backend ('partial' trong report).
+    """
+    report = {} if report is None else report
+    report['attempts'] = 0
+    with trace_span('tts_chunk', 'tts', chars=len(chunk)) as span:
+        audio = None
+        report['error'] = "không có backend TTS nào khả dụng"
+        for position, backend in enumerate(tts_backends.rank() if backends is None else backends):
+            if position:
+                print(f"  - Chuyển đoạn sang backend {backend.name}...")
+            audio = _fetch_with_backend(backend, chunk, language, span, budget, report, sink)
+            if audio:
+                report['backend'] = span['backend'] = backend.name
+                report.pop('error', None)
+                break
+            if report.get('partial'):
+                break
+        span['bytes'] = (audio if sink else len(audio)) if audio else 0
+        return audio
+
+def _fetch_with_backend(backend, chunk, language, span, budget, report, sink=None):
+    if len(chunk) <= backend.max_chars:
+        return _fetch_tts_piece(backend, chunk, language, span, budget, report, sink)
+    # Đoạn được chia cho một backend có giới hạn lớn hơn: chia nhỏ lại, tải song song và ghép âm thanh các phần
+    pieces = split_text_into_chunks(chunk, backend.max_chars)
+    reports = [{'attempts': 0} for _ in pieces]
+    futures = [submit_traced(tts_piece_executor, _fetch_tts_piece, backend, piece, language, span, budget, piece_report)
+               for piece, piece_report in zip(pieces, reports)]
+    parts = []
+    for future in futures:
+        audio_bytes = future.result()
+        if not audio_bytes:
+            # Một phần lỗi thì cả đoạn lỗi: bỏ các phần chưa bắt đầu
+            for pending in futures:
+                pending.cancel()
+            wait(futures)
+            break
+        parts.append(audio_bytes)
+    report['attempts'] += sum(piece_report['attempts'] for piece_report in reports)
+    for piece_report in reports:
+        if piece_report.get('error'):
+            report['error'] = piece_report['error']
+        if piece_report.get('budget_exhausted'):
+            report['budget_exhausted'] = True
+    if len(parts) < len(pieces):
+        return None
+    audio_bytes = join_mp3_parts(parts)
+    if sink is None:
+        return audio_bytes
+    sink(audio_bytes)
+    return len(audio_bytes)
+
+def _fetch_tts_piece(backend, text, language, span, budget, report, sink=None):
+    cache_key = TTSCache.make_key(language, text, backend.cache_name)
+    use_cache = TTS_CACHE_ENABLED and backend.cacheable and sink is None
+    if use_cache:
+        cached = tts_cache.get(cache_key)
+        span['cache_hit'] = cached is not None
+        if cached is not None:
+            # Lấy từ bộ nhớ đệm: không gọi mạng và không cần độ trễ chống chặn
+            return cached
+    
+    sent = 0
+    
+    def send(block):
+        nonlocal sent
+        sent += len(block)
+        sink(block)
+    
+    throttled = errors = 0
+    while True:
+        # Bộ giới hạn tốc độ của backend (nếu có) thay cho độ trễ cố định sau mỗi yêu cầu
+        limiter = backend.acquire()
+        outcome = 'error'
+        retry_after = None
+        status = None
+        buffer = io.BytesIO() if sink is None else None
+        start = time.perf_counter()
+        try:
+            backend.synthesize_to(text, language, buffer.write if sink is None else send)
+            outcome = 'ok'
+        except TTSBackendError as e:
+            status, retry_after, error = e.status, e.retry_after, str(e)
+            if status in TTS_THROTTLE_STATUS_CODES:
+                outcome = 'throttled'
+        except requests.RequestException as e:
+            error = f"{type(e).__name__}: {str(e)}"
+        finally:
+            backend.release(limiter, outcome, retry_after, time.perf_counter() - start, len(text))
+        
+        report['attempts'] += 1
+        span['retries'] = report['attempts'] - 1
+        span['status'] = status
+        if outcome == 'ok':
+            break
+        if sent:
+            # Một phần âm thanh đã được ghi đi, không thể tải lại từ đầu
+            report['partial'] = True
+            error = f"{error} (sau {sent} bytes)"
+            break
+        if outcome == 'throttled':
+            # Bị giới hạn tốc độ: bộ giới hạn đã tự giảm tốc, không tính vào lượt thử lại của job
+            if throttled == TTS_THROTTLE_RETRIES:
+                break
+            throttled += 1
+            print(f"  - Bị giới hạn ({status}), thử lại lần {throttled}/{TTS_THROTTLE_RETRIES}...")
+            if limiter is None:
+                time.sleep(retry_after or 1.0)
+            continue
+        # Lỗi 4xx (trừ 429) là lỗi cố định, thử lại không giúp được
+        if (status is not None and 400 <= status < 500) or errors == TTS_CHUNK_RETRIES:
+            break
+        if budget is not None and not budget.take():
+            report['budget_exhausted'] = True
+            print(f"  - Lỗi ({error}), đã hết lượt thử lại của lần tạo âm thanh này")
+            break
+        delay = retry_backoff_delay(errors)
+        errors += 1
+        print(f"  - Lỗi ({error}), thử lại lần {errors}/{TTS_CHUNK_RETRIES} sau {delay:.1f} giây...")
+        time.sleep(delay)
+    
+    if outcome != 'ok':
+        report['error'] = f"{backend.name}: {error}"
+        print(f"  - Lỗi khi gọi {backend.name}: {error}")
+        return None if sink is None else 0
+    if sink is not None:
+        return sent
+    audio_bytes = buffer.getvalue()
+    if use_cache:
+        tts_cache.put(cache_key, audio_bytes)
+    return audio_bytes
+
+def print_rate_limiter_stats():
+    """In tốc độ hiện tại của bộ giới hạn TTS"""
+    limiter_stats = tts_rate_limiter.stats()
+    print(f"Giới hạn TTS: {limiter_stats['rate']} yêu cầu/giây, {limiter_stats['concurrency']} yêu cầu đồng thời "
+          f"({limiter_stats['throttled']} lần bị giới hạn)")
+
+def write_file_atomically(path, data):
+    """Ghi bytes vào file tạm cùng thư mục rồi đổi tên nguyên tử thành file đích"""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# Ghép MP3 theo khung: bỏ thẻ ID3 và khung Xing/Info của từng đoạn, ghi một khung Xing đúng cho cả file
+AUDIO_TARGET_SECONDS = 20 * 60   # Mục tiêu độ dài video
+MP3_TOC_SAMPLES = 512            # Số vị trí khung tối đa được giữ để dựng bảng tua (số chẵn, bộ nhớ cố định)
+
+_MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 25: (11025, 12000, 8000)}
+_MP3_VERSIONS = {3: 1, 2: 2, 0: 25}  # Bit phiên bản trong header → MPEG 1, 2, 2.5
+_XING_FLAGS = 0x0001 | 0x0002 | 0x0004  # Có số khung, số bytes và bảng tua
+_XING_DATA_SIZE = 4 + 4 + 4 + 4 + 100  # 'Xing' + cờ + số khung + số bytes + bảng tua
+
+def parse_mp3_frame_header(data, pos=0):
+    """Đọc header khung MP3 tại pos, trả về dict thông số khung hoặc None nếu không hợp lệ"""
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    version_bits, layer_bits = (b1 >> 3) & 3, (b1 >> 1) & 3
+    bitrate_index, sample_rate_index, padding = b2 >> 4, (b2 >> 2) & 3, (b2 >> 1) & 1
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    version = _MP3_VERSIONS[version_bits]
+    layer = 4 - layer_bits
+    bitrate = _MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    mono = (b3 >> 6) == 3
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    return {
+        'version': version,
+        'layer': layer,
+        'bitrate_index': bitrate_index,
+        'sample_rate': sample_rate,
+        'samples': samples,
+        'length': length,
+        'side_info': (17 if mono else 32) if version == 1 else (9 if mono else 17),
+        'header': bytes(data[pos:pos + 4]),
+    }
+
+def is_mp3_info_frame(data, pos, frame):
+    """Khung Xing/Info (LAME) hoặc VBRI (Fraunhofer) chỉ chứa thông tin, không chứa âm thanh"""
+    xing_pos = pos + 4 + frame['side_info']
+    return data[xing_pos:xing_pos + 4] in (b'Xing', b'Info') or data[pos + 36:pos + 40] == b'VBRI'
+
+def id3v2_tag_size(data, pos=0):
+    """Kích thước thẻ ID3v2 bắt đầu tại pos (kể cả header/footer), 0 nếu không có"""
+    if data[pos:pos + 3] != b'ID3' or pos + 10 > len(data):
+        return 0
+    size = 0
+    for byte in data[pos + 6:pos + 10]:
+        size = (size << 7) | (byte & 0x7F)
+    return 10 + size + (10 if data[pos + 5] & 0x10 else 0)
+
+class MP3FrameJoiner:
+    """Ghép các đoạn MP3 vào file đang mở theo từng khung, trong một lượt với bộ nhớ cố định
+    
+    Bỏ thẻ ID3v1/ID3v2 và khung Xing/Info/VBRI của từng đoạn, giữ chỗ một khung Xing ở đầu file
+    và ghi lại khi finish() với số khung, số bytes và bảng tua 100 điểm. Thời lượng được cộng
+    từ header của từng khung, không cần giải mã.
+    """
+    
+    def __init__(self, file, on_audio=None, info_frame=True):
+        self._file = file
+        self._on_audio = on_audio  # Nhận bản sao của từng dãy khung âm thanh ngay khi được ghi (phát dần)
+        self._info_frame = info_frame
+        self.frames = 0
+        self.audio_bytes = 0
+        self._samples = {}  # Số mẫu theo tần số lấy mẫu, để tính thời lượng chính xác
+        self._info_header = None
+        self._info_length = 0
+        self._bitrates = set()
+        self._offsets = []
+        self._stride = 1
+    
+    def write_chunk(self, data):
+        """Ghi các khung âm thanh của một đoạn MP3, trả về số bytes âm thanh đã ghi"""
+        written, _, _ = self._write_frames(data, True, True)
+        return written
+    
+    def write_stream(self, blocks):
+        """Ghi một đoạn MP3 đến theo từng khối (ví dụ iter_content), trả về số bytes âm thanh đã ghi
+        
+        Chỉ phần khung chưa trọn ở cuối mỗi khối được giữ lại để ghép với khối sau.
+        """
+        pending = b''
+        written = 0
+        first_frame = True
+        for block in blocks:
+            pending += block
+            count, pos, first_frame = self._write_frames(pending, first_frame, False)
+            written += count
+            pending = pending[pos:]
+        count, _, _ = self._write_frames(pending, first_frame, True)
+        return written + count
+    
+    def _write_frames(self, data, first_frame, final):
+        """Ghi các khung trọn vẹn trong data, trả về (số bytes đã ghi, vị trí đã xử lý đến, first_frame)
+        
+        Khi final là False, dữ liệu có thể còn tiếp: khung hoặc thẻ ID3v2 bị cắt ở cuối được để lại.
+        """
+        view = memoryview(data)
+        end = len(data)
+        if final and end >= 128 and data[end - 128:end - 125] == b'TAG':
+            end -= 128  # ID3v1 ở cuối đoạn
+        pos = 0
+        run_start = None
+        written = 0
+        while pos + 4 <= end:
+            frame = parse_mp3_frame_header(data, pos)
+            if frame is None or pos + frame['length'] > end:
+                if run_start is not None:
+                    written += self._emit(view[run_start:pos])
+                    run_start = None
+                tag_size = id3v2_tag_size(data, pos)
+                if tag_size:
+                    if pos + tag_size > end and not final:
+                        break
+                    pos += tag_size
+                elif frame is not None:
+                    break  # Khung cuối bị cắt dở (hoặc chưa đến hết)
                 else:
-                    if current_chunk:
-                        chunks.append(current_chunk.rstrip(', '))
-                    current_chunk = part + ', '
-            # Đảm bảo không bỏ sót phần cuối
-            if current_chunk:
-                chunks.append(current_chunk.rstrip(', '))
-                current_chunk = ""
-        elif len(current_chunk) + len(sentence) + 1 <= max_length:  # +1 cho khoảng trắng
-            current_chunk += sentence + ' '
-        else:
-            chunks.append(current_chunk.rstrip())
-            current_chunk = sentence + ' '
+                    # Mất đồng bộ: tìm byte đồng bộ tiếp theo
+                    pos = data.find(b'\xff', pos + 1, end)
+                    if pos < 0:
+                        pos = end
+                        break
+                continue
+            if first_frame and is_mp3_info_frame(data, pos, frame):
+                first_frame = False
+                pos += frame['length']
+                continue
+            first_frame = False
+            if self._info_header is None and self._info_frame:
+                self._reserve_info_frame(frame)
+            if run_start is None:
+                run_start = pos
+            self._add_frame(frame)
+            pos += frame['length']
+        if run_start is not None:
+            written += self._emit(view[run_start:pos])
+        return written, min(pos, end), first_frame
     
-    # Thêm phần còn lại nếu có
-    if current_chunk:
-        chunks.append(current_chunk.rstrip())
+    def _emit(self, run):
+        if self._on_audio:
+            self._on_audio(bytes(run))
+        return self._file.write(run)
     
-    return chunks
+    def _reserve_info_frame(self, frame):
+        # Dùng thông số của khung âm thanh đầu tiên, chọn bitrate nhỏ nhất đủ chứa dữ liệu Xing
+        needed = 4 + frame['side_info'] + _XING_DATA_SIZE
+        header = frame['header']
+        for bitrate_index in range(1, 15):
+            candidate = bytes((0xFF, header[1] | 0x01, (bitrate_index << 4) | (header[2] & 0x0C), header[3]))
+            info = parse_mp3_frame_header(candidate)
+            if info and info['length'] >= needed:
+                break
+        self._info_header = (candidate, info)
+        self._info_length = info['length']
+        self._file.write(bytes(self._info_length))
+    
+    def _add_frame(self, frame):
+        if self.frames % self._stride == 0:
+            self._offsets.append(self._info_length + self.audio_bytes)
+            if len(self._offsets) > MP3_TOC_SAMPLES:
+                # Giữ bộ nhớ cố định: bỏ một nửa số mẫu và tăng gấp đôi khoảng cách
+                self._offsets = self._offsets[::2]
+                self._stride *= 2
+        self.frames += 1
+        self.audio_bytes += frame['length']
+        self._samples[frame['sample_rate']] = self._samples.get(frame['sample_rate'], 0) + frame['samples']
+        self._bitrates.add(frame['bitrate_index'])
+    
+    @property
+    def duration(self):
+        """Tổng thời lượng (giây) của các khung đã ghi"""
+        return sum(samples / sample_rate for sample_rate, samples in self._samples.items())
+    
+    def finish(self):
+        """Ghi khung Xing/Info hoàn chỉnh vào chỗ đã giữ ở đầu file"""
+        if self._info_header is None:
+            return
+        header, info = self._info_header
+        total_bytes = self._info_length + self.audio_bytes
+        toc = bytes(min(255, self._offsets[min(len(self._offsets) - 1, i * self.frames // 100 // self._stride)] * 256 // total_bytes)
+                    for i in range(100))
+        body = bytearray(self._info_length)
+        body[0:4] = header
+        xing_pos = 4 + info['side_info']
+        tag = b'Info' if len(self._bitrates) == 1 else b'Xing'
+        body[xing_pos:xing_pos + _XING_DATA_SIZE] = tag + struct.pack('>III', _XING_FLAGS, self.frames, total_bytes) + toc
+        end = self._file.tell()
+        self._file.seek(0)
+        self._file.write(body)
+        self._file.seek(end)
 
-def text_to_speech_google(text, language='vi', save_timestamp=False):
-    """Convert text to speech using Google Translate TTS API (không chính thức)"""
-    if not text:
-        print("Nội dung văn bản trống. Không thể tạo giọng nói.")
+def join_mp3_parts(parts):
+    """Ghép âm thanh của nhiều phần thành một đoạn MP3 (chỉ các khung âm thanh, không có khung Xing)"""
+    buffer = io.BytesIO()
+    joiner = MP3FrameJoiner(buffer, info_frame=False)
+    for part in parts:
+        joiner.write_chunk(part)
+    return buffer.getvalue()
+
+def read_mp3_duration(path):
+    """Thời lượng (giây) của file MP3 từ khung Xing/Info, hoặc cộng header từng khung nếu không có"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(10)
+            pos = id3v2_tag_size(head)
+            f.seek(pos)
+            first = f.read(4 + 32 + 12)
+            frame = parse_mp3_frame_header(first)
+            if frame and is_mp3_info_frame(first, 0, frame):
+                xing_pos = 4 + frame['side_info']
+                flags, frames = struct.unpack('>II', first[xing_pos + 4:xing_pos + 12])
+                if flags & 0x0001:
+                    return frames * frame['samples'] / frame['sample_rate']
+            duration = 0.0
+            while True:
+                f.seek(pos)
+                header = f.read(4)
+                frame = parse_mp3_frame_header(header)
+                if frame is None:
+                    return duration
+                duration += frame['samples'] / frame['sample_rate']
+                pos += frame['length']
+    except OSError:
         return None
+
+def format_duration(seconds):
+    """Định dạng số giây thành mm:ss"""
+    minutes, secs = divmod(int(round(seconds)), 60)
+    return f"{minutes}:{secs:02d}"
+
+def print_audio_duration(seconds):
+    """In thời lượng âm thanh và so với mục tiêu AUDIO_TARGET_SECONDS"""
+    status = "đạt" if seconds >= AUDIO_TARGET_SECONDS else "chưa đạt"
+    print(f"Thời lượng âm thanh: {format_duration(seconds)} ({status} mục tiêu {format_duration(AUDIO_TARGET_SECONDS)})")
+
+# Phát dần: nghe âm thanh qua một luồng HTTP cục bộ trong khi các đoạn còn đang được tạo
+PROGRESSIVE_HOST = "127.0.0.1"   # Cổng được hệ điều hành chọn ngẫu nhiên cho mỗi lần tạo
+PROGRESSIVE_PLAYERS = (          # Trình phát đầu tiên có trong PATH sẽ được dùng; URL luồng được thêm vào cuối lệnh
+    ('mpg123', '-q'),
+    ('ffplay', '-nodisp', '-autoexit', '-loglevel', 'quiet'),
+    ('mpv', '--no-video', '--really-quiet'),
+    ('cvlc', '--play-and-exit', '--quiet'),
+)
+PROGRESSIVE_MAX_BUFFER_BYTES = 4 * 1024 * 1024   # Dữ liệu giữ lại khi chưa có trình phát nào kết nối (~4 phút ở 128 kbps)
+
+def find_stream_player():
+    """Lệnh của trình phát đầu tiên trong PROGRESSIVE_PLAYERS có trong PATH, hoặc None"""
+    for command in PROGRESSIVE_PLAYERS:
+        if shutil.which(command[0]):
+            return list(command)
+    return None
+
+class AudioStream:
+    """Các khung MP3 của một lần tạo âm thanh, theo đúng thứ tự ghi vào file
+    
+    Người nghe chờ cho đến khi có thêm dữ liệu hoặc luồng kết thúc, nên không bao giờ phát
+    vượt quá phần đã tạo. Khối nào mọi người nghe đã nhận thì được giải phóng; khi chưa có ai nghe,
+    chỉ giữ tối đa PROGRESSIVE_MAX_BUFFER_BYTES dữ liệu mới nhất cho trình phát kết nối muộn.
+    """
+    
+    def __init__(self, on_start=None, max_buffer_bytes=None):
+        self._blocks = deque()
+        self._base = 0          # Vị trí (tính từ đầu luồng) của khối đầu tiên còn giữ
+        self._readers = {}      # Người nghe → vị trí khối tiếp theo cần nhận
+        self._closed = False
+        self._condition = threading.Condition()
+        self._on_start = on_start
+        self.max_buffer_bytes = PROGRESSIVE_MAX_BUFFER_BYTES if max_buffer_bytes is None else max_buffer_bytes
+        self.bytes_fed = 0
+        self.buffered_bytes = 0
+        self.peak_buffered_bytes = 0
+    
+    def feed(self, data):
+        with self._condition:
+            first = not self.bytes_fed
+            self._blocks.append(data)
+            self.bytes_fed += len(data)
+            self.buffered_bytes += len(data)
+            self.peak_buffered_bytes = max(self.peak_buffered_bytes, self.buffered_bytes)
+            self._trim()
+            self._condition.notify_all()
+        if first and self._on_start:
+            self._on_start(self)
+    
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+    
+    def attach(self):
+        """Đăng ký một người nghe, bắt đầu từ khối cũ nhất còn giữ; trả về mã người nghe"""
+        reader = object()
+        with self._condition:
+            self._readers[reader] = self._base
+        return reader
+    
+    def detach(self, reader):
+        with self._condition:
+            self._readers.pop(reader, None)
+            self._trim()
+    
+    def read_blocks(self, reader):
+        """Chờ các khối mà người nghe chưa nhận, trả về (danh sách khối, luồng đã kết thúc)"""
+        with self._condition:
+            while self._readers[reader] >= self._base + len(self._blocks) and not self._closed:
+                self._condition.wait()
+            blocks = list(itertools.islice(self._blocks, self._readers[reader] - self._base, None))
+            self._readers[reader] += len(blocks)
+            self._trim()
+            return blocks, self._closed
+    
+    def _trim(self):
+        # Giải phóng các khối mọi người nghe đã nhận; khi không có ai nghe, bỏ khối cũ nhất nếu vượt giới hạn
+        if self._readers:
+            keep_from = min(self._readers.values())
+            while self._base < keep_from:
+                self._drop_oldest()
+        else:
+            while len(self._blocks) > 1 and self.buffered_bytes > self.max_buffer_bytes:
+                self._drop_oldest()
+    
+    def _drop_oldest(self):
+        self.buffered_bytes -= len(self._blocks.popleft())
+        self._base += 1
+
+class AudioStreamHandler(BaseHTTPRequestHandler):
+    """Phục vụ luồng hiện tại của ProgressivePlayer tại /stream.mp3 (HTTP/1.0, kết thúc khi đóng kết nối)"""
+    
+    def do_GET(self):
+        stream = self.server.player.stream
+        if urllib.parse.urlsplit(self.path).path != '/stream.mp3' or stream is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        reader = stream.attach()
+        try:
+            while True:
+                blocks, closed = stream.read_blocks(reader)
+                for block in blocks:
+                    self.wfile.write(block)
+                if closed:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Trình phát đã đóng
+        finally:
+            stream.detach(reader)
+    
+    def log_message(self, format, *args):
+        pass
+
+class ProgressivePlayer:
+    """Phát âm thanh đang được tạo ngay từ đoạn đầu tiên, qua http://127.0.0.1:<cổng>/stream.mp3
+    
+    Mỗi OrderedAudioWriter mở một luồng mới (open_stream); máy chủ và trình phát chỉ được khởi động
+    khi luồng có dữ liệu đầu tiên. Nếu luồng trước bị hủy (ví dụ chế độ luồng chuyển sang chế độ thường),
+    trình phát cũ bị dừng và mở lại trên luồng mới. Không có trình phát nào thì in URL để tự mở.
+    """
+    
+    def __init__(self):
+        self.command = find_stream_player()
+        self.stream = None
+        self.process = None
+        self._server = None
+        self._lock = threading.Lock()
+    
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/stream.mp3"
+    
+    def open_stream(self):
+        stream = AudioStream(on_start=self._start)
+        with self._lock:
+            if self.stream:
+                self.stream.close()
+            self.stream = stream
+        return stream
+    
+    def _start(self, stream):
+        with self._lock:
+            if stream is not self.stream:
+                return
+            if self._server is None:
+                self._server = ThreadingHTTPServer((PROGRESSIVE_HOST, 0), AudioStreamHandler)
+                self._server.daemon_threads = True
+                self._server.player = self
+                threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            if self.process and self.process.poll() is None:
+                self.process.terminate()
+            if not self.command:
+                print(f"{Colors.YELLOW}Không tìm thấy mpg123, ffplay, mpv hoặc vlc. "
+                      f"Mở {self.url} bằng trình phát bất kỳ để nghe trong khi đang tạo.{Colors.ENDC}")
+                return
+            print(f"{Colors.CYAN}Bắt đầu phát dần với {self.command[0]}: {self.url}{Colors.ENDC}")
+            try:
+                self.process = subprocess.Popen(self.command + [self.url], stdin=subprocess.DEVNULL,
+                                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                print(f"{Colors.RED}Không thể mở trình phát {self.command[0]}: {str(e)}{Colors.ENDC}")
+    
+    def finish(self):
+        """Kết thúc luồng hiện tại; máy chủ dừng sau khi trình phát phát xong"""
+        with self._lock:
+            if self.stream:
+                self.stream.close()
+            server, process = self._server, self.process
+        if server is None:
+            return
         
-    # Ensure the text has a minimum length by adding spaces if needed
-    text = text.strip()
-    if len(text) < 10:
-        print(f"Cảnh báo: Văn bản quá ngắn ({len(text)} ký tự), thêm nội dung đệm.")
-        # Add padding text in Vietnamese to meet minimum requirements
-        padding = "Đây là nội dung được tạo tự động bởi Gemini. "
-        text = padding + text
+        def stop():
+            if process:
+                process.wait()
+            server.shutdown()
+            server.server_close()
+        threading.Thread(target=stop, daemon=True).start()
+
+# Trình phát dần của lần tạo âm thanh trên luồng hiện tại, hoặc None
+_progressive_player = contextvars.ContextVar('progressive_player', default=None)
+
+def play_progressively(render, *args, **kwargs):
+    """Gọi render(*args, **kwargs) và phát âm thanh nó tạo ra ngay từ đoạn đầu tiên"""
+    player = ProgressivePlayer()
+    token = _progressive_player.set(player)
+    try:
+        return render(*args, **kwargs)
+    finally:
+        _progressive_player.reset(token)
+        player.finish()
+
+class OrderedAudioWriter:
+    """Ghi các đoạn âm thanh theo đúng thứ tự ngay khi có, vào file tạm cạnh file đích
     
-    print(f"Độ dài văn bản để chuyển thành giọng nói: {len(text)} ký tự")
+    Các đoạn về sớm được giữ trong bộ nhớ cho đến khi các đoạn trước đó được ghi.
+    Các đoạn được ghép theo khung MP3 (MP3FrameJoiner) nên file cuối có một header Xing đúng.
+    commit() đổi tên nguyên tử file tạm thành file đích, nên không có file từng đoạn
+    và các lần chạy song song không dùng chung thư mục tạm.
+    Khi đang phát dần (play_progressively), các khung cũng được gửi vào luồng phát ngay khi ghi.
+    """
+    
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.temp_file = f"{output_file}.{os.getpid()}.{threading.get_ident()}.part"
+        self.chunks_written = 0
+        self.bytes_written = 0
+        self.duration = 0.0
+        self._file = open(self.temp_file, 'wb')
+        player = _progressive_player.get()
+        self._stream = player.open_stream() if player else None
+        self._joiner = MP3FrameJoiner(self._file, self._stream.feed if self._stream else None)
+        self._pending = {}
+        self._next_index = 0
+        self._lock = threading.Lock()
+    
+    def add(self, index, audio_bytes):
+        """Nhận kết quả của đoạn thứ index (None nếu đoạn bị lỗi hoặc bỏ qua)"""
+        with self._lock:
+            self._pending[index] = audio_bytes
+            while self._next_index in self._pending:
+                self._write(self._pending.pop(self._next_index))
+                self._next_index += 1
+    
+    def add_stream(self, index, blocks):
+        """Ghi đoạn thứ index từ các khối bytes ngay khi chúng đến, trả về số bytes âm thanh đã ghi
+        
+        Mọi đoạn trước index phải đã được nhận (add hoặc add_stream).
+        """
+        with self._lock:
+            if index != self._next_index:
+                raise ValueError(f"Đoạn {index} đến trước đoạn {self._next_index}")
+            written = self._joiner.write_stream(blocks)
+            if written:
+                self.chunks_written += 1
+                self.bytes_written += written
+            self._next_index += 1
+            while self._next_index in self._pending:
+                self._write(self._pending.pop(self._next_index))
+                self._next_index += 1
+            return written
+    
+    def _write(self, audio_bytes):
+        if audio_bytes:
+            written = self._joiner.write_chunk(audio_bytes)
+            if written:
+                self.chunks_written += 1
+                self.bytes_written += written
+            else:
+                print("  - Cảnh báo: Bỏ qua một đoạn không chứa khung MP3 hợp lệ")
+    
+    def commit(self):
+        """Ghi các đoạn còn lại và thay thế file đích, trả về True nếu thành công"""
+        with self._lock, trace_span('assemble_audio', 'audio') as span:
+            span['pending_chunks'] = len(self._pending)
+            for index in sorted(self._pending):
+                self._write(self._pending.pop(index))
+            self._close_stream()
+            try:
+                self._joiner.finish()
+                self._file.close()
+                if not self.chunks_written:
+                    os.remove(self.temp_file)
+                    return False
+                os.replace(self.temp_file, self.output_file)
+                self.duration = self._joiner.duration
+                span.update(chunks=self.chunks_written, frames=self._joiner.frames, bytes=self.bytes_written,
+                            duration_s=round(self.duration, 3))
+                return True
+            except OSError as e:
+                print(f"Lỗi khi hoàn tất file âm thanh: {str(e)}")
+                if os.path.exists(self.temp_file):
+                    os.remove(self.temp_file)
+                return False
+    
+    def abort(self):
+        """Hủy ghi và xóa file tạm"""
+        with self._lock:
+            self._close_stream()
+            self._file.close()
+            if os.path.exists(self.temp_file):
+                os.remove(self.temp_file)
+    
+    def _close_stream(self):
+        if self._stream:
+            self._stream.close()
+
+class SpooledDownload:
+    """Dữ liệu của một lần tải đang diễn ra, đọc được trong khi vẫn đang tải
+    
+    Giữ tối đa max_memory bytes trong bộ nhớ, phần còn lại nằm trong file tạm không tên (tự xóa khi đóng).
+    Dùng cho một luồng ghi (write, finish) và một luồng đọc (iter_blocks).
+    """
+    
+    def __init__(self, max_memory):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._size = 0
+        self._done = False
+        self._condition = threading.Condition()
+    
+    def write(self, data):
+        with self._condition:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self._size += len(data)
+            self._condition.notify_all()
+    
+    def finish(self):
+        with self._condition:
+            self._done = True
+            self._condition.notify_all()
+    
+    def iter_blocks(self, block_size):
+        """Các khối dữ liệu theo thứ tự, chờ khi đọc kịp phần đã tải, dừng khi tải xong"""
+        offset = 0
+        while True:
+            with self._condition:
+                while offset >= self._size and not self._done:
+                    self._condition.wait()
+                if offset >= self._size:
+                    return
+                self._file.seek(offset)
+                block = self._file.read(min(block_size, self._size - offset))
+            offset += len(block)
+            yield block
+    
+    def close(self):
+        self._file.close()
+
+class ChunkDeduplicator:
+    """Gom các đoạn giống hệt nhau trong một lần tạo âm thanh: mỗi đoạn duy nhất chỉ tải một lần
+    
+    Kết quả tải được ghi vào OrderedAudioWriter tại mọi vị trí đoạn đó xuất hiện, kể cả các vị trí
+    được đăng ký sau khi đoạn đã tải xong (chế độ luồng). on_write(index, chunk, audio_bytes, info, duplicate_of)
+    được gọi cho mỗi vị trí được ghi; duplicate_of là vị trí của lần xuất hiện đầu tiên (None cho chính nó).
+    """
+    
+    def __init__(self, writer, on_write=None):
+        self._writer = writer
+        self._on_write = on_write
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.total = 0
+        self.unique = 0
     
+    @property
+    def saved(self):
+        return self.total - self.unique
+    
+    def add(self, index, chunk):
+        """Đăng ký đoạn thứ index; trả về True nếu cần tải, False nếu dùng lại kết quả của đoạn trùng"""
+        with self._lock:
+            self.total += 1
+            entry = self._entries.get(chunk)
+            if entry is None:
+                self._entries[chunk] = {'indices': [index], 'done': False, 'audio': None, 'info': None}
+                self.unique += 1
+                return True
+            if not entry['done']:
+                entry['indices'].append(index)
+                return False
+        self._write(index, chunk, entry, entry['indices'][0])
+        return False
+    
+    def resolve(self, chunk, audio_bytes, info=None, written=None):
+        """Ghi kết quả tải của đoạn (None nếu lỗi) vào mọi vị trí của nó; info là thông tin lần tải (số lần gọi, độ trễ)
+        
+        written là vị trí mà người gọi đã tự ghi vào writer (add_stream): chỉ gọi on_write cho vị trí đó.
+        """
+        with self._lock:
+            entry = self._entries[chunk]
+            entry['done'] = True
+            entry['audio'] = audio_bytes
+            entry['info'] = info
+            indices = list(entry['indices'])
+        for index in indices:
+            self._write(index, chunk, entry, indices[0], index == written)
+    
+    def _write(self, index, chunk, entry, first, written=False):
+        if not written:
+            self._writer.add(index, entry['audio'])
+        if self._on_write:
+            self._on_write(index, chunk, entry['audio'], entry['info'], None if index == first else first)
+    
+    def report(self):
+        if self.saved:
+            print(f"Đã bỏ qua {self.saved} yêu cầu TTS trùng lặp ({self.unique} đoạn duy nhất / {self.total} đoạn)")
+
+class ChunkManifest:
+    """Bảng kê từng đoạn của một lần tạo âm thanh: thành công hay lỗi, số lần gọi, độ trễ, nguồn
+    
+    Quy tắc chấp nhận: đủ mọi đoạn là complete; thiếu không quá TTS_MAX_MISSING_RATIO số đoạn là gaps
+    (vẫn tạo file, có cảnh báo và danh sách đoạn thiếu); thiếu nhiều hơn là failed (không tạo file).
+    Bảng kê được lưu cạnh file âm thanh: <tên>.manifest.json.
+    """
+    
+    def __init__(self, output_file, chunks=0):
+        self.output_file = output_file
+        self.path = manifest_path(output_file)
+        self.budget = RetryBudget(chunks)
+        self._entries = {}
+        self._lock = threading.Lock()
+    
+    def record(self, index, chunk, audio_bytes, info=None, duplicate_of=None, source='fetched', size=None):
+        """Ghi kết quả của một đoạn; size thay cho len(audio_bytes) khi âm thanh đã được ghi thẳng vào file"""
+        info = info or {}
+        size = len(audio_bytes or b'') if size is None else size
+        entry = {
+            'index': index,
+            'chars': len(chunk),
+            'status': 'ok' if size else 'failed',
+            'bytes': size,
+            'source': source if duplicate_of is None else 'duplicate',
+            'attempts': info.get('attempts', 0) if duplicate_of is None else 0,
+            'latency_s': round(info.get('latency_s', 0.0), 3),
+            'error': info.get('error'),
+            'backend': info.get('backend'),
+        }
+        if duplicate_of is not None:
+            entry['duplicate_of'] = duplicate_of
+        with self._lock:
+            self._entries[index] = entry
+    
+    def decide(self):
+        """Trả về (trạng thái, danh sách vị trí đoạn bị thiếu) theo quy tắc chấp nhận"""
+        with self._lock:
+            total = len(self._entries)
+            missing = sorted(index for index, entry in self._entries.items() if entry['status'] != 'ok')
+        if not total or len(missing) == total:
+            return 'failed', missing
+        if not missing:
+            return 'complete', missing
+        return ('gaps' if len(missing) <= TTS_MAX_MISSING_RATIO * total else 'failed'), missing
+    
+    def finish(self):
+        """Áp dụng quy tắc, lưu bảng kê và in kết quả; trả về complete, gaps hoặc failed"""
+        status, missing = self.decide()
+        with self._lock:
+            entries = [self._entries[index] for index in sorted(self._entries)]
+        latencies = [entry['latency_s'] for entry in entries if entry['source'] == 'fetched']
+        backends = {}
+        for entry in entries:
+            if entry['backend'] and entry['source'] == 'fetched':
+                backends[entry['backend']] = backends.get(entry['backend'], 0) + 1
+        manifest = {
+            'output_file': self.output_file,
+            'created_at': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'status': status,
+            'chunks': len(entries),
+            'ok': len(entries) - len(missing),
+            'missing': missing,
+            'max_missing_ratio': TTS_MAX_MISSING_RATIO,
+            'retries': {'used': self.budget.used, 'limit': self.budget.limit},
+            'backends': backends,
+            'latency_s': {
+                'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+                'max': max(latencies) if latencies else None,
+            },
+            'entries': entries,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            write_file_atomically(self.path, json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+        except OSError as e:
+            print(f"Cảnh báo: Không thể lưu bảng kê đoạn âm thanh: {str(e)}")
+        
+        positions = ', '.join(str(index + 1) for index in missing[:20]) + (', ...' if len(missing) > 20 else '')
+        if status == 'gaps':
+            print(f"{Colors.YELLOW}Cảnh báo: Thiếu {len(missing)}/{len(entries)} đoạn (#{positions}) sau khi thử lại; "
+                  f"vẫn tạo file vì không quá {TTS_MAX_MISSING_RATIO:.0%} số đoạn{Colors.ENDC}")
+        elif status == 'failed':
+            print(f"{Colors.RED}Lỗi: Thiếu {len(missing)}/{len(entries)} đoạn (#{positions}), vượt quá "
+                  f"{TTS_MAX_MISSING_RATIO:.0%} số đoạn; hủy file âm thanh{Colors.ENDC}")
+        if len(backends) > 1:
+            print(f"Các đoạn đã tải theo backend: {', '.join(f'{name} {count}' for name, count in backends.items())}")
+        print(f"Bảng kê đoạn âm thanh: {self.path} (đã dùng {self.budget.used}/{self.budget.limit} lượt thử lại)")
+        return status
+
+def manifest_path(output_file):
+    return f"{os.path.splitext(output_file)[0]}.manifest.json"
+
+def prepare_audio_output(save_timestamp=False, output_name=None):
+    """Tạo thư mục audio và trả về (audio_dir, output_file) cho file âm thanh đầu ra"""
     # Create audio directory if it doesn't exist
     try:
         audio_dir = os.path.join(os.getcwd(), "audio")
@@ -220,33 +2814,21 @@ def text_to_speech_google(text, language='vi', save_timestamp=False):
     # Define output filename
     base_filename = "gemini_latest_speech"
     
-    if save_timestamp:
+    if output_name:
+        output_file = os.path.join(audio_dir, f"{output_name}.mp3")
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    elif save_timestamp:
         # Add timestamp to filename to avoid overwriting
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         output_file = os.path.join(audio_dir, f"{base_filename}_{timestamp}.mp3")
     else:
         output_file = os.path.join(audio_dir, f"{base_filename}.mp3")
     
-    # Remove existing file if not using timestamp and it exists
-    if not save_timestamp and os.path.exists(output_file):
-        try:
-            os.remove(output_file)
-            print(f"Đã xóa file âm thanh cũ: {output_file}")
-        except Exception as e:
-            print(f"Cảnh báo: Không thể xóa file âm thanh cũ: {str(e)}")
-    
-    # Add speech breaks to make the voice more natural
-    processed_text = text
-    # Add pauses after sentences to make speech more natural
-    processed_text = re.sub(r'([.!?]) ', r'\1... ', processed_text)
-    # Add slight pauses at commas
-    processed_text = processed_text.replace(', ', ', ... ')
-    # Add pauses at line breaks, but not for multiple consecutive line breaks
-    processed_text = re.sub(r'(?<!\n)\n(?!\n)', '... ', processed_text)
-    # Remove any unnecessary multiple pauses
-    processed_text = re.sub(r'\.{3,}', '...', processed_text)
-    
-    # Detect language (default to Vietnamese)
+    # File cũ (nếu có) được giữ nguyên cho đến khi file mới hoàn tất và thay thế nguyên tử
+    return audio_dir, output_file
+
+def detect_speech_language(text, language='vi'):
+    """Phát hiện ngôn ngữ của văn bản để chọn giọng đọc"""
     detected_language = language
     if any(ord(c) > 127 for c in text):
         # Contains non-ASCII chars, likely Vietnamese
@@ -256,131 +2838,210 @@ def text_to_speech_google(text, language='vi', save_timestamp=False):
         # Likely English
         detected_language = 'en'
         print("Sử dụng giọng tiếng Anh")
+    return detected_language
+
+def render_elevenlabs_audio(text, language, output_file):
+    """Tạo file âm thanh bằng ElevenLabs với các đoạn lớn (ELEVENLABS_MAX_CHARS), ghi ra đĩa ngay khi dữ liệu đến
+    
+    Tối đa ELEVENLABS_MAX_CONCURRENCY đoạn cho mỗi khóa trong elevenlabs_keys được tải cùng lúc qua endpoint streaming. Đoạn đến lượt được ghi
+    thẳng vào file đích theo từng khối, các đoạn sau chờ trong SpooledDownload, nên bộ nhớ dùng không phụ thuộc
+    độ dài kịch bản. Đoạn lỗi được chuyển sang backend khác như mọi đoạn TTS (fetch_tts_chunk).
+    Như text_to_speech_google, đoạn trùng chỉ tải một lần và job ở chế độ dịch vụ tiếp tục từ đoạn chưa xong;
+    chỉ khi đó âm thanh của đoạn mới được giữ lại trong bộ nhớ. Trả về đường dẫn file hoặc None.
+    """
+    chunks = split_text_into_chunks(text, ELEVENLABS_MAX_CHARS)
+    print(f"ElevenLabs: đã chia văn bản thành {len(chunks)} đoạn (tối đa {ELEVENLABS_MAX_CHARS} ký tự mỗi đoạn).")
+    manifest = ChunkManifest(output_file, len(chunks))
+    
+    def download(index):
+        report = {}
+        start = time.perf_counter()
+        try:
+            print(f"Đang tải đoạn {index+1}/{len(chunks)} ({len(chunks[index])} ký tự)...")
+            fetch_tts_chunk(chunks[index], language, manifest.budget, report, sink=spools[index].write)
+        except Exception as chunk_error:
+            print(f"  - Lỗi khi xử lý đoạn {index+1}: {str(chunk_error)}")
+            report['error'] = str(chunk_error)
+        finally:
+            spools[index].finish()
+        report['latency_s'] = time.perf_counter() - start
+        return report
+    
+    def record_chunk(index, chunk, audio_bytes, info, duplicate_of):
+        job_record_chunk(index, audio_bytes)
+        # Đoạn ghi thẳng vào file không giữ bytes: kích thước lấy từ 'written'; đoạn bị cắt giữa chừng tính là thiếu
+        manifest.record(index, chunk, audio_bytes, info, duplicate_of,
+                        size=None if audio_bytes else (info or {}).get('written', 0))
     
+    def collect(blocks, parts):
+        for block in blocks:
+            parts.append(block)
+            yield block
+    
+    # Job ở chế độ dịch vụ: các đoạn đã tải xong ở lần chạy trước được lấy lại từ kho job
+    resumed = job_start_chunks(chunks)
+    if resumed:
+        print(f"Tiếp tục job: dùng lại {len(resumed)}/{len(chunks)} đoạn đã tải ở lần chạy trước")
+    keep_audio = _current_job.get() is not None
+    writer = OrderedAudioWriter(output_file)
+    dedup = ChunkDeduplicator(writer, record_chunk)
+    fetched = []
+    for index, chunk in enumerate(chunks):
+        if index in resumed:
+            writer.add(index, resumed[index])
+            manifest.record(index, chunk, resumed[index], source='resumed')
+        elif dedup.add(index, chunk):
+            fetched.append(index)
+    spools = {index: SpooledDownload(ELEVENLABS_SPOOL_MEMORY_BYTES) for index in fetched}
+    executor = ThreadPoolExecutor(max_workers=max(1, min(ELEVENLABS_MAX_CONCURRENCY * len(elevenlabs_keys), len(fetched))))
     try:
-        # Process with Google Translate TTS API
-        print(f"Đang chuyển đổi văn bản thành giọng nói với Google Translate TTS (ngôn ngữ: {detected_language})...")
+        futures = {index: submit_traced(executor, download, index) for index in fetched}
+        for index in fetched:
+            chunk = chunks[index]
+            # Các vị trí trước đó (đã tiếp tục, trùng) đã nằm trong writer nên đoạn này đến lượt ghi thẳng vào file
+            parts = [] if keep_audio or chunks.count(chunk) > 1 else None
+            blocks = spools[index].iter_blocks(ELEVENLABS_STREAM_BLOCK_BYTES)
+            written = writer.add_stream(index, blocks if parts is None else collect(blocks, parts))
+            report = futures[index].result()
+            spools[index].close()
+            report['written'] = 0 if report.get('error') else written
+            audio_bytes = b''.join(parts) if parts is not None and report['written'] else None
+            dedup.resolve(chunk, audio_bytes, report, written=index)
+            if not report.get('error'):
+                print(f"  - Đã ghi đoạn {index+1}/{len(chunks)} ({written // 1024} KB)")
+    except Exception:
+        executor.shutdown(wait=False, cancel_futures=True)
+        writer.abort()
+        raise
+    executor.shutdown()
+    dedup.report()
+    
+    if manifest.finish() == 'failed':
+        writer.abort()
+        return None
+    if not writer.commit():
+        return None
+    print(f"Đã tạo file âm thanh: {output_file} ({writer.chunks_written}/{len(chunks)} đoạn, "
+          f"{writer.bytes_written // 1024} KB)")
+    print_audio_duration(writer.duration)
+    return output_file
+
+def text_to_speech_google(text, language='vi', save_timestamp=False, max_workers=None, output_name=None):
+    """Convert text to speech using the TTS backends (mặc định Google Translate TTS không chính thức)
+    
+    Mỗi đoạn dùng backend đang được xếp hạng tốt nhất và tự chuyển sang backend khác nếu lỗi (tts_backends).
+    Khi ElevenLabs đứng đầu, văn bản được tạo bằng render_elevenlabs_audio với các đoạn lớn.
+    max_workers giới hạn số đoạn được tải song song (mặc định TTS_MAX_WORKERS).
+    output_name đặt tên file riêng thay cho gemini_latest_speech.
+    """
+    if not text:
+        print("Nội dung văn bản trống. Không thể tạo giọng nói.")
+        return None
+        
+    # Ensure the text has a minimum length by adding spaces if needed
+    text = text.strip()
+    if len(text) < 10:
+        print(f"Cảnh báo: Văn bản quá ngắn ({len(text)} ký tự), thêm nội dung đệm.")
+        # Add padding text in Vietnamese to meet minimum requirements
+        padding = "Đây là nội dung được tạo tự động bởi Gemini. "
+        text = padding + text
+    
+    print(f"Độ dài văn bản để chuyển thành giọng nói: {len(text)} ký tự")
+    
+    audio_dir, output_file = prepare_audio_output(save_timestamp, output_name)
+    
+    # Detect language (default to Vietnamese)
+    detected_language = detect_speech_language(text, language)
+    
+    try:
+        ranked = tts_backends.rank()
+        print(f"Đang chuyển đổi văn bản thành giọng nói với {', '.join(backend.name for backend in ranked) or 'không có backend nào'} "
+              f"(ngôn ngữ: {detected_language})...")
         
         # Make sure the output directory exists
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
         
-        # Create a temporary directory for chunks
-        temp_dir = os.path.join(audio_dir, "temp_chunks")
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
-        
-        # Split text into manageable chunks (Google Translate TTS has ~200 char limit)
-        MAX_CHARS = 200
+        if ranked and ranked[0].name == 'elevenlabs':
+            return render_elevenlabs_audio(text, detected_language, output_file)
         
-        chunks = split_text_into_chunks(processed_text, MAX_CHARS)
+        # Split text into chunks sized for the best-ranked backend (Google Translate TTS has a ~200 char limit);
+        # speech pauses only fill the characters left over in each chunk
+        chunks = split_text_into_chunks(text, tts_backends.chunk_limit(), pauses=True)
         print(f"Đã chia văn bản thành {len(chunks)} đoạn để xử lý.")
         
-        chunk_files = []
-        success = False
+        workers = max(1, min(max_workers or TTS_MAX_WORKERS, len(set(chunks))))
+        if workers > 1:
+            print(f"Tải song song tối đa {workers} đoạn cùng lúc...")
         
-        # Process each chunk with Google Translate TTS
-        for i, chunk in enumerate(chunks):
-            if not chunk.strip():
-                continue
-                
+        # Each chunk is retried with backoff inside fetch_tts_chunk; the manifest records the outcome of every position
+        manifest = ChunkManifest(output_file, len(chunks))
+        
+        def process_chunk(i, chunk):
             print(f"Đang xử lý đoạn {i+1}/{len(chunks)} ({len(chunk)} ký tự)...")
-            chunk_file = os.path.join(temp_dir, f"chunk_{i+1}.mp3")
-            
+            report = {}
+            start = time.perf_counter()
+            audio_bytes = None
             try:
-                # URL không chính thức của Google Translate TTS
-                url = f"https://translate.google.com/translate_tts?ie=UTF-8&client=tw-ob&tl={detected_language}&q={urllib.parse.quote(chunk)}"
-                
-                # Thêm User-Agent để tránh bị chặn
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                    'Referer': 'https://translate.google.com/'
-                }
-                
-                response = requests.get(url, headers=headers)
-                
-                if response.status_code == 200:
-                    with open(chunk_file, 'wb') as f:
-                        f.write(response.content)
-                    
-                    if os.path.exists(chunk_file) and os.path.getsize(chunk_file) > 0:
-                        chunk_files.append(chunk_file)
-                        print(f"  - Đã tạo đoạn {i+1}")
-                    else:
-                        print(f"  - Lỗi: File đoạn {i+1} không được tạo hoặc trống")
-                else:
-                    print(f"  - Lỗi khi gọi API: {response.status_code}")
-                
-                # Thêm độ trễ để tránh bị chặn
-                time.sleep(0.5)
-                
+                audio_bytes = fetch_tts_chunk(chunk, detected_language, manifest.budget, report)
+                if audio_bytes:
+                    print(f"  - Đã tạo đoạn {i+1}")
             except Exception as chunk_error:
                 print(f"  - Lỗi khi xử lý đoạn {i+1}: {str(chunk_error)}")
+                report['error'] = str(chunk_error)
                 # Continue with other chunks
+            report['latency_s'] = time.perf_counter() - start
+            return audio_bytes, report
         
-        if not chunk_files:
-            print("Không thể tạo bất kỳ phần âm thanh nào. Thử phương pháp đơn giản hơn...")
-            # Fallback to standard gTTS if available
-            if GTTS_AVAILABLE:
-                try:
-                    print("Thử sử dụng gTTS làm phương án dự phòng...")
-                    tts = gTTS(text="Xin chào. Không thể tạo âm thanh với Google Translate TTS. Đây là phương án dự phòng.", 
-                              lang=detected_language, slow=False)
-                    tts.save(output_file)
-                    print(f"Đã tạo file âm thanh đơn giản: {output_file}")
-                    success = True
-                except Exception as simple_e:
-                    print(f"Không thể tạo được file âm thanh: {str(simple_e)}")
-                    return None
-            else:
-                print("Không thể tạo file âm thanh và gTTS không khả dụng.")
-                return None
-        else:
-            # Combine all chunks into a single file
-            print(f"Đang kết hợp {len(chunk_files)} đoạn thành file âm thanh hoàn chỉnh...")
-            
-            try:
-                # Simple file concatenation
-                with open(output_file, 'wb') as outfile:
-                    for chunk_file in chunk_files:
-                        if os.path.exists(chunk_file):
-                            with open(chunk_file, 'rb') as infile:
-                                outfile.write(infile.read())
-                
-                print(f"Đã tạo file âm thanh kết hợp: {output_file}")
-                success = True
-            except Exception as combine_error:
-                print(f"Lỗi khi kết hợp các file: {str(combine_error)}")
-                # If combining fails, try to copy at least the first chunk
-                if chunk_files and os.path.exists(chunk_files[0]):
-                    try:
-                        import shutil
-                        shutil.copy2(chunk_files[0], output_file)
-                        print(f"Đã sao chép đoạn đầu tiên làm file âm thanh: {output_file}")
-                        success = True
-                    except Exception as copy_error:
-                        print(f"Lỗi khi sao chép file: {str(copy_error)}")
-                        return None
+        def record_chunk(index, chunk, audio_bytes, info, duplicate_of):
+            job_record_chunk(index, audio_bytes)
+            manifest.record(index, chunk, audio_bytes, info, duplicate_of)
         
-        # Clean up temporary files after processing
+        # Process chunks with a bounded worker pool; the writer streams them into the output in the original order.
+        # Identical chunks (recurring transitions, sign-offs) are fetched once and reused at every position.
+        # Job ở chế độ dịch vụ: các đoạn đã tải xong ở lần chạy trước được lấy lại từ kho job
+        resumed = job_start_chunks(chunks)
+        if resumed:
+            print(f"Tiếp tục job: dùng lại {len(resumed)}/{len(chunks)} đoạn đã tải ở lần chạy trước")
+        writer = OrderedAudioWriter(output_file)
+        dedup = ChunkDeduplicator(writer, record_chunk)
         try:
-            if os.path.exists(temp_dir):
-                for temp_file in os.listdir(temp_dir):
-                    try:
-                        os.remove(os.path.join(temp_dir, temp_file))
-                    except:
-                        pass
-                try:
-                    os.rmdir(temp_dir)
-                    print("Đã dọn dẹp các file tạm thời")
-                except:
-                    pass
-        except:
-            pass
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {}
+                for i, chunk in enumerate(chunks):
+                    if not chunk.strip():
+                        writer.add(i, None)
+                    elif i in resumed:
+                        writer.add(i, resumed[i])
+                        manifest.record(i, chunk, resumed[i], source='resumed')
+                    elif dedup.add(i, chunk):
+                        futures[submit_traced(executor, process_chunk, i, chunk)] = chunk
+                for future in as_completed(futures):
+                    dedup.resolve(futures[future], *future.result())
+        except Exception:
+            writer.abort()
+            raise
+        dedup.report()
+        
+        # Thiếu quá nhiều đoạn thì hủy thay vì tạo một file âm thanh bị mất nội dung mà không ai biết
+        if manifest.finish() == 'failed':
+            writer.abort()
+            return None
+        
+        print(f"Đang hoàn tất file âm thanh từ {writer.chunks_written}/{len(chunks)} đoạn...")
+        success = writer.commit()
+        if success:
+            print(f"Đã tạo file âm thanh kết hợp: {output_file}")
+            print_audio_duration(writer.duration)
         
         # Check if file was created successfully
         if success and os.path.exists(output_file) and os.path.getsize(output_file) > 0:
             size = os.path.getsize(output_file)
             print(f"Xác nhận: File âm thanh tồn tại và có kích thước {size} bytes")
+            if TTS_CACHE_ENABLED:
+                cache_stats = tts_cache.stats()
+                print(f"Bộ nhớ đệm TTS: {cache_stats['hits']} lần trúng, {cache_stats['misses']} lần trượt")
+            if TTS_RATE_LIMIT_ENABLED:
+                print_rate_limiter_stats()
             return output_file
         else:
             print("Lỗi: File âm thanh không được tạo hoặc có kích thước bằng 0")
@@ -390,6 +3051,7 @@ def text_to_speech_google(text, language='vi', save_timestamp=False):
         print(f"Lỗi khi tạo file âm thanh: {str(e)}")
         return None
 
+@traced_stage('text')
 def extract_content_section(cleaned_text):
     """Extract only the content section from the cleaned text"""
     if not cleaned_text:
@@ -430,89 +3092,115 @@ def extract_content_section(cleaned_text):
     print("Không tìm thấy cấu trúc [nội dung] rõ ràng, sử dụng toàn bộ văn bản.")
     return cleaned_text  # Return the whole text if no content section found
 
-def filter_speech_content(text):
-    """Lọc các thành phần không cần thiết trong kịch bản trước khi chuyển đổi thành giọng nói"""
+# Mẫu giới thiệu kịch bản: tất cả đều neo ở đầu văn bản nên gộp thành một phép so khớp,
+# các nhánh được thử theo đúng thứ tự ưu tiên ban đầu
+_SPEECH_INTRO_PATTERNS = [
+    r'^.*?(đây là kịch bản|kịch bản|bài viết).*?video.*?youtube.*?\.',
+    r'^(Tuyệt vời|Chắc chắn|Được rồi|Dưới đây|Sau đây|Xin chào).*?(kịch bản|bài viết|nội dung).*?\.',
+    r'^.*?kịch bản.*?(về chủ đề|với chủ đề|về).*?\.',
+    r'^.*?đây là.*?(kịch bản|nội dung|bài viết).*?\.',
+    # Thêm mẫu cụ thể để bắt dòng "Tuyệt vời! Đây là kịch bản chi tiết..."
+    r'^Tuyệt vời\! Đây là kịch bản chi tiết.*?\.',
+    r'^Tuyệt vời\! Đây là kịch bản.*?20 phút.*?\.',
+    r'^Tuyệt vời\! Đây là kịch bản.*?chủ đề.*?\.',
+    r'^Tuyệt vời\!.*?kịch bản.*?\.'
+]
+_SPEECH_INTRO_RE = re.compile('|'.join(f'(?:{pattern})' for pattern in _SPEECH_INTRO_PATTERNS), re.IGNORECASE)
+
+# Hướng dẫn diễn xuất (ngoặc vuông, ngoặc tròn, dấu *), áp dụng lần lượt theo thứ tự
+_ACTING_RES = [
+    ('[', re.compile(r'\[.*?\]')),  # Loại bỏ [mọi thứ trong ngoặc vuông]
+    ('(', re.compile(r'\(.*?\)')),  # Loại bỏ (mọi thứ trong ngoặc tròn)
+    ('*', re.compile(r'\*.*?\*')),  # Loại bỏ *mọi thứ giữa dấu sao*
+]
+
+# Định dạng markdown dạng thoát, xóa lần lượt theo thứ tự (chỉ có tác dụng khi văn bản chứa dấu \)
+_MARKDOWN_PATTERNS = [
+    r'\*\*',  # Loại bỏ ** (bold)
+    r'\_\_',  # Loại bỏ __ (bold)
+    r'\*',    # Loại bỏ * (italic)
+    r'\_',    # Loại bỏ _ (italic)
+    r'\~\~',  # Loại bỏ ~~ (strikethrough)
+    r'\`',    # Loại bỏ ` (code)
+]
+
+# Lời kêu gọi hành động (CTA) và các cụm từ thừa, áp dụng lần lượt theo thứ tự
+# Mẫu IGNORECASE không dùng được tối ưu tiền tố của re nên mỗi lần quét khá chậm;
+# mỗi mẫu kèm tiền tố chữ thường để bỏ qua nhanh khi văn bản không chứa tiền tố đó
+_CTA_RES = [(prefix, re.compile(pattern, re.IGNORECASE)) for prefix, pattern in [
+    ('đừng quên', r'Đừng quên.*?like.*?đăng ký.*?'),
+    ('hãy để lại', r'Hãy để lại.*?bình luận.*?'),
+    ('bấm đăng ký', r'Bấm đăng ký.*?'),
+    ('bấm like', r'Bấm like.*?'),
+    ('hãy đăng ký', r'Hãy đăng ký.*?'),
+    ('theo dõi', r'Theo dõi.*?kênh.*?'),
+    ('cảm ơn', r'Cảm ơn.*?đã xem.*?'),
+]]
+_REDUNDANT_PHRASE_RES = [(prefix, re.compile(prefix, re.IGNORECASE)) for prefix in [
+    'video đăng youtube',
+    'video youtube',
+    'kịch bản video',
+    'trong video này',
+]]
+# Các ký tự mà re.IGNORECASE coi là tương đương với chữ cái ASCII nhưng str.lower() thì không
+_CASE_FOLD_EXCEPTIONS = ('İ', 'ı', 'ſ')
+
+def _sub_ignorecase_patterns(patterns, text):
+    """Áp dụng lần lượt các mẫu IGNORECASE, bỏ qua mẫu có tiền tố không xuất hiện trong văn bản"""
+    exact = any(char in text for char in _CASE_FOLD_EXCEPTIONS)
+    lowered = None
+    for prefix, pattern in patterns:
+        if not exact:
+            if lowered is None:
+                lowered = text.lower()
+            if prefix not in lowered:
+                continue
+        text = pattern.sub('', text)
+        lowered = None
+    return text
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+@traced_stage('text')
+def filter_speech_content(text, strip_intro=True):
+    """Lọc các thành phần không cần thiết trong kịch bản trước khi chuyển đổi thành giọng nói
+    
+    strip_intro=False bỏ qua bước lọc phần giới thiệu (dùng cho các đoạn giữa kịch bản khi xử lý dạng luồng).
+    """
     if not text:
         return ""
     
     # Lưu văn bản gốc
     original_text = text
     
-    # 1. Lọc bỏ các phần intro giới thiệu kịch bản
-    intro_patterns = [
-        r'^.*?(đây là kịch bản|kịch bản|bài viết).*?video.*?youtube.*?\.',
-        r'^(Tuyệt vời|Chắc chắn|Được rồi|Dưới đây|Sau đây|Xin chào).*?(kịch bản|bài viết|nội dung).*?\.',
-        r'^.*?kịch bản.*?(về chủ đề|với chủ đề|về).*?\.',
-        r'^.*?đây là.*?(kịch bản|nội dung|bài viết).*?\.',
-        # Thêm mẫu cụ thể để bắt dòng "Tuyệt vời! Đây là kịch bản chi tiết..."
-        r'^Tuyệt vời\! Đây là kịch bản chi tiết.*?\.',
-        r'^Tuyệt vời\! Đây là kịch bản.*?20 phút.*?\.',
-        r'^Tuyệt vời\! Đây là kịch bản.*?chủ đề.*?\.',
-        r'^Tuyệt vời\!.*?kịch bản.*?\.'
-    ]
-    
-    # Tìm và loại bỏ mẫu intro đầu tiên tìm thấy
+    # 1. Lọc bỏ phần intro giới thiệu kịch bản (chỉ mẫu đầu tiên khớp)
     filtered_text = text
-    for pattern in intro_patterns:
-        match = re.search(pattern, filtered_text, re.IGNORECASE)
+    if strip_intro:
+        match = _SPEECH_INTRO_RE.match(filtered_text)
         if match:
             intro_text = match.group(0)
-            filtered_text = filtered_text.replace(intro_text, '', 1)
+            filtered_text = filtered_text[match.end():]
             print(f"Đã loại bỏ phần giới thiệu: '{intro_text[:50]}...'")
-            break  # Chỉ loại bỏ mẫu đầu tiên tìm thấy
     
     # 2. Lọc các hướng dẫn diễn xuất (đặt trong ngoặc vuông, ngoặc tròn hoặc dấu *)
-    acting_patterns = [
-        r'\[.*?\]',  # Loại bỏ [mọi thứ trong ngoặc vuông]
-        r'\(.*?\)',  # Loại bỏ (mọi thứ trong ngoặc tròn)
-        r'\*.*?\*',  # Loại bỏ *mọi thứ giữa dấu sao*
-    ]
-    
-    for pattern in acting_patterns:
-        filtered_text = re.sub(pattern, '', filtered_text)
+    for trigger, pattern in _ACTING_RES:
+        if trigger in filtered_text:
+            filtered_text = pattern.sub('', filtered_text)
     
     # 3. Lọc bỏ định dạng markdown
-    markdown_patterns = [
-        r'\*\*',  # Loại bỏ ** (bold)
-        r'\_\_',  # Loại bỏ __ (bold)
-        r'\*',    # Loại bỏ * (italic)
-        r'\_',    # Loại bỏ _ (italic)
-        r'\~\~',  # Loại bỏ ~~ (strikethrough)
-        r'\`',    # Loại bỏ ` (code)
-    ]
-    
-    for pattern in markdown_patterns:
-        filtered_text = filtered_text.replace(pattern, '')
+    if '\\' in filtered_text:
+        for pattern in _MARKDOWN_PATTERNS:
+            filtered_text = filtered_text.replace(pattern, '')
     
     # 4. Lọc các lời kêu gọi hành động (CTA) thường có ở cuối
-    cta_patterns = [
-        r'Đừng quên.*?like.*?đăng ký.*?',
-        r'Hãy để lại.*?bình luận.*?',
-        r'Bấm đăng ký.*?',
-        r'Bấm like.*?',
-        r'Hãy đăng ký.*?',
-        r'Theo dõi.*?kênh.*?',
-        r'Cảm ơn.*?đã xem.*?',
-    ]
-    
-    for pattern in cta_patterns:
-        filtered_text = re.sub(pattern, '', filtered_text, flags=re.IGNORECASE)
+    filtered_text = _sub_ignorecase_patterns(_CTA_RES, filtered_text)
     
     # 5. Loại bỏ các cụm từ thừa lặp lại
-    redundant_phrases = [
-        r'video đăng youtube',
-        r'video youtube',
-        r'kịch bản video',
-        r'trong video này',
-    ]
-    
-    for phrase in redundant_phrases:
-        filtered_text = re.sub(phrase, '', filtered_text, flags=re.IGNORECASE)
+    filtered_text = _sub_ignorecase_patterns(_REDUNDANT_PHRASE_RES, filtered_text)
     
     # 6. Dọn dẹp khoảng trắng thừa và các vấn đề định dạng
-    filtered_text = re.sub(r'\n{3,}', '\n\n', filtered_text)  # Giảm nhiều dòng trống thành 2
-    filtered_text = re.sub(r' {2,}', ' ', filtered_text)      # Giảm nhiều khoảng trắng thành 1
-    filtered_text = filtered_text.strip()                     # Xóa khoảng trắng ở đầu và cuối
+    filtered_text = _BLANK_LINES_RE.sub('\n\n', filtered_text)  # Giảm nhiều dòng trống thành 2
+    filtered_text = _MULTI_SPACE_RE.sub(' ', filtered_text)     # Giảm nhiều khoảng trắng thành 1
+    filtered_text = filtered_text.strip()                       # Xóa khoảng trắng ở đầu và cuối
     
     # Kiểm tra nếu quá trình lọc đã loại bỏ quá nhiều nội dung
     if len(filtered_text) < len(original_text) * 0.7:
@@ -520,6 +3208,127 @@ def filter_speech_content(text):
     
     return filtered_text
 
+# Bảng thay thế ký tự đặc biệt và ký hiệu toán học cho giọng nói
+_SPECIAL_CHAR_REPLACEMENTS = {
+    # Các ký tự đặc biệt thường gây vấn đề khi đọc
+    '[': ' ',
+    ']': ' ',
+    '{': ' ',
+    '}': ' ',
+    '(': ' ',
+    ')': ' ',
+    '|': ' ',
+    '/': ' ',
+    '\\': ' ',
+    '#': ' ',
+    '@': ' ',
+    '&': ' và ',
+    '+': ' cộng ',
+    '=': ' bằng ',
+    '*': ' ',
+    '_': ' ',
+    '~': ' ',
+    '<': ' ',
+    '>': ' ',
+    '^': ' ',
+    '`': ' ',
+    '•': ' ',
+    '■': ' ',
+    '●': ' ',
+    '★': ' ',
+    '☆': ' ',
+    '♦': ' ',
+    '♣': ' ',
+    '♠': ' ',
+    '♥': ' ',
+    '→': ' ',
+    '←': ' ',
+    '↑': ' ',
+    '↓': ' ',
+}
+
+_MATH_SYMBOL_REPLACEMENTS = {
+    '÷': ' chia cho ',
+    '×': ' nhân ',
+    '≤': ' nhỏ hơn hoặc bằng ',
+    '≥': ' lớn hơn hoặc bằng ',
+    '≠': ' khác ',
+    '≈': ' xấp xỉ ',
+    '∞': ' vô cùng ',
+    '∑': ' tổng ',
+    '∏': ' tích ',
+    '√': ' căn bậc hai ',
+    '∫': ' tích phân ',
+    '∂': ' đạo hàm riêng ',
+    '∇': ' nabla ',
+    '∆': ' delta ',
+    '∈': ' thuộc ',
+    '∉': ' không thuộc ',
+    '∩': ' giao ',
+    '∪': ' hợp ',
+    '⊂': ' tập con ',
+    '⊃': ' tập cha ',
+    '⊆': ' tập con hoặc bằng ',
+    '⊇': ' tập cha hoặc bằng ',
+}
+
+_SPEECH_REPLACEMENTS = {**_SPECIAL_CHAR_REPLACEMENTS, **_MATH_SYMBOL_REPLACEMENTS}
+
+# Dải emoji và biểu tượng cảm xúc cần loại bỏ
+_EMOJI_RANGES = [
+    (0x1F600, 0x1F64F),  # emoticons
+    (0x1F300, 0x1F5FF),  # symbols & pictographs
+    (0x1F680, 0x1F6FF),  # transport & map symbols
+    (0x1F700, 0x1F77F),  # alchemical symbols
+    (0x1F780, 0x1F7FF),  # Geometric Shapes
+    (0x1F800, 0x1F8FF),  # Supplemental Arrows-C
+    (0x1F900, 0x1F9FF),  # Supplemental Symbols and Pictographs
+    (0x1FA00, 0x1FA6F),  # Chess Symbols
+    (0x1FA70, 0x1FAFF),  # Symbols and Pictographs Extended-A
+    (0x2702, 0x27B0),    # Dingbats
+    (0x24C2, 0x1F251),
+]
+
+def _build_speech_symbols_pattern():
+    # Một lần quét duy nhất: ký tự trong bảng thay thế (nhóm 1) hoặc chuỗi emoji.
+    # Bảng thay thế được ưu tiên như thứ tự cũ (thay thế trước, xóa emoji sau), nên các ký tự
+    # của bảng (ví dụ ★ ♥ ■) được loại khỏi lớp emoji; giá trị thay thế không chứa emoji.
+    excluded = sorted(ord(char) for char in _SPEECH_REPLACEMENTS)
+    merged = []
+    for start, end in sorted(_EMOJI_RANGES):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    ranges = []
+    for start, end in merged:
+        for code in excluded:
+            if start <= code <= end:
+                if start < code:
+                    ranges.append((start, code - 1))
+                start = code + 1
+        if start <= end:
+            ranges.append((start, end))
+    emoji_class = ''.join(f'\\U{start:08X}-\\U{end:08X}' for start, end in ranges)
+    special_class = re.escape(''.join(_SPEECH_REPLACEMENTS))
+    return re.compile(f'([{special_class}])|[{emoji_class}]+')
+
+_SPEECH_SYMBOLS_RE = _build_speech_symbols_pattern()
+
+def _replace_speech_symbol(match):
+    char = match.group(1)
+    return _SPEECH_REPLACEMENTS[char] if char else ''
+
+_URL_RE = re.compile(r'https?://\S+|www\.\S+')
+_REPEATED_PUNCTUATION_RE = re.compile(r'\.{2,}|!{2,}|\?{2,}')
+_HTML_TAG_RE = re.compile('<.*?>')
+
+def _collapse_punctuation(match):
+    # ... thành khoảng trắng, !!! thành !, ??? thành ?
+    char = match.group(0)[0]
+    return ' ' if char == '.' else char
+
+@traced_stage('text')
 def remove_special_characters(text):
     """Loại bỏ hoặc thay thế các ký tự đặc biệt để giọng nói không đọc"""
     if not text:
@@ -528,143 +3337,353 @@ def remove_special_characters(text):
     # Lưu văn bản gốc
     original_text = text
     
-    # 1. Thay thế các ký tự đặc biệt bằng khoảng trắng hoặc xóa
-    replacements = {
-        # Các ký tự đặc biệt thường gây vấn đề khi đọc
-        '[': ' ',
-        ']': ' ',
-        '{': ' ',
-        '}': ' ',
-        '(': ' ',
-        ')': ' ',
-        '|': ' ',
-        '/': ' ',
-        '\\': ' ',
-        '#': ' ',
-        '@': ' ',
-        '&': ' và ',
-        '+': ' cộng ',
-        '=': ' bằng ',
-        '*': ' ',
-        '_': ' ',
-        '~': ' ',
-        '<': ' ',
-        '>': ' ',
-        '^': ' ',
-        '`': ' ',
-        '•': ' ',
-        '■': ' ',
-        '●': ' ',
-        '★': ' ',
-        '☆': ' ',
-        '♦': ' ',
-        '♣': ' ',
-        '♠': ' ',
-        '♥': ' ',
-        '→': ' ',
-        '←': ' ',
-        '↑': ' ',
-        '↓': ' ',
-    }
-    
-    # Thực hiện thay thế
-    processed_text = text
-    for char, replacement in replacements.items():
-        processed_text = processed_text.replace(char, replacement)
-    
-    # 2. Xử lý các biểu tượng cảm xúc và emoji
-    # Sử dụng regex để loại bỏ emoji
-    emoji_pattern = re.compile("["
-                               u"\U0001F600-\U0001F64F"  # emoticons
-                               u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-                               u"\U0001F680-\U0001F6FF"  # transport & map symbols
-                               u"\U0001F700-\U0001F77F"  # alchemical symbols
-                               u"\U0001F780-\U0001F7FF"  # Geometric Shapes
-                               u"\U0001F800-\U0001F8FF"  # Supplemental Arrows-C
-                               u"\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
-                               u"\U0001FA00-\U0001FA6F"  # Chess Symbols
-                               u"\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
-                               u"\U00002702-\U000027B0"  # Dingbats
-                               u"\U000024C2-\U0001F251" 
-                               "]+", flags=re.UNICODE)
-    processed_text = emoji_pattern.sub(r'', processed_text)
-    
-    # 3. Xử lý các ký hiệu toán học
-    math_replacements = {
-        '÷': ' chia cho ',
-        '×': ' nhân ',
-        '≤': ' nhỏ hơn hoặc bằng ',
-        '≥': ' lớn hơn hoặc bằng ',
-        '≠': ' khác ',
-        '≈': ' xấp xỉ ',
-        '∞': ' vô cùng ',
-        '∑': ' tổng ',
-        '∏': ' tích ',
-        '√': ' căn bậc hai ',
-        '∫': ' tích phân ',
-        '∂': ' đạo hàm riêng ',
-        '∇': ' nabla ',
-        '∆': ' delta ',
-        '∈': ' thuộc ',
-        '∉': ' không thuộc ',
-        '∩': ' giao ',
-        '∪': ' hợp ',
-        '⊂': ' tập con ',
-        '⊃': ' tập cha ',
-        '⊆': ' tập con hoặc bằng ',
-        '⊇': ' tập cha hoặc bằng ',
-    }
-    
-    for char, replacement in math_replacements.items():
-        processed_text = processed_text.replace(char, replacement)
+    # 1-3. Thay thế ký tự đặc biệt, ký hiệu toán học và loại bỏ emoji trong một lần quét
+    processed_text = _SPEECH_SYMBOLS_RE.sub(_replace_speech_symbol, text)
     
     # 4. Xử lý URL và đường dẫn web
     # Loại bỏ hoặc đơn giản hóa URL
-    url_pattern = re.compile(r'https?://\S+|www\.\S+')
-    processed_text = url_pattern.sub(' liên kết website ', processed_text)
+    if 'http' in processed_text or 'www.' in processed_text:
+        processed_text = _URL_RE.sub(' liên kết website ', processed_text)
     
-    # 5. Xử lý dấu ngoặc và nội dung bên trong
-    # Đã xử lý ở phần 1 bằng cách thay thế dấu ngoặc, nhưng có thể xử lý thêm nếu cần
+    # 5. Xử lý nhiều dấu chấm câu lặp lại (... → khoảng trắng, !!! → !, ??? → ?)
+    processed_text = _REPEATED_PUNCTUATION_RE.sub(_collapse_punctuation, processed_text)
     
-    # 6. Xử lý nhiều dấu chấm câu lặp lại
-    processed_text = re.sub(r'\.{2,}', ' ', processed_text)  # Thay thế ... bằng khoảng trắng
-    processed_text = re.sub(r'\!{2,}', '!', processed_text)  # Thay thế !!! bằng !
-    processed_text = re.sub(r'\?{2,}', '?', processed_text)  # Thay thế ??? bằng ?
-    
-    # 7. Xử lý các ký tự Unicode đặc biệt
+    # 6. Xử lý các ký tự Unicode đặc biệt
     # Chuyển về dạng NFKD để tách Unicode đặc biệt
     processed_text = unicodedata.normalize('NFKD', processed_text)
     
-    # 8. Loại bỏ các thẻ HTML và XML nếu có
-    html_pattern = re.compile('<.*?>')
-    processed_text = html_pattern.sub(' ', processed_text)
+    # 7. Loại bỏ các thẻ HTML và XML nếu có
+    if '<' in processed_text:
+        processed_text = _HTML_TAG_RE.sub(' ', processed_text)
     
-    # 9. Dọn dẹp khoảng trắng và dấu câu thừa
-    processed_text = re.sub(r' +', ' ', processed_text)  # Thay thế nhiều khoảng trắng bằng 1 khoảng trắng
+    # 8. Dọn dẹp khoảng trắng và dấu câu thừa
+    processed_text = _MULTI_SPACE_RE.sub(' ', processed_text)  # Thay thế nhiều khoảng trắng bằng 1 khoảng trắng
     processed_text = processed_text.strip()
     
-    # 10. Kiểm tra xem sau khi xử lý còn lại bao nhiêu nội dung
+    # 9. Kiểm tra xem sau khi xử lý còn lại bao nhiêu nội dung
     if len(processed_text) < len(original_text) * 0.5:
         print(f"Cảnh báo: Xử lý ký tự đặc biệt đã giảm đáng kể nội dung (từ {len(original_text)} xuống {len(processed_text)} ký tự)")
     
     return processed_text
 
-def send_to_gemini(api_key, prompt, save_timestamp=False, use_content_only=False):
-    # Format the prompt with the YouTube script template, emphasizing to only return spoken content
-    formatted_prompt = f"""Tạo kịch bản chi tiết và đầy đủ cho video YouTube dài 20 phút với chủ đề: {prompt}.
+def build_speech_text(cleaned_response, prompt, use_content_only=False):
+    """Chuẩn bị văn bản cuối cùng để chuyển thành giọng nói từ phản hồi đã làm sạch"""
+    # Determine which text to convert to speech
+    final_speech_text = ""
+    
+    if use_content_only:
+        # Extract only the content section
+        speech_content = extract_content_section(cleaned_response)
+        if speech_content and len(speech_content.strip()) >= 10:
+            print("Chỉ chuyển đổi phần [nội dung] thành giọng nói...")
+            final_speech_text = speech_content
+        else:
+            print("Không tìm thấy phần [nội dung] hợp lệ, chuyển đổi toàn bộ phản hồi...")
+            final_speech_text = cleaned_response
+    else:
+        # Convert the entire cleaned response
+        final_speech_text = cleaned_response
+    
+    # Lọc các thành phần không cần đọc trong kịch bản trước khi chuyển đổi thành giọng nói
+    print("Đang lọc các thành phần không cần đọc (hướng dẫn diễn xuất, định dạng, v.v.)")
+    final_speech_text = filter_speech_content(final_speech_text)
+    
+    # Loại bỏ các ký tự đặc biệt để giọng nói không đọc
+    print("Đang xử lý và loại bỏ các ký tự đặc biệt...")
+    final_speech_text = remove_special_characters(final_speech_text)
+    
+    # Kiểm tra lần cuối trước khi chuyển đổi
+    if not final_speech_text or len(final_speech_text.strip()) < 10:
+        print("Cảnh báo nghiêm trọng: Nội dung cuối cùng cho chuyển đổi âm thanh trống hoặc quá ngắn")
+        # Thêm nội dung mặc định
+        default_text = f"Xin chào. Đây là kịch bản về chủ đề {prompt}. Rất tiếc, chúng tôi không thể tạo được nội dung đầy đủ. Vui lòng thử lại."
+        final_speech_text = default_text
+    
+    return final_speech_text
 
-Kịch bản phải thực sự dài, đầy đủ thông tin, và đủ nội dung để nói trong 20 phút. Kịch bản nên có độ dài ít nhất 2000-3000 từ.
+def process_gemini_response(original_response, prompt, save_timestamp=False, use_content_only=False, output_name=None):
+    """Làm sạch, lưu phản hồi Gemini và chuyển thành giọng nói, trả về phản hồi đã làm sạch"""
+    text_seconds = generation_elapsed()
+    # Lưu ngay văn bản gốc vào kho job để khi tiếp tục không phải gọi lại Gemini
+    job_checkpoint(raw_text=original_response)
+    
+    # Clean the response 
+    cleaned_response = clean_response(original_response)
+    
+    # Kiểm tra nội dung sau khi làm sạch
+    if not cleaned_response or len(cleaned_response.strip()) < 10:
+        print("Cảnh báo: Nội dung sau khi làm sạch quá ngắn hoặc trống rỗng, sử dụng nội dung gốc")
+        cleaned_response = original_response
+    job_checkpoint(cleaned_text=cleaned_response)
+    
+    # Debug: check if cleaned response still has the content tag
+    if "[nội dung]" not in cleaned_response.lower() and use_content_only:
+        print("Cảnh báo: Thẻ [nội dung] có thể đã bị loại bỏ trong quá trình làm sạch")
+    
+    # Save both responses to file
+    saved_file = save_responses(original_response, cleaned_response, prompt, save_timestamp, output_name)
+    print(f"Đã lưu phản hồi vào file: {saved_file}")
+    
+    # Convert to speech using Google TTS
+    print("Đang chuyển đổi phản hồi thành giọng nói bằng Google TTS...")
+    
+    final_speech_text = build_speech_text(cleaned_response, prompt, use_content_only)
+    
+    print(f"Nội dung cuối cùng để chuyển đổi âm thanh: {len(final_speech_text)} ký tự")
+    tts_start = time.perf_counter()
+    audio_file = None
+    try:
+        audio_file = text_to_speech_google(final_speech_text, language='vi', save_timestamp=save_timestamp,
+                                           output_name=output_name)
+    finally:
+        # Ghi vào kho lưu trữ cả khi tạo âm thanh bị lỗi, để không mất văn bản
+        archive_generation(prompt, original_response, cleaned_response, audio_file, saved_file, use_content_only,
+                           {'text_s': text_seconds, 'tts_s': round(time.perf_counter() - tts_start, 3)})
+    
+    if audio_file:
+        print(f"Đã tạo file âm thanh: {audio_file}")
+    else:
+        print("Cảnh báo: Không thể tạo file âm thanh. Xem thông báo lỗi ở trên.")
+    
+    return cleaned_response
 
-Yêu cầu bắt buộc:
-1. Sử dụng định dạng [tiêu đề] và [nội dung]
-2. [nội dung] PHẢI dài và chi tiết, đủ để nói trong 20 phút
-3. CHỈ bao gồm lời thoại của một người, KHÔNG có hướng dẫn quay phim, mô tả cảnh, chú thích hay ghi chú kỹ thuật
-4. Nội dung PHẢI được triển khai đầy đủ, có phần giới thiệu, thân bài với nhiều điểm và ví dụ, và phần kết luận
-5. Viết hoàn toàn bằng tiếng Việt, tập trung vào nội dung chất lượng cao
+def build_continuation_request(data, text_so_far, missing_words):
+    """Tạo yêu cầu nhiều lượt: prompt gốc, phần kịch bản đã có (lượt của model) và yêu cầu viết tiếp"""
+    contents = [dict(content, role=content.get('role', 'user')) for content in data["contents"]]
+    contents.append({"role": "model", "parts": [{"text": text_so_far}]})
+    contents.append({"role": "user", "parts": [{"text": GEMINI_CONTINUATION_PROMPT.format(missing_words=missing_words)}]})
+    generation_config = dict(data["generationConfig"])
+    # Chỉ trả cho số từ còn thiếu
+    generation_config["maxOutputTokens"] = min(generation_config.get("maxOutputTokens", 8192),
+                                               max(1024, int(missing_words * GEMINI_TOKENS_PER_WORD)))
+    return {"contents": contents, "generationConfig": generation_config}
 
-QUAN TRỌNG: ĐỪNG rút gọn hoặc tóm tắt. Kịch bản phải đủ dài cho video 20 phút."""
+def join_continuation(text_so_far, continuation):
+    """Nối phần viết tiếp vào kịch bản, giữ khoảng trắng hợp lý tại chỗ nối"""
+    if not text_so_far or text_so_far[-1].isspace() or continuation[:1].isspace():
+        return text_so_far + continuation
+    return text_so_far + ('\n' if text_so_far[-1] in '.!?' else ' ') + continuation
+
+def gemini_usage_tokens(result):
+    """Tổng số token (usageMetadata.totalTokenCount) của một phản hồi Gemini, 0 nếu không có"""
+    return (result.get('usageMetadata') or {}).get('totalTokenCount', 0)
+
+def request_gemini_continuation(api_key, data, text_so_far, missing_words):
+    """Gửi một yêu cầu viết tiếp đến generateContent, trả về phần văn bản mới hoặc None"""
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    try:
+        with trace_span('gemini_continuation', 'gemini', missing_words=missing_words) as span, \
+                gemini_keys.lease(api_key) as usage:
+            url = f"{GEMINI_API_BASE}:generateContent?key={usage['key']}"
+            response = get_http_session().post(url, headers=headers, json=build_continuation_request(data, text_so_far, missing_words),
+                                               timeout=60)
+            span.update(status=response.status_code, bytes=len(response.content))
+            response.raise_for_status()
+            result = response.json()
+            usage['tokens'] = gemini_usage_tokens(result)
+        add_generation_tokens(usage['tokens'])
+        candidates = result.get('candidates') or []
+        parts = candidates[0].get('content', {}).get('parts', []) if candidates else []
+        continuation = ''.join(part.get('text', '') for part in parts)
+        return continuation if continuation.strip() else None
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Lỗi khi yêu cầu viết tiếp: {str(e)}")
+        return None
+
+def lengthen_gemini_script(api_key, data, text):
+    """Yêu cầu Gemini viết tiếp kịch bản ngắn cho đến khi đủ GEMINI_TARGET_WORDS từ"""
+    word_count = len(text.split())
+    for round_number in range(1, GEMINI_MAX_CONTINUATIONS + 1):
+        if word_count >= GEMINI_TARGET_WORDS:
+            break
+        missing_words = GEMINI_TARGET_WORDS - word_count
+        print(f"Nội dung mới có {word_count} từ, yêu cầu Gemini viết tiếp khoảng {missing_words} từ "
+              f"(lần {round_number}/{GEMINI_MAX_CONTINUATIONS})...")
+        continuation = request_gemini_continuation(api_key, data, text, missing_words)
+        if not continuation:
+            break
+        text = join_continuation(text, continuation)
+        word_count = len(text.split())
+    return text
+
+gemini_hedge_stats = {}
+_hedge_log_lock = threading.Lock()
+
+def check_script_response(text):
+    """Áp dụng các kiểm tra của send_to_gemini, trả về None nếu hợp lệ hoặc lý do không đạt"""
+    if not text or len(text.strip()) < 10:
+        return "phản hồi trống hoặc quá ngắn"
+    lowered = text.lower()
+    if "[tiêu đề]" not in lowered and "[nội dung]" not in lowered:
+        return "thiếu thẻ [tiêu đề] và [nội dung]"
+    word_count = len(text.split())
+    if word_count < GEMINI_TARGET_WORDS:
+        return f"nội dung quá ngắn ({word_count} từ)"
+    return None
+
+def request_gemini_candidates(api_key, data, candidate_count=1, cancelled=None):
+    """Gửi một yêu cầu generateContent, trả về danh sách văn bản của các candidate
+    
+    Khi có cancelled (threading.Event), yêu cầu đi qua streamGenerateContent để có thể dừng giữa chừng:
+    khi cancelled được đặt, kết nối bị đóng ngay (mô hình ngừng viết, khóa API được trả lại) và trả về [].
+    """
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    if candidate_count > 1:
+        data = dict(data, generationConfig=dict(data["generationConfig"], candidateCount=candidate_count))
+    if cancelled is not None:
+        return stream_gemini_candidates(api_key, data, candidate_count, cancelled)
+    with trace_span('gemini_request', 'gemini', candidates=candidate_count) as span, gemini_keys.lease(api_key) as usage:
+        url = f"{GEMINI_API_BASE}:generateContent?key={usage['key']}"
+        response = get_http_session().post(url, headers=headers, json=data, timeout=60)
+        span.update(status=response.status_code, bytes=len(response.content))
+        response.raise_for_status()
+        result = response.json()
+        usage['tokens'] = gemini_usage_tokens(result)
+    add_generation_tokens(usage['tokens'])
+    texts = []
+    for candidate in result.get('candidates') or []:
+        texts.append(''.join(part.get('text', '') for part in candidate.get('content', {}).get('parts', [])))
+    return texts
+
+def stream_gemini_candidates(api_key, data, candidate_count, cancelled):
+    """Phần streamGenerateContent của request_gemini_candidates: gom văn bản theo chỉ số candidate"""
+    if cancelled.is_set():
+        return []
+    texts = [''] * candidate_count
+    with trace_span('gemini_request', 'gemini', candidates=candidate_count, streaming=1) as span, \
+            gemini_keys.lease(api_key) as usage, \
+            get_http_session().post(f"{GEMINI_API_BASE}:streamGenerateContent?alt=sse&key={usage['key']}",
+                                    headers={'Content-Type': 'application/json'}, json=data, stream=True,
+                                    timeout=60) as response:
+        span['status'] = response.status_code
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if cancelled.is_set():
+                # Thoát khỏi with: response chưa đọc hết nên kết nối bị đóng thay vì trả về pool
+                span['cancelled'] = 1
+                return []
+            line = line.decode('utf-8') if isinstance(line, bytes) else line
+            if not line.startswith('data:'):
+                continue
+            event = json.loads(line[5:].strip())
+            usage['tokens'] = gemini_usage_tokens(event) or usage['tokens']
+            for candidate in event.get('candidates') or []:
+                index = candidate.get('index', 0)
+                if index < candidate_count:
+                    texts[index] += ''.join(part.get('text', '') for part in candidate.get('content', {}).get('parts', []))
+    add_generation_tokens(usage['tokens'])
+    return [text for text in texts if text]
+
+def record_hedge_result(mode, winner, elapsed, requests_sent):
+    """Đếm chiến lược thắng và ghi thêm một dòng vào GEMINI_HEDGE_LOG"""
+    with _hedge_log_lock:
+        gemini_hedge_stats[winner] = gemini_hedge_stats.get(winner, 0) + 1
+        try:
+            os.makedirs(os.path.dirname(GEMINI_HEDGE_LOG), exist_ok=True)
+            with open(GEMINI_HEDGE_LOG, 'a', encoding='utf-8') as log_file:
+                log_file.write(json.dumps({
+                    'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    'mode': mode,
+                    'winner': winner,
+                    'seconds': round(elapsed, 3),
+                    'requests': requests_sent,
+                    'hedge_delay': GEMINI_HEDGE_DELAY if mode == 'delay' else None,
+                    'candidates': GEMINI_HEDGE_CANDIDATES if mode != 'delay' else None,
+                }, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Cảnh báo: Không thể ghi nhật ký hedging: {str(e)}")
+
+def send_hedged_request(api_key, data, mode=None):
+    """Gửi yêu cầu Gemini theo chiến lược hedging và lấy candidate hợp lệ đầu tiên
+    
+    Trả về (văn bản, tên chiến lược thắng). Nếu không có candidate nào hợp lệ, trả về
+    (candidate có thẻ dài nhất hoặc None, None). Khi đã có kết quả, các yêu cầu còn lại bị đóng kết nối
+    để không tiếp tục tốn hạn mức.
+    """
+    mode = mode or GEMINI_HEDGE_MODE
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(2, GEMINI_HEDGE_CANDIDATES))
+    cancelled = threading.Event()
+    futures = {}
+    
+    def submit(label, candidate_count=1):
+        future = submit_traced(executor, request_gemini_candidates, api_key, data, candidate_count, cancelled)
+        futures[future] = label
+        return future
+    
+    if mode == 'candidates':
+        submit('candidates', GEMINI_HEDGE_CANDIDATES)
+    elif mode == 'parallel':
+        for i in range(GEMINI_HEDGE_CANDIDATES):
+            submit(f'parallel_{i + 1}')
+    else:
+        submit('primary')
+    hedge_sent = mode != 'delay'
+    
+    winner = None
+    best_text = None
+    pending = set(futures)
+    try:
+        print(f"Đang gửi yêu cầu đến Gemini API (hedging: {mode})...")
+        while pending and winner is None:
+            timeout = None if hedge_sent else max(0.0, GEMINI_HEDGE_DELAY - (time.perf_counter() - start))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    texts = future.result()
+                except Exception as e:
+                    print(f"Yêu cầu {futures[future]} bị lỗi: {str(e)}")
+                    texts = []
+                for index, text in enumerate(texts):
+                    label = futures[future] if len(texts) == 1 else f"{futures[future]}_{index + 1}"
+                    reason = check_script_response(text)
+                    if reason is None:
+                        winner = (text, label)
+                        break
+                    print(f"Candidate {label} không đạt: {reason}")
+                    if "[tiêu đề]" in text.lower() or "[nội dung]" in text.lower():
+                        if best_text is None or len(text.split()) > len(best_text.split()):
+                            best_text = text
+                if winner:
+                    break
+            if winner is None and not hedge_sent and (not done or not pending):
+                # Yêu cầu chính chậm hoặc không hợp lệ: gửi yêu cầu dự phòng
+                print("Chưa có phản hồi hợp lệ, gửi thêm yêu cầu dự phòng...")
+                pending.add(submit('hedge'))
+                hedge_sent = True
+    finally:
+        # Không chờ các yêu cầu còn lại: chúng tự đóng kết nối ở sự kiện SSE tiếp theo
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    elapsed = time.perf_counter() - start
+    record_hedge_result(mode, winner[1] if winner else 'none', elapsed, len(futures))
+    if winner:
+        print(f"Chiến lược thắng: {winner[1]} sau {elapsed:.1f} giây")
+        return winner
+    return best_text, None
+
+@traced_run
+@archived_run
+def send_to_gemini(api_key, prompt, save_timestamp=False, use_content_only=False, force_refresh=False, output_name=None):
+    # Dùng lại phản hồi đã lưu cho cùng chủ đề và cấu hình, trừ khi yêu cầu làm mới
+    cache_key = ResponseCache.make_key(prompt, SCRIPT_PROMPT_TEMPLATE, DEFAULT_GENERATION_CONFIG)
+    if GEMINI_CACHE_ENABLED and not force_refresh:
+        cached_response = gemini_cache.get(cache_key)
+        if cached_response:
+            print("Đã tìm thấy phản hồi trong bộ nhớ đệm, bỏ qua lời gọi Gemini API.")
+            mark_generation_cached()
+            return process_gemini_response(cached_response, prompt, save_timestamp, use_content_only, output_name)
+    archived_response = None if force_refresh else check_duplicate_topic(prompt)
+    if archived_response:
+        return process_gemini_response(archived_response, prompt, save_timestamp, use_content_only, output_name)
     
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
+    # Format the prompt with the YouTube script template, emphasizing to only return spoken content
+    formatted_prompt = SCRIPT_PROMPT_TEMPLATE.format(topic=prompt)
     
     headers = {
         'Content-Type': 'application/json'
@@ -674,24 +3693,39 @@ QUAN TRỌNG: ĐỪNG rút gọn hoặc tóm tắt. Kịch bản phải đủ d
         "contents": [{
             "parts": [{"text": formatted_prompt}]
         }],
-        "generationConfig": {
-            "temperature": 0.8,
-            "topK": 40,
-            "topP": 0.95,
-            "maxOutputTokens": 32768  # Tăng lên mức tối đa có thể để có nội dung dài hơn
-        }
+        "generationConfig": dict(DEFAULT_GENERATION_CONFIG)
     }
     
-    max_retries = 3  # Tăng số lần thử lại để đảm bảo nhận được nội dung đủ dài
+    if GEMINI_HEDGE_MODE != 'off':
+        hedged_response, strategy = send_hedged_request(api_key, data)
+        if hedged_response and strategy is None and GEMINI_CONTINUATION_ENABLED:
+            # Không có candidate đủ dài: viết tiếp candidate tốt nhất thay vì gửi lại từ đầu,
+            # rồi dùng luôn như vòng gửi tuần tự vẫn làm với kịch bản đã viết tiếp
+            hedged_response = lengthen_gemini_script(api_key, data, hedged_response)
+            strategy = 'continuation'
+        if hedged_response and (strategy or check_script_response(hedged_response) is None):
+            if GEMINI_CACHE_ENABLED:
+                gemini_cache.put(cache_key, hedged_response, prompt)
+            return process_gemini_response(hedged_response, prompt, save_timestamp, use_content_only, output_name)
+        print("Không có candidate hợp lệ, chuyển sang gửi tuần tự...")
+    
+    # Tăng số lần thử lại để đảm bảo nhận được nội dung đủ dài; sau một vòng hedging đã gửi nhiều yêu cầu thì chỉ thử lại một lần
+    max_retries = 3 if GEMINI_HEDGE_MODE == 'off' else 1
     current_retry = 0
     
     while current_retry <= max_retries:
         try:
             print(f"Đang gửi yêu cầu đến Gemini API{' (lần thử lại)' if current_retry > 0 else ''}...")
-            response = requests.post(url, headers=headers, json=data, timeout=60)  # Tăng timeout lên 60 giây
-            response.raise_for_status()  # Raise exception for HTTP errors
-            
-            result = response.json()
+            # Mỗi lần thử lấy một khóa từ gemini_keys: khóa vừa bị 429 được tạm ngưng và lần sau dùng khóa khác
+            with trace_span('gemini_request', 'gemini', attempt=current_retry + 1, retries=int(current_retry > 0)) as span, \
+                    gemini_keys.lease(api_key) as usage:
+                url = f"{GEMINI_API_BASE}:generateContent?key={usage['key']}"
+                response = get_http_session().post(url, headers=headers, json=data, timeout=60)  # Tăng timeout lên 60 giây
+                span.update(status=response.status_code, bytes=len(response.content))
+                response.raise_for_status()  # Raise exception for HTTP errors
+                result = response.json()
+                usage['tokens'] = gemini_usage_tokens(result)
+            add_generation_tokens(usage['tokens'])
             
             # Extract the response text from the result
             if 'candidates' in result and len(result['candidates']) > 0:
@@ -713,8 +3747,14 @@ QUAN TRỌNG: ĐỪNG rút gọn hoặc tóm tắt. Kịch bản phải đủ d
                                 current_retry += 1
                                 continue
                         
+                        # Nội dung ngắn: giữ phần đã có và yêu cầu viết tiếp thay vì tạo lại toàn bộ
+                        if word_count < GEMINI_TARGET_WORDS and GEMINI_CONTINUATION_ENABLED:
+                            original_response = lengthen_gemini_script(api_key, data, original_response)
+                            word_count = len(original_response.split())
+                            print(f"Sau khi viết tiếp: khoảng {word_count} từ")
+                        
                         # Kiểm tra nội dung có đủ dài cho video 20 phút không (ước tính khoảng 2000 từ)
-                        if word_count < 1500 and current_retry < max_retries:
+                        if word_count < GEMINI_TARGET_WORDS and current_retry < max_retries and not GEMINI_CONTINUATION_ENABLED:
                             print(f"Cảnh báo: Nội dung quá ngắn cho video 20 phút ({word_count} từ). Thử lại yêu cầu nội dung dài hơn...")
                             current_retry += 1
                             # Điều chỉnh prompt để nhấn mạnh yêu cầu nội dung dài
@@ -765,65 +3805,11 @@ Lưu ý: Nội dung phải thực sự dài và chi tiết, ít nhất 2500 từ
                                 }
                                 continue  # Try again with the new prompt
                         
-                        # Clean the response 
-                        cleaned_response = clean_response(original_response)
-                        
-                        # Kiểm tra nội dung sau khi làm sạch
-                        if not cleaned_response or len(cleaned_response.strip()) < 10:
-                            print("Cảnh báo: Nội dung sau khi làm sạch quá ngắn hoặc trống rỗng, sử dụng nội dung gốc")
-                            cleaned_response = original_response
-                        
-                        # Debug: check if cleaned response still has the content tag
-                        if "[nội dung]" not in cleaned_response.lower() and use_content_only:
-                            print("Cảnh báo: Thẻ [nội dung] có thể đã bị loại bỏ trong quá trình làm sạch")
-                        
-                        # Save both responses to file
-                        saved_file = save_responses(original_response, cleaned_response, prompt, save_timestamp)
-                        print(f"Đã lưu phản hồi vào file: {saved_file}")
-                        
-                        # Convert to speech using Google TTS
-                        print("Đang chuyển đổi phản hồi thành giọng nói bằng Google TTS...")
-                        
-                        # Determine which text to convert to speech
-                        final_speech_text = ""
-                        
-                        if use_content_only:
-                            # Extract only the content section
-                            speech_content = extract_content_section(cleaned_response)
-                            if speech_content and len(speech_content.strip()) >= 10:
-                                print("Chỉ chuyển đổi phần [nội dung] thành giọng nói...")
-                                final_speech_text = speech_content
-                            else:
-                                print("Không tìm thấy phần [nội dung] hợp lệ, chuyển đổi toàn bộ phản hồi...")
-                                final_speech_text = cleaned_response
-                        else:
-                            # Convert the entire cleaned response
-                            final_speech_text = cleaned_response
-                        
-                        # Lọc các thành phần không cần đọc trong kịch bản trước khi chuyển đổi thành giọng nói
-                        print("Đang lọc các thành phần không cần đọc (hướng dẫn diễn xuất, định dạng, v.v.)")
-                        final_speech_text = filter_speech_content(final_speech_text)
-                        
-                        # Loại bỏ các ký tự đặc biệt để giọng nói không đọc
-                        print("Đang xử lý và loại bỏ các ký tự đặc biệt...")
-                        final_speech_text = remove_special_characters(final_speech_text)
-                        
-                        # Kiểm tra lần cuối trước khi chuyển đổi
-                        if not final_speech_text or len(final_speech_text.strip()) < 10:
-                            print("Cảnh báo nghiêm trọng: Nội dung cuối cùng cho chuyển đổi âm thanh trống hoặc quá ngắn")
-                            # Thêm nội dung mặc định
-                            default_text = f"Xin chào. Đây là kịch bản về chủ đề {prompt}. Rất tiếc, chúng tôi không thể tạo được nội dung đầy đủ. Vui lòng thử lại."
-                            final_speech_text = default_text
-                        
-                        print(f"Nội dung cuối cùng để chuyển đổi âm thanh: {len(final_speech_text)} ký tự")
-                        audio_file = text_to_speech_google(final_speech_text, language='vi', save_timestamp=save_timestamp)
+                        if GEMINI_CACHE_ENABLED:
+                            gemini_cache.put(cache_key, original_response, prompt)
                         
-                        if audio_file:
-                            print(f"Đã tạo file âm thanh: {audio_file}")
-                        else:
-                            print("Cảnh báo: Không thể tạo file âm thanh. Xem thông báo lỗi ở trên.")
-                        
-                        return cleaned_response
+                        return process_gemini_response(original_response, prompt, save_timestamp, use_content_only,
+                                                       output_name)
             
             # If we reach here, there was an issue with the response format
             if current_retry < max_retries:
@@ -872,10 +3858,823 @@ Lưu ý: Nội dung phải thực sự dài và chi tiết, ít nhất 2500 từ
     # Tạo file âm thanh mặc định khi không nhận được phản hồi từ API
     print("Tạo âm thanh mặc định do không nhận được phản hồi hợp lệ...")
     default_text = f"Xin chào. Đây là thông báo. Chúng tôi không thể tạo kịch bản cho chủ đề {prompt} sau nhiều lần thử. Vui lòng thử lại với một chủ đề khác."
-    text_to_speech_google(default_text, language='vi', save_timestamp=save_timestamp)
+    text_to_speech_google(default_text, language='vi', save_timestamp=save_timestamp, output_name=output_name)
     
     return fallback_response
 
+def stream_gemini_text(api_key, data):
+    """Gọi streamGenerateContent (SSE) và trả về từng phần văn bản ngay khi mô hình đang viết"""
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    
+    with trace_span('gemini_stream', 'gemini', turns=len(data["contents"])) as span, gemini_keys.lease(api_key) as usage, \
+            get_http_session().post(f"{GEMINI_API_BASE}:streamGenerateContent?alt=sse&key={usage['key']}",
+                                    headers=headers, json=data, stream=True, timeout=60) as response:
+        span['status'] = response.status_code
+        response.raise_for_status()
+        span['bytes'] = 0
+        for line in response.iter_lines():
+            span['bytes'] += len(line)
+            line = line.decode('utf-8') if isinstance(line, bytes) else line
+            if not line.startswith('data:'):
+                continue
+            event = json.loads(line[5:].strip())
+            # Sự kiện cuối cùng mang tổng số token của cả lượt
+            usage['tokens'] = gemini_usage_tokens(event) or usage['tokens']
+            candidates = event.get('candidates') or []
+            if candidates:
+                for part in candidates[0].get('content', {}).get('parts', []):
+                    if part.get('text'):
+                        yield part['text']
+        add_generation_tokens(usage['tokens'])
+
+def find_segment_boundary(text):
+    """Tìm vị trí kết thúc câu hoàn chỉnh cuối cùng nằm ngoài ngoặc vuông/ngoặc tròn"""
+    depth = 0
+    boundary = 0
+    for i, char in enumerate(text):
+        if char in '[(':
+            depth += 1
+        elif char in '])':
+            depth = max(0, depth - 1)
+        elif depth == 0:
+            if char == '\n' or (char in '.!?' and i + 1 < len(text) and text[i + 1].isspace()):
+                boundary = i + 1
+    return boundary
+
+@traced_run
+@archived_run
+def send_to_gemini_streaming(api_key, prompt, save_timestamp=False, use_content_only=False, max_workers=None,
+                             force_refresh=False, output_name=None):
+    """Tạo kịch bản qua streamGenerateContent và chuyển từng câu hoàn chỉnh sang TTS ngay khi mô hình đang viết
+    
+    Thời gian tạo file MP3 gần bằng max(thời gian tạo nội dung, thời gian TTS) thay vì tổng của hai bước.
+    Nếu luồng bị lỗi, chuyển sang send_to_gemini thông thường.
+    """
+    cache_key = ResponseCache.make_key(prompt, SCRIPT_PROMPT_TEMPLATE, DEFAULT_GENERATION_CONFIG)
+    if GEMINI_CACHE_ENABLED and not force_refresh:
+        cached_response = gemini_cache.get(cache_key)
+        if cached_response:
+            print("Đã tìm thấy phản hồi trong bộ nhớ đệm, bỏ qua lời gọi Gemini API.")
+            mark_generation_cached()
+            return process_gemini_response(cached_response, prompt, save_timestamp, use_content_only, output_name)
+    archived_response = None if force_refresh else check_duplicate_topic(prompt)
+    if archived_response:
+        return process_gemini_response(archived_response, prompt, save_timestamp, use_content_only, output_name)
+    
+    data = {
+        "contents": [{
+            "parts": [{"text": SCRIPT_PROMPT_TEMPLATE.format(topic=prompt)}]
+        }],
+        "generationConfig": dict(DEFAULT_GENERATION_CONFIG)
+    }
+    
+    _, output_file = prepare_audio_output(save_timestamp, output_name)
+    writer = OrderedAudioWriter(output_file)
+    manifest = ChunkManifest(output_file)
+    
+    def record_chunk(index, chunk, audio_bytes, info, duplicate_of):
+        job_record_chunk(index, audio_bytes)
+        manifest.record(index, chunk, audio_bytes, info, duplicate_of, source=(info or {}).get('source', 'fetched'))
+    
+    dedup = ChunkDeduplicator(writer, record_chunk)
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers or TTS_MAX_WORKERS))
+    futures = []
+    raw_parts = []
+    # Job ở chế độ dịch vụ bị dừng giữa chừng: tiếp tục từ phần kịch bản đã nhận và dùng lại audio đã tải
+    stream_state, resumed_audio = job_resume_stream()
+    state = {
+        'chunks': 0,
+        'pending': '',
+        'first_segment': True,
+        'language': None,
+        'max_chars': tts_backends.chunk_limit(),
+        'content_started': not use_content_only,
+        'segments': [],
+        'stream_ended': False,
+    }
+    
+    def checkpoint_stream():
+        # Lưu văn bản đã nhận và các phân đoạn đã chuyển sang TTS: khi tiếp tục, phát lại đúng các phân đoạn này
+        # cho ra cùng các đoạn nên audio đã tải được dùng lại
+        job_checkpoint(stream_state=json.dumps({
+            'text': ''.join(raw_parts),
+            'segments': state['segments'],
+            'pending': state['pending'],
+            'content_started': state['content_started'],
+        }, ensure_ascii=False))
+    
+    def fetch_chunk(index, chunk, language):
+        audio_bytes = None
+        report = {}
+        start = time.perf_counter()
+        try:
+            audio_bytes = fetch_tts_chunk(chunk, language, manifest.budget, report)
+        except Exception as chunk_error:
+            print(f"  - Lỗi khi xử lý đoạn {index+1}: {str(chunk_error)}")
+            report['error'] = str(chunk_error)
+        report['latency_s'] = time.perf_counter() - start
+        # Ghi ngay trong luồng tải (vào mọi vị trí của đoạn trùng) để đoạn đã sẵn sàng khi future hoàn tất
+        dedup.resolve(chunk, audio_bytes, report)
+    
+    def render_segment(segment):
+        # clean_response → filter_speech_content → remove_special_characters → split_text_into_chunks
+        state['segments'].append(segment)
+        checkpoint_stream()
+        first = state['first_segment']
+        speech_text = clean_response(segment, strip_intro=first)
+        speech_text = filter_speech_content(speech_text, strip_intro=first)
+        speech_text = remove_special_characters(speech_text)
+        if not speech_text.strip():
+            return
+        state['first_segment'] = False
+        if state['language'] is None:
+            state['language'] = detect_speech_language(speech_text, 'vi')
+        
+        for chunk in split_text_into_chunks(speech_text, state['max_chars'], pauses=True):
+            if not chunk.strip():
+                continue
+            index = state['chunks']
+            state['chunks'] += 1
+            manifest.budget.expand(1)
+            job_add_chunk(index, chunk)
+            if not dedup.add(index, chunk):
+                continue
+            if chunk in resumed_audio:
+                dedup.resolve(chunk, resumed_audio[chunk], {'source': 'resumed'})
+            else:
+                futures.append(submit_traced(executor, fetch_chunk, index, chunk, state['language']))
+    
+    def flush_pending(final=False):
+        if not state['content_started']:
+            # Bỏ qua phần trước thẻ [nội dung] khi chỉ đọc nội dung
+            match = re.search(r'\[(content|nội dung)\]', state['pending'], re.IGNORECASE)
+            if match:
+                state['pending'] = state['pending'][match.end():]
+                state['content_started'] = True
+            elif not final:
+                return
+        
+        boundary = len(state['pending']) if final else find_segment_boundary(state['pending'])
+        if boundary and (final or boundary >= STREAM_SEGMENT_MIN_CHARS):
+            segment = state['pending'][:boundary]
+            state['pending'] = state['pending'][boundary:]
+            render_segment(segment)
+    
+    def stream_continuations(rounds=GEMINI_MAX_CONTINUATIONS):
+        # Viết tiếp qua cùng luồng SSE để phần mới cũng được chuyển sang TTS ngay khi mô hình đang viết
+        for round_number in range(1, rounds + 1):
+            text_so_far = ''.join(raw_parts)
+            word_count = len(text_so_far.split())
+            if word_count >= GEMINI_TARGET_WORDS or not text_so_far.strip():
+                return
+            missing_words = GEMINI_TARGET_WORDS - word_count
+            print(f"Nội dung mới có {word_count} từ, yêu cầu Gemini viết tiếp khoảng {missing_words} từ "
+                  f"(lần {round_number}/{rounds})...")
+            request = build_continuation_request(data, text_so_far, missing_words)
+            received = False
+            try:
+                for text_part in stream_gemini_text(api_key, request):
+                    if not received:
+                        text_part = join_continuation(text_so_far, text_part)[len(text_so_far):]
+                        received = True
+                    raw_parts.append(text_part)
+                    state['pending'] += text_part
+                    flush_pending()
+            except Exception as e:
+                # Giữ phần kịch bản đã có nếu lượt viết tiếp bị lỗi
+                print(f"Lỗi khi yêu cầu viết tiếp: {str(e)}")
+                return
+            if not received:
+                return
+    
+    try:
+        if stream_state:
+            print(f"Tiếp tục job từ {len(stream_state['text'].split())} từ đã nhận "
+                  f"({len(resumed_audio)} đoạn âm thanh đã có), không viết lại từ đầu")
+            raw_parts.append(stream_state['text'])
+            state['pending'] = stream_state['pending']
+            state['content_started'] = stream_state['content_started']
+            for segment in stream_state['segments']:
+                render_segment(segment)
+            flush_pending()
+            # Lần chạy trước bị dừng giữa luồng: luôn viết tiếp (ít nhất một lượt) cho đến khi đủ độ dài
+            stream_continuations(max(1, GEMINI_MAX_CONTINUATIONS if GEMINI_CONTINUATION_ENABLED else 1))
+        else:
+            print("Đang gửi yêu cầu đến Gemini API (chế độ luồng)...")
+            stream = stream_gemini_text(api_key, data)
+            cut_short = False
+            while True:
+                try:
+                    text_part = next(stream)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    if not raw_parts:
+                        raise
+                    # Luồng bị ngắt giữa chừng: giữ phần đã nhận và viết tiếp như khi tiếp tục job
+                    print(f"Luồng Gemini bị ngắt sau {len(''.join(raw_parts).split())} từ ({str(e)}), "
+                          f"yêu cầu viết tiếp phần còn lại...")
+                    cut_short = True
+                    break
+                raw_parts.append(text_part)
+                state['pending'] += text_part
+                flush_pending()
+            if cut_short:
+                stream_continuations(max(1, GEMINI_MAX_CONTINUATIONS if GEMINI_CONTINUATION_ENABLED else 1))
+            elif GEMINI_CONTINUATION_ENABLED:
+                stream_continuations()
+        state['stream_ended'] = True
+        flush_pending(final=True)
+        text_seconds = generation_elapsed()
+        print(f"Gemini đã viết xong, đang chờ {sum(not f.done() for f in futures)}/{len(futures)} đoạn âm thanh còn lại...")
+        for future in futures:
+            future.result()
+    except Exception as e:
+        executor.shutdown(wait=False, cancel_futures=True)
+        writer.abort()
+        received_response = ''.join(raw_parts)
+        if not received_response.strip():
+            print(f"Lỗi khi xử lý luồng Gemini: {str(e)}. Chuyển sang chế độ thông thường...")
+            return send_to_gemini(api_key, prompt, save_timestamp, use_content_only, force_refresh=True,
+                                  output_name=output_name)
+        # Đã có văn bản: không gọi lại Gemini từ đầu, chỉ viết tiếp nếu luồng chưa xong rồi tạo âm thanh như thường
+        print(f"Lỗi khi xử lý luồng Gemini: {str(e)}. Giữ {len(received_response.split())} từ đã nhận, "
+              f"tạo âm thanh theo chế độ thông thường...")
+        if not state['stream_ended']:
+            received_response = lengthen_gemini_script(api_key, data, received_response)
+        return process_gemini_response(received_response, prompt, save_timestamp, use_content_only, output_name)
+    executor.shutdown()
+    dedup.report()
+    
+    original_response = ''.join(raw_parts)
+    word_count = len(original_response.split())
+    print(f"Đã nhận phản hồi dài {len(original_response)} ký tự, khoảng {word_count} từ")
+    if not original_response.strip():
+        print("Cảnh báo: Phản hồi từ API trống. Chuyển sang chế độ thông thường...")
+        return send_to_gemini(api_key, prompt, save_timestamp, use_content_only, force_refresh=True,
+                              output_name=output_name)
+    if word_count < GEMINI_TARGET_WORDS:
+        print(f"Cảnh báo: Nội dung quá ngắn cho video 20 phút ({word_count} từ).")
+    elif GEMINI_CACHE_ENABLED:
+        gemini_cache.put(cache_key, original_response, prompt)
+    
+    cleaned_response = clean_response(original_response)
+    if not cleaned_response or len(cleaned_response.strip()) < 10:
+        print("Cảnh báo: Nội dung sau khi làm sạch quá ngắn hoặc trống rỗng, sử dụng nội dung gốc")
+        cleaned_response = original_response
+    job_checkpoint(raw_text=original_response, cleaned_text=cleaned_response, stream_state=None)
+    
+    saved_file = save_responses(original_response, cleaned_response, prompt, save_timestamp, output_name)
+    print(f"Đã lưu phản hồi vào file: {saved_file}")
+    
+    audio_file = None
+    if manifest.finish() != 'failed' and writer.commit():
+        audio_file = output_file
+        print(f"Đã tạo file âm thanh: {output_file} ({writer.chunks_written}/{state['chunks']} đoạn)")
+        print_audio_duration(writer.duration)
+        if TTS_RATE_LIMIT_ENABLED:
+            print_rate_limiter_stats()
+    else:
+        writer.abort()
+        print("Cảnh báo: Không thể tạo file âm thanh. Xem thông báo lỗi ở trên.")
+    # Âm thanh được tạo song song với Gemini: tts_s là phần chờ thêm sau khi Gemini viết xong
+    total_seconds = generation_elapsed()
+    archive_generation(prompt, original_response, cleaned_response, audio_file, saved_file, use_content_only,
+                       {'text_s': text_seconds,
+                        'tts_s': round(total_seconds - text_seconds, 3) if total_seconds is not None else None})
+    
+    return cleaned_response
+
+# Cấu hình chế độ hàng loạt (batch)
+BATCH_MAX_WORKERS = 2      # Số chủ đề được xử lý song song cho mỗi khóa Gemini; mỗi chủ đề còn có TTS_MAX_WORKERS luồng TTS riêng
+BATCH_SLUG_MAX_CHARS = 60
+
+def load_batch_topics(file_path):
+    """Đọc danh sách chủ đề từ file .txt (mỗi dòng một chủ đề), .csv (cột 'topic' hoặc cột đầu tiên) hoặc .jsonl"""
+    extension = os.path.splitext(file_path)[1].lower()
+    topics = []
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as file:
+        if extension == '.csv':
+            rows = [row for row in csv.reader(file) if row]
+            column = 0
+            if rows:
+                header = [cell.strip().lower() for cell in rows[0]]
+                for name in ('topic', 'chủ đề', 'chu de'):
+                    if name in header:
+                        column = header.index(name)
+                        rows = rows[1:]
+                        break
+            topics = [row[column] for row in rows if len(row) > column]
+        elif extension in ('.jsonl', '.ndjson'):
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"Dòng {line_number} không phải JSON hợp lệ: {str(e)}")
+                topics.append(entry.get('topic', '') if isinstance(entry, dict) else str(entry))
+        else:
+            topics = [line for line in file if not line.lstrip().startswith('#')]
+    return [' '.join(topic.split()) for topic in topics if topic and topic.strip()]
+
+def make_batch_artifact_name(index, topic):
+    """Tên file duy nhất cho một chủ đề: số thứ tự + chủ đề không dấu"""
+    slug = topic_slug(topic, BATCH_SLUG_MAX_CHARS)
+    return f"{index + 1:04d}_{slug or 'topic'}"
+
+def describe_artifacts(output_name):
+    """Đường dẫn file phản hồi/âm thanh của một lần tạo theo output_name (None nếu chưa có) và thời lượng âm thanh"""
+    response_file = os.path.join('responses', f"{output_name}.txt")
+    audio_file = os.path.join(os.getcwd(), 'audio', f"{output_name}.mp3")
+    has_audio = os.path.exists(audio_file)
+    artifacts = {
+        'response_file': response_file if os.path.exists(response_file) else None,
+        'audio_file': audio_file if has_audio else None,
+        'audio_seconds': round(read_mp3_duration(audio_file) or 0, 1) if has_audio else None,
+        'manifest_file': None,
+        'missing_chunks': [],
+    }
+    try:
+        with open(manifest_path(audio_file), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        artifacts['manifest_file'] = manifest_path(audio_file)
+        artifacts['missing_chunks'] = manifest.get('missing', [])
+    except (OSError, ValueError):
+        pass
+    return artifacts
+
+def classify_generation(response, artifacts):
+    """Trạng thái (ok, gaps, no_audio, failed) và lỗi của một lần tạo dựa trên các file đã được ghi"""
+    if not artifacts['response_file']:
+        # Các nhánh lỗi của send_to_gemini trả về thông báo lỗi thay vì lưu phản hồi
+        return 'failed', response or "Không nhận được phản hồi từ Gemini"
+    return classify_audio(artifacts)
+
+GENERATION_STATUS_COLORS = {'ok': Colors.GREEN, 'gaps': Colors.YELLOW}
+
+def classify_audio(artifacts):
+    """ok, gaps (được chấp nhận dù thiếu vài đoạn, xem bảng kê) hoặc no_audio"""
+    if not artifacts['audio_file']:
+        missing = len(artifacts['missing_chunks'])
+        return 'no_audio', f"Không thể tạo file âm thanh{f' (thiếu {missing} đoạn)' if missing else ''}"
+    if artifacts['missing_chunks']:
+        return 'gaps', f"Thiếu {len(artifacts['missing_chunks'])} đoạn âm thanh, xem {artifacts['manifest_file']}"
+    return 'ok', None
+
+def run_batch(api_key, topics, max_workers=None, use_streaming=False, use_content_only=False, force_refresh=False):
+    """Tạo kịch bản và âm thanh cho nhiều chủ đề song song, mỗi chủ đề một cặp file riêng
+    
+    Kết quả được lưu vào responses/batch_<thời gian>/ và audio/batch_<thời gian>/,
+    kèm báo cáo summary.json với thời gian và lỗi của từng chủ đề. Trả về báo cáo.
+    """
+    batch_id = f"batch_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    generate = send_to_gemini_streaming if use_streaming else send_to_gemini
+    workers = max(1, min(max_workers or BATCH_MAX_WORKERS * max(1, len(gemini_keys)), len(topics) or 1))
+    
+    def process_topic(index, topic):
+        output_name = f"{batch_id}/{make_batch_artifact_name(index, topic)}"
+        result = {'index': index + 1, 'topic': topic, 'status': 'failed', 'error': None}
+        start = time.perf_counter()
+        response = None
+        try:
+            response = generate(api_key, topic, use_content_only=use_content_only, force_refresh=force_refresh,
+                                output_name=output_name)
+        except Exception as e:
+            result['error'] = str(e)
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        result.update(describe_artifacts(output_name))
+        if result['error'] is None:
+            result['status'], result['error'] = classify_generation(response, result)
+        status_color = GENERATION_STATUS_COLORS.get(result['status'], Colors.RED)
+        print(f"{status_color}[{index + 1}/{len(topics)}] {result['status']} ({result['seconds']:.1f}s): {topic}{Colors.ENDC}")
+        return result
+    
+    print(f"{Colors.CYAN}Bắt đầu {batch_id}: {len(topics)} chủ đề, {workers} chủ đề song song{Colors.ENDC}")
+    started_at = datetime.datetime.now()
+    start = time.perf_counter()
+    results = [None] * len(topics)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_topic, i, topic): i for i, topic in enumerate(topics)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    elapsed = time.perf_counter() - start
+    
+    succeeded = sum(result['status'] in ('ok', 'gaps') for result in results)
+    report = {
+        'batch_id': batch_id,
+        'started_at': started_at.strftime("%Y-%m-%d %H:%M:%S"),
+        'total_seconds': round(elapsed, 3),
+        'workers': workers,
+        'streaming': use_streaming,
+        'topics': len(topics),
+        'succeeded': succeeded,
+        'failed': len(topics) - succeeded,
+        'results': results,
+    }
+    report_dir = os.path.join('responses', batch_id)
+    os.makedirs(report_dir, exist_ok=True)
+    report['report_file'] = os.path.join(report_dir, 'summary.json')
+    write_file_atomically(report['report_file'], json.dumps(report, ensure_ascii=False, indent=2).encode('utf-8'))
+    
+    print(f"\n{Colors.CYAN}=== TỔNG KẾT {batch_id} ==={Colors.ENDC}")
+    print(f"{Colors.CYAN}Thành công: {succeeded}/{len(topics)} chủ đề trong {elapsed:.1f} giây{Colors.ENDC}")
+    for result in results:
+        if result['status'] != 'ok':
+            print(f"{Colors.RED}  #{result['index']} {result['topic']}: {result['error']}{Colors.ENDC}")
+    print(f"{Colors.CYAN}Báo cáo: {report['report_file']}{Colors.ENDC}")
+    return report
+
+# Cấu hình chế độ dịch vụ (service): một tiến trình nạp sẵn mọi thứ, nhận job qua HTTP cục bộ và Unix socket
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_SOCKET = "gemini_chat.sock"   # Tương đối với thư mục làm việc; để trống để tắt
+SERVICE_WORKERS = 2                   # Số job chạy song song; mỗi job còn có TTS_MAX_WORKERS luồng TTS riêng
+SERVICE_MAX_FINISHED_JOBS = 1000      # Số job đã xong được giữ lại để tra cứu trạng thái
+SERVICE_JOB_KINDS = ('generate', 'render')
+SERVICE_MAX_BODY_BYTES = 1024 * 1024
+
+def _now_text():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+class JobQueue:
+    """Hàng đợi job của chế độ dịch vụ, chạy trên một pool SERVICE_WORKERS luồng
+    
+    generate: tạo kịch bản cho topic rồi chuyển thành giọng nói; render: chuyển text có sẵn thành giọng nói.
+    Mỗi job có id, trạng thái (queued, running, ok, gaps, no_audio, failed), thời gian và đường dẫn file kết quả.
+    Với store (JobStore), job được lưu lại và các job chưa xong được chạy tiếp khi khởi động lại.
+    """
+    
+    def __init__(self, api_key, max_workers=None, store=None):
+        self.api_key = api_key
+        self.max_workers = max(1, max_workers or SERVICE_WORKERS)
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        if store:
+            self._resume_unfinished()
+    
+    def _resume_unfinished(self):
+        for stored in self.store.load_jobs(('queued', 'running')):
+            job = {key: stored[key] for key in _JOB_FIELDS}
+            job['status'] = 'queued'
+            self._jobs[job['id']] = job
+            self._executor.submit(self._run, job, stored['input_text'], time.perf_counter())
+            print(f"{Colors.YELLOW}Tiếp tục job {job['id']} ({job['kind']}) từ lần chạy trước: {job['topic']}{Colors.ENDC}")
+    
+    def submit(self, request):
+        """Kiểm tra yêu cầu, đưa job vào hàng đợi và trả về bản sao job; ValueError nếu yêu cầu không hợp lệ"""
+        if not isinstance(request, dict):
+            raise ValueError("Yêu cầu phải là một đối tượng JSON")
+        kind = request.get('kind', 'generate')
+        if kind not in SERVICE_JOB_KINDS:
+            raise ValueError(f"kind phải là một trong {', '.join(SERVICE_JOB_KINDS)}")
+        field = 'topic' if kind == 'generate' else 'text'
+        value = request.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f"Thiếu '{field}' cho job {kind}")
+        
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            'id': job_id,
+            'kind': kind,
+            'status': 'queued',
+            'topic': request.get('topic') or value[:80],
+            'options': {
+                'stream': bool(request.get('stream')),
+                'content_only': bool(request.get('content_only')),
+                'refresh': bool(request.get('refresh')),
+            },
+            'error': None,
+            'submitted_at': _now_text(),
+            'started_at': None,
+            'finished_at': None,
+            'timings': {},
+            'artifacts': {},
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._trim_finished()
+        if self.store:
+            self.store.save_job(job, input_text=value.strip())
+        self._executor.submit(self._run, job, value.strip(), time.perf_counter())
+        print(f"{Colors.CYAN}Nhận job {job_id} ({kind}): {job['topic']}{Colors.ENDC}")
+        return self.get(job_id)
+    
+    def _trim_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['finished_at']]
+        for job_id in finished[:max(0, len(finished) - SERVICE_MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+    
+    def _run(self, job, value, submitted):
+        start = time.perf_counter()
+        with self._lock:
+            job['status'] = 'running'
+            job['started_at'] = _now_text()
+            job['timings']['queued_s'] = round(start - submitted, 3)
+        self._save(job)
+        output_name = f"jobs/{job['id']}_{topic_slug(job['topic'], BATCH_SLUG_MAX_CHARS) or 'job'}"
+        options = job['options']
+        response = None
+        error = None
+        token = _current_job.set((self.store, job['id'])) if self.store else None
+        try:
+            stored = self.store.load_job(job['id']) if self.store else None
+            if job['kind'] == 'generate' and stored and stored['raw_text']:
+                # Gemini đã trả lời ở lần chạy trước: chỉ làm sạch và chuyển thành giọng nói (tiếp tục từ đoạn chưa xong)
+                print(f"Job {job['id']}: dùng lại phản hồi Gemini đã lưu, không gọi lại API")
+                response = process_gemini_response(stored['raw_text'], value, use_content_only=options['content_only'],
+                                                   output_name=output_name)
+            elif job['kind'] == 'generate':
+                generate = send_to_gemini_streaming if options['stream'] else send_to_gemini
+                response = generate(self.api_key, value, use_content_only=options['content_only'],
+                                    force_refresh=options['refresh'], output_name=output_name)
+            else:
+                # render: không có file phản hồi, chỉ có file âm thanh
+                text_to_speech_google(value, output_name=output_name)
+        except Exception as e:
+            error = str(e)
+        finally:
+            if token is not None:
+                _current_job.reset(token)
+        artifacts = describe_artifacts(output_name)
+        if error:
+            status = 'failed'
+        elif job['kind'] == 'generate':
+            status, error = classify_generation(response, artifacts)
+        else:
+            status, error = classify_audio(artifacts)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            job.update(status=status, error=error, artifacts=artifacts, finished_at=_now_text())
+            job['timings']['run_s'] = round(elapsed, 3)
+            job['timings']['total_s'] = round(time.perf_counter() - submitted, 3)
+        self._save(job)
+        if self.store and artifacts['audio_file']:
+            # File MP3 đã hoàn chỉnh nên không cần giữ audio từng đoạn
+            self.store.drop_audio(job['id'])
+        status_color = GENERATION_STATUS_COLORS.get(status, Colors.RED)
+        print(f"{status_color}Job {job['id']} {status} ({elapsed:.1f}s): {job['topic']}{Colors.ENDC}")
+    
+    def _save(self, job):
+        if self.store:
+            with self._lock:
+                snapshot = json.loads(json.dumps(job))
+            self.store.save_job(snapshot)
+    
+    def get(self, job_id):
+        """Bản sao của job (an toàn để chuyển thành JSON), None nếu không có; job đang chạy kèm tiến độ từng đoạn"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            job = json.loads(json.dumps(job)) if job else None
+        if self.store:
+            if job is None:
+                # Job của các lần chạy trước chỉ còn trong kho job
+                stored = self.store.load_job(job_id)
+                job = {key: stored[key] for key in _JOB_FIELDS} if stored else None
+            if job and job['status'] == 'running':
+                job['chunks'] = self.store.chunk_progress(job_id)
+        return job
+    
+    def list(self):
+        with self._lock:
+            return json.loads(json.dumps(list(self._jobs.values())))
+    
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        return {'workers': self.max_workers, 'jobs': counts, 'uptime_s': round(time.time() - self.started_at, 1)}
+    
+    def shutdown(self):
+        """Hủy các job chưa chạy; job đang chạy được chạy nốt"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """API JSON của chế độ dịch vụ, dùng chung cho cổng HTTP và Unix socket
+    
+    POST /jobs                 gửi job: {"kind": "generate", "topic": ...} hoặc {"kind": "render", "text": ...}
+    GET  /jobs                 danh sách job
+    GET  /jobs/<id>            trạng thái, thời gian và file kết quả của một job
+    GET  /health               số luồng, số job theo trạng thái, thời gian chạy
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = "GeminiChatService/1.0"
+    
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path.rstrip('/')
+        queue = self.server.job_queue
+        if path == '/health':
+            self._send_json(200, dict(status='ok', **queue.stats()))
+        elif path == '/jobs':
+            self._send_json(200, {'jobs': queue.list()})
+        elif path.startswith('/jobs/'):
+            job = queue.get(path[len('/jobs/'):])
+            if job:
+                self._send_json(200, job)
+            else:
+                self._send_json(404, {'error': "Không tìm thấy job"})
+        else:
+            self._send_json(404, {'error': "Không tìm thấy đường dẫn"})
+    
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': "Không tìm thấy đường dẫn"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > SERVICE_MAX_BODY_BYTES:
+                self._send_json(413, {'error': "Yêu cầu quá lớn"})
+                return
+            request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            job = self.server.job_queue.submit(request)
+        except (ValueError, UnicodeDecodeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202, job)
+    
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def address_string(self):
+        # Kết nối qua Unix socket không có địa chỉ IP
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+    
+    def log_message(self, format, *args):
+        pass
+
+class ServiceHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+if hasattr(socket, 'AF_UNIX'):
+    class ServiceUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    ServiceUnixServer = None  # Windows: chỉ dùng cổng HTTP
+
+def open_service_socket(socket_path, handler):
+    """Mở Unix socket cho dịch vụ; xóa file socket cũ nếu không còn tiến trình nào lắng nghe"""
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            raise OSError(f"Đã có dịch vụ đang chạy trên {socket_path}")
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(socket_path)
+        finally:
+            probe.close()
+    return ServiceUnixServer(socket_path, handler)
+
+def run_service(api_key, host=None, port=None, socket_path=None, max_workers=None):
+    """Chạy dịch vụ cho đến khi nhấn Ctrl+C: HTTP trên host:port và (nếu hỗ trợ) Unix socket"""
+    queue = JobQueue(api_key, max_workers, job_store if JOB_STORE_ENABLED else None)
+    host = host or SERVICE_HOST
+    port = SERVICE_PORT if port is None else port
+    socket_path = SERVICE_SOCKET if socket_path is None else socket_path
+    
+    servers = []
+    try:
+        http_server = ServiceHTTPServer((host, port), ServiceRequestHandler)
+        servers.append(http_server)
+        print(f"{Colors.CYAN}Dịch vụ HTTP: http://{host}:{http_server.server_address[1]}{Colors.ENDC}")
+        if socket_path and ServiceUnixServer:
+            servers.append(open_service_socket(socket_path, ServiceRequestHandler))
+            print(f"{Colors.CYAN}Unix socket: {os.path.abspath(socket_path)}{Colors.ENDC}")
+    except OSError as e:
+        print(f"{Colors.RED}Không thể khởi động dịch vụ: {str(e)}{Colors.ENDC}")
+        for server in servers:
+            server.server_close()
+        return 2
+    
+    for server in servers:
+        server.job_queue = queue
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"{Colors.GREEN}Dịch vụ sẵn sàng với {queue.max_workers} job song song. Nhấn Ctrl+C để dừng.{Colors.ENDC}")
+    
+    def stop_service(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop_service)  # kill/systemd dừng dịch vụ giống Ctrl+C
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(f"\n{Colors.YELLOW}Đang dừng dịch vụ, chờ các job đang chạy hoàn tất...{Colors.ENDC}")
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if socket_path and ServiceUnixServer and os.path.exists(socket_path):
+            os.remove(socket_path)
+        queue.shutdown()
+        if JOB_STORE_ENABLED:
+            job_store.flush()
+    return 0
+
+def batch_main(argv):
+    """Chế độ không tương tác: python3 gemini_chat.py --batch topics.txt [--workers N] [--stream] ...
+    hoặc python3 gemini_chat.py --serve [--port N] [--socket PATH] [--workers N]
+    hoặc python3 gemini_chat.py --archive / --export [ID ...] [--topic T] [--since NGÀY] [--until NGÀY]
+    hoặc python3 gemini_chat.py --search "TỪ KHÓA" [--limit N] / --import-responses [FILE ...]
+    """
+    global TTS_MAX_WORKERS, GEMINI_HEDGE_MODE, TTS_BACKENDS, API_KEY_SELECTION, ARCHIVE_DUPLICATE_CHECK
+    parser = argparse.ArgumentParser(description="Tạo kịch bản và âm thanh hàng loạt từ file chủ đề (.txt, .csv, .jsonl) "
+                                                 "hoặc chạy dịch vụ nhận job qua HTTP/Unix socket")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--batch', metavar='FILE', help="file chứa danh sách chủ đề")
+    mode.add_argument('--serve', action='store_true', help="chạy dịch vụ cho đến khi nhấn Ctrl+C")
+    mode.add_argument('--archive', action='store_true', help="liệt kê các lần tạo kịch bản trong kho lưu trữ")
+    mode.add_argument('--export', nargs='*', type=int, metavar='ID',
+                      help="tạo lại file phản hồi dễ đọc từ kho lưu trữ (theo id, hoặc theo bộ lọc nếu không có id)")
+    mode.add_argument('--search', metavar='QUERY',
+                      help="tìm trong chủ đề và phần [nội dung] của kho lưu trữ (không phân biệt dấu, \"cụm từ\" để tìm nguyên cụm)")
+    mode.add_argument('--import-responses', nargs='*', metavar='FILE',
+                      help="nhập các file phản hồi cũ vào kho lưu trữ (mặc định: mọi file .txt trong responses/)")
+    parser.add_argument('--topic', help="lọc kho lưu trữ theo chủ đề (không phân biệt dấu, hoa thường)")
+    parser.add_argument('--since', help="lọc kho lưu trữ từ ngày (YYYY-MM-DD)")
+    parser.add_argument('--until', help="lọc kho lưu trữ đến hết ngày (YYYY-MM-DD)")
+    parser.add_argument('--limit', type=int, help="số lần tạo tối đa khi liệt kê hoặc xuất")
+    parser.add_argument('--output', default=ARCHIVE_EXPORT_DIR, help="thư mục chứa file được xuất")
+    parser.add_argument('--workers', type=int, help=f"số chủ đề (batch, mặc định {BATCH_MAX_WORKERS} cho mỗi khóa Gemini) "
+                                                    f"hoặc job (dịch vụ, mặc định {SERVICE_WORKERS}) xử lý song song")
+    parser.add_argument('--host', default=SERVICE_HOST, help="địa chỉ HTTP của dịch vụ")
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help="cổng HTTP của dịch vụ")
+    parser.add_argument('--socket', default=SERVICE_SOCKET, help="đường dẫn Unix socket của dịch vụ ('' để tắt)")
+    parser.add_argument('--tts-workers', type=int, default=TTS_MAX_WORKERS, help="số đoạn TTS tải song song cho mỗi chủ đề")
+    parser.add_argument('--stream', action='store_true', help="dùng chế độ luồng (TTS song song với Gemini)")
+    parser.add_argument('--content-only', action='store_true', help="chỉ đọc phần [nội dung]")
+    parser.add_argument('--refresh', action='store_true', help="bỏ qua bộ nhớ đệm phản hồi Gemini")
+    parser.add_argument('--hedge', choices=GEMINI_HEDGE_MODES, default=GEMINI_HEDGE_MODE, help="chế độ hedging yêu cầu Gemini")
+    parser.add_argument('--tts-backends', default=','.join(TTS_BACKENDS),
+                        help=f"các backend TTS được phép, cách nhau bởi dấu phẩy ({', '.join(tts_backends.backends)})")
+    parser.add_argument('--key-selection', choices=API_KEY_SELECTIONS, default=API_KEY_SELECTION,
+                        help="cách chọn khóa khi tệp cấu hình có nhiều khóa API")
+    parser.add_argument('--similar', choices=ARCHIVE_DUPLICATE_MODES, default=ARCHIVE_DUPLICATE_CHECK,
+                        help="xử lý chủ đề gần trùng với kho lưu trữ trước khi gọi Gemini")
+    parser.add_argument('--config', default="APIvsCURL.txt", help="file chứa các Gemini API key (và ElevenLabs nếu có)")
+    args = parser.parse_args(argv)
+    
+    if args.search is not None:
+        records = response_archive.search(args.search, args.limit or ARCHIVE_SEARCH_LIMIT)
+        print_search_results(records)
+        return 0 if records else 1
+    if args.import_responses is not None:
+        paths = args.import_responses or sorted(glob.glob(os.path.join("responses", "**", "*.txt"), recursive=True))
+        print(f"Đã nhập {import_response_files(paths)}/{len(paths)} file vào kho lưu trữ")
+        return 0
+    if args.archive or args.export is not None:
+        records = response_archive.find(args.topic, args.since, args.until, args.export or None,
+                                        args.limit or (20 if args.archive else None))
+        if args.archive:
+            print_archive_records(records)
+            stats = response_archive.stats()
+            print(f"Kho lưu trữ: {stats['records']} lần tạo, {stats['text_bytes'] // 1024} KB văn bản, "
+                  f"{stats['stored_bytes'] // 1024} KB sau khi nén")
+            return 0
+        paths = export_archive(records, args.output)
+        for path in paths:
+            print(path)
+        print(f"Đã xuất {len(paths)} file vào {args.output}")
+        return 0 if paths else 1
+    
+    TTS_MAX_WORKERS = max(1, args.tts_workers)
+    GEMINI_HEDGE_MODE = args.hedge
+    TTS_BACKENDS = tuple(name.strip() for name in args.tts_backends.split(',') if name.strip())
+    unknown = [name for name in TTS_BACKENDS if name not in tts_backends.backends]
+    if unknown:
+        print(f"{Colors.RED}Lỗi: Backend TTS không tồn tại: {', '.join(unknown)}{Colors.ENDC}")
+        return 2
+    API_KEY_SELECTION = args.key_selection
+    ARCHIVE_DUPLICATE_CHECK = args.similar
+    load_api_keys(args.config)
+    
+    if args.serve:
+        # API key chỉ đọc một lần khi khởi động dịch vụ
+        return run_service(extract_api_key(args.config), args.host, args.port, args.socket, args.workers)
+    
+    try:
+        gemini_api_key = extract_api_key(args.config)
+        topics = load_batch_topics(args.batch)
+    except Exception as e:
+        print(f"{Colors.RED}Lỗi: {str(e)}{Colors.ENDC}")
+        return 2
+    if not topics:
+        print(f"{Colors.YELLOW}Không tìm thấy chủ đề nào trong {args.batch}{Colors.ENDC}")
+        return 2
+    
+    report = run_batch(gemini_api_key, topics, args.workers, args.stream, args.content_only, args.refresh)
+    return 0 if report['failed'] == 0 else 1
+
 def play_audio_file(audio_file):
     """Phát file âm thanh dựa trên nền tảng đang chạy"""
     if not os.path.exists(audio_file):
@@ -916,6 +4715,8 @@ def play_audio_file(audio_file):
         return False
 
 def main():
+    global GEMINI_HEDGE_MODE
+    
     # Default configuration file path
     config_file = "APIvsCURL.txt"
     
@@ -926,11 +4727,13 @@ def main():
         print(f"{Colors.RED}Lỗi khi đọc API key: {str(e)}{Colors.ENDC}")
         print(f"{Colors.YELLOW}Vui lòng đảm bảo tệp APIvsCURL.txt tồn tại và chứa khóa Gemini API của bạn.{Colors.ENDC}")
         sys.exit(1)
+    # Mọi dòng API: và ELEVENLABS: đều được dùng; backend ElevenLabs chỉ được bật khi có ít nhất một dòng ELEVENLABS:
+    load_api_keys(config_file)
     
     # Check if gtts is available
     if not GTTS_AVAILABLE:
         print(f"{Colors.RED}CẢNH BÁO: Thư viện gTTS chưa được cài đặt. Vui lòng cài đặt bằng lệnh: pip install gtts{Colors.ENDC}")
-        print(f"{Colors.YELLOW}Voice sẽ không được tạo cho đến khi bạn cài đặt gTTS.{Colors.ENDC}")
+        print(f"{Colors.YELLOW}Backend gtts sẽ bị bỏ qua khi các backend khác bị lỗi.{Colors.ENDC}")
     
     # Print welcome banner
     print_welcome_banner()
@@ -938,6 +4741,9 @@ def main():
     # Default to not saving timestamp (overwrite files)
     save_with_timestamp = False
     use_content_only = False  # Set to False by default to read entire response
+    use_streaming = False  # Chế độ luồng: chuyển thành giọng nói trong khi Gemini đang viết
+    force_refresh = False  # Bỏ qua bộ nhớ đệm phản hồi Gemini và luôn gọi API
+    use_progressive_playback = False  # Phát âm thanh qua luồng cục bộ ngay từ đoạn đầu tiên, trong khi vẫn đang tạo
     last_audio_file = None
     
     while True:
@@ -957,7 +4763,10 @@ def main():
                 continue
                 
             print(f"{Colors.CYAN}Đang tạo kịch bản cho chủ đề: {topic}...{Colors.ENDC}")
-            response = send_to_gemini(gemini_api_key, topic, save_with_timestamp, use_content_only)
+            generate = send_to_gemini_streaming if use_streaming else send_to_gemini
+            if use_progressive_playback:
+                generate = functools.partial(play_progressively, generate)
+            response = generate(gemini_api_key, topic, save_with_timestamp, use_content_only, force_refresh=force_refresh)
             if response:
                 print(f"{Colors.GREEN}Đã tạo kịch bản thành công!{Colors.ENDC}")
                 # Lưu đường dẫn file audio để phát lại sau này
@@ -1016,11 +4825,81 @@ def main():
                 status = "BẬT" if use_content_only else "TẮT"
                 print(f"{Colors.GREEN}Đã {status} chế độ chỉ đọc phần [nội dung].{Colors.ENDC}")
                 
+            elif config_choice == '4':
+                # Streaming on/off
+                use_streaming = not use_streaming
+                status = "BẬT" if use_streaming else "TẮT"
+                print(f"{Colors.GREEN}Đã {status} chế độ luồng (TTS song song với Gemini).{Colors.ENDC}")
+                
+            elif config_choice == '5':
+                # Force refresh on/off
+                force_refresh = not force_refresh
+                status = "BẬT" if force_refresh else "TẮT"
+                print(f"{Colors.GREEN}Đã {status} chế độ luôn làm mới (bỏ qua bộ nhớ đệm Gemini).{Colors.ENDC}")
+                
+            elif config_choice == '6':
+                # Chuyển chế độ hedging: off → delay → candidates → parallel
+                GEMINI_HEDGE_MODE = GEMINI_HEDGE_MODES[(GEMINI_HEDGE_MODES.index(GEMINI_HEDGE_MODE) + 1) % len(GEMINI_HEDGE_MODES)]
+                print(f"{Colors.GREEN}Chế độ hedging Gemini: {GEMINI_HEDGE_MODE}{Colors.ENDC}")
+                
+            elif config_choice == '7':
+                # Progressive playback on/off
+                use_progressive_playback = not use_progressive_playback
+                status = "BẬT" if use_progressive_playback else "TẮT"
+                print(f"{Colors.GREEN}Đã {status} chế độ phát dần (nghe trong khi đang tạo âm thanh).{Colors.ENDC}")
+                
+            elif config_choice == '8':
+                # Ưu tiên ElevenLabs (trả phí) hoặc trả về thứ tự mặc định
+                status = "BẬT" if toggle_elevenlabs_first() else "TẮT"
+                print(f"{Colors.GREEN}Đã {status} ưu tiên ElevenLabs. Thứ tự backend TTS: {', '.join(TTS_BACKENDS)}{Colors.ENDC}")
+                if not elevenlabs_keys:
+                    print(f"{Colors.YELLOW}Chưa có khóa ELEVENLABS: trong APIvsCURL.txt, ElevenLabs sẽ không được dùng.{Colors.ENDC}")
+                
             elif config_choice == '3':
                 # Hiển thị thông tin cấu hình
                 print(f"\n{Colors.CYAN}=== THÔNG TIN CẤU HÌNH HIỆN TẠI ==={Colors.ENDC}")
                 print(f"{Colors.CYAN}Lưu file với timestamp: {'BẬT' if save_with_timestamp else 'TẮT'}{Colors.ENDC}")
                 print(f"{Colors.CYAN}Chỉ đọc phần [nội dung]: {'BẬT' if use_content_only else 'TẮT'}{Colors.ENDC}")
+                print(f"{Colors.CYAN}Chế độ luồng: {'BẬT' if use_streaming else 'TẮT'}{Colors.ENDC}")
+                print(f"{Colors.CYAN}Luôn làm mới (bỏ qua bộ nhớ đệm Gemini): {'BẬT' if force_refresh else 'TẮT'}{Colors.ENDC}")
+                player = find_stream_player()
+                print(f"{Colors.CYAN}Phát dần: {'BẬT' if use_progressive_playback else 'TẮT'} "
+                      f"(trình phát: {player[0] if player else 'không tìm thấy'}){Colors.ENDC}")
+                print(f"{Colors.CYAN}Hedging Gemini: {GEMINI_HEDGE_MODE}{Colors.ENDC}")
+                print(f"{Colors.CYAN}Thứ tự backend TTS: {', '.join(TTS_BACKENDS)}{Colors.ENDC}")
+                if ARCHIVE_ENABLED:
+                    archive_stats = response_archive.stats()
+                    print(f"{Colors.CYAN}Kho lưu trữ: {archive_stats['records']} lần tạo, "
+                          f"{archive_stats['stored_bytes'] // 1024} KB ({ARCHIVE_PATH}){Colors.ENDC}")
+                    print(f"{Colors.CYAN}Kiểm tra chủ đề gần trùng: {ARCHIVE_DUPLICATE_CHECK} "
+                          f"(giống từ {ARCHIVE_DUPLICATE_THRESHOLD:.0%}){Colors.ENDC}")
+                for pool in (gemini_keys, elevenlabs_keys):
+                    for key_stats in pool.stats():
+                        benched = f", tạm ngưng {key_stats['benched']} giây" if key_stats['benched'] else ""
+                        print(f"{Colors.CYAN}Khóa {pool.name} {key_stats['key']}: {key_stats['requests']} yêu cầu, "
+                              f"{key_stats['tokens']} {'ký tự' if pool is elevenlabs_keys else 'token'}, "
+                              f"{key_stats['throttled']} lần bị 429{benched}{Colors.ENDC}")
+                if gemini_hedge_stats:
+                    wins = ', '.join(f"{strategy}: {count}" for strategy, count in gemini_hedge_stats.items())
+                    print(f"{Colors.CYAN}Chiến lược thắng: {wins}{Colors.ENDC}")
+                print(f"{Colors.CYAN}Số đoạn TTS tải song song: {TTS_MAX_WORKERS}{Colors.ENDC}")
+                if TTS_RATE_LIMIT_ENABLED:
+                    limiter_stats = tts_rate_limiter.stats()
+                    print(f"{Colors.CYAN}Giới hạn tốc độ TTS: {limiter_stats['rate']} yêu cầu/giây, "
+                          f"{limiter_stats['concurrency']} đồng thời{Colors.ENDC}")
+                if TTS_CACHE_ENABLED:
+                    cache_stats = tts_cache.stats()
+                    print(f"{Colors.CYAN}Bộ nhớ đệm TTS: {cache_stats['entries']} đoạn, {cache_stats['bytes'] // 1024} KB "
+                          f"({cache_stats['hits']} trúng / {cache_stats['misses']} trượt){Colors.ENDC}")
+                for backend_stats in tts_backends.stats():
+                    if not backend_stats['available']:
+                        detail = "không khả dụng"
+                    elif backend_stats['samples']:
+                        speed = f"{backend_stats['ms_per_char']} ms/ký tự" if backend_stats['ms_per_char'] is not None else "chưa thành công"
+                        detail = f"{speed}, {backend_stats['success_rate']:.0%} thành công trong {backend_stats['samples']} lần gọi"
+                    else:
+                        detail = "chưa có số liệu"
+                    print(f"{Colors.CYAN}Backend TTS {backend_stats['name']}: {detail}{Colors.ENDC}")
                 print(f"{Colors.CYAN}Đang chạy trên: {'Termux/Android' if is_android else platform.system()}{Colors.ENDC}")
                 if GTTS_AVAILABLE:
                     print(f"{Colors.GREEN}Thư viện gTTS: Đã cài đặt{Colors.ENDC}")
@@ -1047,6 +4926,50 @@ def main():
             use_content_only = False
             print(f"{Colors.GREEN}Đã TẮT chế độ chỉ đọc phần [nội dung]. Sẽ đọc toàn bộ phản hồi.{Colors.ENDC}")
             
+        elif user_input == 'stream on':
+            use_streaming = True
+            print(f"{Colors.GREEN}Đã BẬT chế độ luồng (TTS song song với Gemini).{Colors.ENDC}")
+            
+        elif user_input == 'stream off':
+            use_streaming = False
+            print(f"{Colors.GREEN}Đã TẮT chế độ luồng.{Colors.ENDC}")
+            
+        elif user_input == 'play on':
+            use_progressive_playback = True
+            print(f"{Colors.GREEN}Đã BẬT chế độ phát dần (nghe trong khi đang tạo âm thanh).{Colors.ENDC}")
+            
+        elif user_input == 'play off':
+            use_progressive_playback = False
+            print(f"{Colors.GREEN}Đã TẮT chế độ phát dần.{Colors.ENDC}")
+            
+        elif user_input == ':archive':
+            # Các lệnh kho lưu trữ bắt đầu bằng ':' để không trùng với chủ đề (ví dụ "search engine là gì")
+            print_archive_records(response_archive.find(limit=10))
+            
+        elif user_input == ':export' or user_input.startswith(':export '):
+            # :export: lần tạo mới nhất; :export <id> [<id> ...]: các lần tạo được chọn
+            ids = [int(value) for value in user_input.split()[1:] if value.isdigit()]
+            records = response_archive.find(ids=ids) if ids else response_archive.find(limit=1)
+            paths = export_archive(records)
+            for path in paths:
+                print(f"{Colors.GREEN}Đã xuất: {path}{Colors.ENDC}")
+            if not paths:
+                print(f"{Colors.YELLOW}Không tìm thấy lần tạo nào trong kho lưu trữ.{Colors.ENDC}")
+            
+        elif user_input == ':search' or user_input.startswith(':search '):
+            # :search <từ khóa>: tìm trong chủ đề và phần [nội dung] của các kịch bản đã lưu
+            query = user_input[len(':search'):].strip()
+            records = response_archive.search(query) if query else []
+            print_search_results(records)
+            if not query:
+                print(f"{Colors.YELLOW}Cú pháp: :search <từ khóa> (\"cụm từ\" để tìm nguyên cụm){Colors.ENDC}")
+            elif not records:
+                print(f"{Colors.YELLOW}Không tìm thấy kịch bản nào phù hợp.{Colors.ENDC}")
+            
+        elif user_input.startswith(':'):
+            print(f"{Colors.YELLOW}Lệnh không hợp lệ. Các lệnh kho lưu trữ: :archive, :export [id ...], "
+                  f":search <từ khóa>{Colors.ENDC}")
+            
         elif user_input == 'test':
             # Functionality to test voice generation
             print(f"{Colors.CYAN}Đang tạo file âm thanh kiểm tra...{Colors.ENDC}")
@@ -1062,7 +4985,10 @@ def main():
             # Treat as topic input
             topic = user_input
             print(f"{Colors.CYAN}Đang tạo kịch bản cho chủ đề: {topic}...{Colors.ENDC}")
-            response = send_to_gemini(gemini_api_key, topic, save_with_timestamp, use_content_only)
+            generate = send_to_gemini_streaming if use_streaming else send_to_gemini
+            if use_progressive_playback:
+                generate = functools.partial(play_progressively, generate)
+            response = generate(gemini_api_key, topic, save_with_timestamp, use_content_only, force_refresh=force_refresh)
             if response:
                 print(f"{Colors.GREEN}Đã tạo kịch bản thành công!{Colors.ENDC}")
                 # Lưu đường dẫn file audio để phát lại sau này
@@ -1106,8 +5032,15 @@ def print_config_menu():
     print(f"{Colors.CYAN}║ {Colors.YELLOW}1{Colors.CYAN} - Toggle timestamp  ║{Colors.ENDC}")
     print(f"{Colors.CYAN}║ {Colors.YELLOW}2{Colors.CYAN} - Toggle content    ║{Colors.ENDC}")
     print(f"{Colors.CYAN}║ {Colors.YELLOW}3{Colors.CYAN} - Xem cấu hình      ║{Colors.ENDC}")
+    print(f"{Colors.CYAN}║ {Colors.YELLOW}4{Colors.CYAN} - Toggle streaming  ║{Colors.ENDC}")
+    print(f"{Colors.CYAN}║ {Colors.YELLOW}5{Colors.CYAN} - Toggle refresh    ║{Colors.ENDC}")
+    print(f"{Colors.CYAN}║ {Colors.YELLOW}6{Colors.CYAN} - Đổi chế độ hedging║{Colors.ENDC}")
+    print(f"{Colors.CYAN}║ {Colors.YELLOW}7{Colors.CYAN} - Toggle phát dần   ║{Colors.ENDC}")
+    print(f"{Colors.CYAN}║ {Colors.YELLOW}8{Colors.CYAN} - Toggle ElevenLabs ║{Colors.ENDC}")
     print(f"{Colors.CYAN}║ {Colors.YELLOW}0{Colors.CYAN} - Quay lại menu     ║{Colors.ENDC}")
     print(f"{Colors.CYAN}╚════════════════════╝{Colors.ENDC}")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(batch_main(sys.argv[1:]))
     main() 
\ No newline at end of file
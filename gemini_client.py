@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Client gọn nhẹ cho dịch vụ gemini_chat (python3 gemini_chat.py --serve)
+
+Chỉ dùng thư viện chuẩn và không nạp gemini_chat, nên khởi động gần như tức thì.
+Kết nối qua Unix socket nếu có, nếu không thì qua HTTP.
+
+    python3 gemini_client.py generate "Lịch sử Hà Nội" --stream --wait
+    python3 gemini_client.py render --file script.txt
+    python3 gemini_client.py status <job_id> --wait
+    python3 gemini_client.py list
+    python3 gemini_client.py health
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import http.client
+import urllib.parse
+
+# Phải khớp với SERVICE_HOST / SERVICE_PORT / SERVICE_SOCKET trong gemini_chat.py
+DEFAULT_URL = "http://127.0.0.1:8765"
+DEFAULT_SOCKET = "gemini_chat.sock"
+FINISHED_STATUSES = ('ok', 'gaps', 'no_audio', 'failed')
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection qua Unix socket"""
+
+    def __init__(self, socket_path, timeout=30):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def open_connection(url, socket_path):
+    if not url and socket_path and hasattr(socket, 'AF_UNIX') and os.path.exists(socket_path):
+        return UnixHTTPConnection(socket_path)
+    parts = urllib.parse.urlsplit(url or DEFAULT_URL)
+    return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+def call(args, method, path, payload=None):
+    """Gửi một yêu cầu JSON đến dịch vụ, trả về (mã HTTP, dữ liệu JSON)"""
+    connection = open_connection(args.url, args.socket)
+    try:
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8') or '{}')
+    finally:
+        connection.close()
+
+def wait_for_job(args, job):
+    while job.get('status') not in FINISHED_STATUSES:
+        time.sleep(args.interval)
+        status, job = call(args, 'GET', f"/jobs/{job['id']}")
+        if status != 200:
+            break
+    return job
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gửi job đến dịch vụ gemini_chat")
+    parser.add_argument('--url', help=f"địa chỉ HTTP của dịch vụ (mặc định: Unix socket nếu có, nếu không {DEFAULT_URL})")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="đường dẫn Unix socket của dịch vụ")
+    parser.add_argument('--interval', type=float, default=1.0, help="số giây giữa các lần kiểm tra khi dùng --wait")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help="tạo kịch bản và âm thanh cho một chủ đề")
+    generate.add_argument('topic')
+    generate.add_argument('--stream', action='store_true', help="dùng chế độ luồng")
+    generate.add_argument('--content-only', action='store_true', help="chỉ đọc phần [nội dung]")
+    generate.add_argument('--refresh', action='store_true', help="bỏ qua bộ nhớ đệm phản hồi Gemini")
+    generate.add_argument('--wait', action='store_true', help="chờ job hoàn tất")
+
+    render = commands.add_parser('render', help="chuyển văn bản có sẵn thành giọng nói")
+    source = render.add_mutually_exclusive_group(required=True)
+    source.add_argument('--text')
+    source.add_argument('--file', help="file văn bản UTF-8 ('-' để đọc từ stdin)")
+    render.add_argument('--wait', action='store_true', help="chờ job hoàn tất")
+
+    status = commands.add_parser('status', help="trạng thái của một job")
+    status.add_argument('job_id')
+    status.add_argument('--wait', action='store_true', help="chờ job hoàn tất")
+
+    commands.add_parser('list', help="danh sách job")
+    commands.add_parser('health', help="tình trạng dịch vụ")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'generate':
+            code, result = call(args, 'POST', '/jobs', {
+                'kind': 'generate', 'topic': args.topic, 'stream': args.stream,
+                'content_only': args.content_only, 'refresh': args.refresh,
+            })
+        elif args.command == 'render':
+            if args.file == '-':
+                text = sys.stdin.read()
+            elif args.file:
+                with open(args.file, 'r', encoding='utf-8') as f:
+                    text = f.read()
+            else:
+                text = args.text
+            code, result = call(args, 'POST', '/jobs', {'kind': 'render', 'text': text})
+        elif args.command == 'status':
+            code, result = call(args, 'GET', f"/jobs/{args.job_id}")
+        elif args.command == 'list':
+            code, result = call(args, 'GET', '/jobs')
+        else:
+            code, result = call(args, 'GET', '/health')
+
+        if code < 300 and getattr(args, 'wait', False):
+            result = wait_for_job(args, result)
+    except (OSError, http.client.HTTPException) as e:
+        print(f"Không thể kết nối đến dịch vụ: {str(e)}", file=sys.stderr)
+        return 2
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if code >= 300 or result.get('status') in ('failed', 'no_audio'):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
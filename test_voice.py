@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 import os
 import sys
-import requests
 import re
+from api_common import (get_http_session, ELEVENLABS_API_BASE, ELEVENLABS_VOICE_ID, ELEVENLABS_MODEL_ID,
+                        ELEVENLABS_VOICE_SETTINGS)
 
 def extract_elevenlabs_api_key(file_path):
     try:
@@ -32,13 +33,13 @@ def test_elevenlabs(api_key):
     test_text = "This is a test of the ElevenLabs voice generation API."
     
     # Default English voice
-    voice_id = "21m00Tcm4TlvDq8ikWAM"  # Rachel voice
+    voice_id = ELEVENLABS_VOICE_ID
     
     # Test output file
     output_file = "audio/test_voice.mp3"
     
     # API endpoint
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+    url = f"{ELEVENLABS_API_BASE}/text-to-speech/{voice_id}"
     
     # Headers
     headers = {
@@ -50,11 +51,8 @@ def test_elevenlabs(api_key):
     # Request body
     data = {
         "text": test_text,
-        "model_id": "eleven_multilingual_v2",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.75
-        }
+        "model_id": ELEVENLABS_MODEL_ID,
+        "voice_settings": ELEVENLABS_VOICE_SETTINGS
     }
     
     print(f"Making test request to ElevenLabs API...")
@@ -63,7 +61,7 @@ def test_elevenlabs(api_key):
     
     try:
         # Make the API request
-        response = requests.post(url, json=data, headers=headers)
+        response = get_http_session().post(url, json=data, headers=headers)
         
         # Print response details for debugging
         print(f"Response Status Code: {response.status_code}")